@@ -23,6 +23,19 @@ from . import forms
 admin.site.unregister(Group)
 
 
+class UnitDataAdminMixin:
+    """
+        Bulk deletes from the admin do not call Model.delete(), so the data version of the affected units is updated here
+    """
+    unit_field = 'unit_id'
+
+    def delete_queryset(self, request, queryset):
+        unit_ids = set(queryset.values_list(self.unit_field, flat=True))
+        super().delete_queryset(request, queryset)
+        for unit_id in unit_ids:
+            models.Unit.data_changed(unit_id)
+
+
 """
 
 User admin
@@ -171,7 +184,7 @@ class UnitAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
         return queryset.annotate(
-            students_count=Count('students', distinct=True), projects_count=Count('projects', distinct=True)
+            students_count=models.Unit.related_count(models.Student), projects_count=models.Unit.related_count(models.Project)
         )
 
 
@@ -211,7 +224,7 @@ class PreferencesFilter(SimpleListFilter):
 
 
 @admin.register(models.Student)
-class StudentAdmin(admin.ModelAdmin):
+class StudentAdmin(UnitDataAdminMixin, admin.ModelAdmin):
     list_select_related = ['user', 'unit']
     list_display = ['id', 'student_id', 'name', 'is_registered',
                     'user_link', 'unit_link', 'submitted_preferences', 'preferences_count', 'allocated_project_link', 'allocated_preference_rank']
@@ -358,7 +371,7 @@ class ProjectStudentInlineModelAdmin(admin.TabularInline):
 
 
 @admin.register(models.Project)
-class ProjectAdmin(admin.ModelAdmin):
+class ProjectAdmin(UnitDataAdminMixin, admin.ModelAdmin):
     list_display = ['id', 'identifier', 'name', 'unit_link']
     search_fields = ['name', 'identifier']
 
@@ -390,7 +403,8 @@ Preferences admin
 
 
 @admin.register(models.ProjectPreference)
-class ProjectPreferenceAdmin(admin.ModelAdmin):
+class ProjectPreferenceAdmin(UnitDataAdminMixin, admin.ModelAdmin):
+    unit_field = 'project__unit_id'
     list_select_related = ['student', 'project', 'student__unit']
     list_display = ['id', 'unit_link',  'student_link', 'rank', 'project_link']
     search_fields = ['student__student_id',
@@ -1,4 +1,5 @@
 from django import forms
+from django.db.models import Exists, OuterRef
 
 from crispy_forms.helper import FormHelper
 from crispy_forms.bootstrap import FormActions
@@ -32,12 +33,43 @@ class ExistsMultipleChoiceFilter(ExistsMultipleChoiceMixin, django_filters.Multi
         self.method = 'filter_exists'
 
 
+class SearchFilter(django_filters.CharFilter):
+    """
+        Case insensitive substring search, which uses the trigram indexes on PostgreSQL
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('lookup_expr', 'icontains')
+        super().__init__(*args, **kwargs)
+
+    def filter(self, qs, value):
+        return super().filter(qs, value.strip() if value else value)
+
+
 class ExistsMultipleChoiceFilterSet(ExistsMultipleChoiceMixin, django_filters.FilterSet):
     def filter_exists(self, queryset, name, value):
         if len(value) == 2:
             return queryset
-        lookup = '__'.join([name, 'isnull'])
-        return queryset.filter(**{lookup: False if self.SHOW_EXISTS in value else True}).distinct()
+        show_exists = self.SHOW_EXISTS in value
+        field = queryset.model._meta.get_field(name)
+        if field.concrete and not field.many_to_many:
+            # Foreign keys are checked on the model's own column
+            return queryset.filter(**{f'{name}__isnull': not show_exists})
+        # Related rows are checked with a correlated subquery, rather than joining them and removing the duplicate rows
+        related = Exists(self.get_related_queryset(field))
+        return queryset.filter(related if show_exists else ~related)
+
+    def get_related_queryset(self, field):
+        """
+            Rows related to the outer query's row through a reverse foreign key or a many to many field
+        """
+        if field.many_to_many:
+            if field.concrete:
+                through = field.remote_field.through
+                return through.objects.filter(**{field.m2m_field_name(): OuterRef('pk')})
+            through = field.through
+            return through.objects.filter(**{field.field.m2m_reverse_field_name(): OuterRef('pk')})
+        return field.related_model.objects.filter(**{field.field.name: OuterRef('pk')})
 
 
 """
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.6 on 2026-10-20 01:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_alter_unit_celery_task'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ListUpload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(max_length=255, unique=True)),
+                ('task_name', models.CharField(max_length=255)),
+                ('rows_total', models.PositiveIntegerField(default=0)),
+                ('rows_committed', models.PositiveIntegerField(default=0)),
+                ('completed', models.BooleanField(default=False)),
+                ('unit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='list_uploads', to='core.unit')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.6 on 2026-10-20 01:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_listupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listupload',
+            name='data_version',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='listupload',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.6 on 2026-10-20 01:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_listupload_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unit',
+            name='data_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
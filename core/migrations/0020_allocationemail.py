@@ -0,0 +1,26 @@
+# Generated by Django 4.2.6 on 2026-10-20 01:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_unit_data_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AllocationEmail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sent', models.BooleanField(default=False)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('project', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.project')),
+                ('student', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='allocation_email', to='core.student')),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.6 on 2026-10-20 01:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_allocationemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AllocationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data_version', models.PositiveIntegerField()),
+                ('students_count', models.PositiveIntegerField(default=0)),
+                ('allocated_students_count', models.PositiveIntegerField(default=0)),
+                ('avg_allocated_pref', models.FloatField(null=True)),
+                ('min_allocated_pref', models.PositiveIntegerField(null=True)),
+                ('max_allocated_pref', models.PositiveIntegerField(null=True)),
+                ('rank_counts', models.JSONField(default=dict)),
+                ('project_counts', models.JSONField(default=dict)),
+                ('solver_status', models.CharField(choices=[('OP', 'Successful (Optimal)'), ('FS', 'Successful (Feasible)'), ('IF', 'Failed (Proven Infeasible)'), ('UN', 'Failed (Proven Unbounded)'), ('AB', 'Failed (Abnormal)'), ('MI', 'Failed (Model Invalid)'), ('NO', 'Failed (Not Solved)')], max_length=2, null=True)),
+                ('solve_time', models.FloatField(null=True)),
+                ('objective_value', models.FloatField(null=True)),
+                ('allocated_at', models.DateTimeField(null=True)),
+                ('unit', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='allocation_summary', to='core.unit')),
+            ],
+        ),
+    ]
@@ -0,0 +1,72 @@
+from django.db import DatabaseError, migrations, transaction
+
+
+"""
+
+Trigram indexes for the case insensitive substring searches in the filters, these are only created on PostgreSQL
+servers where the pg_trgm extension is enabled or can be created by the migration, other databases keep scanning the table
+
+"""
+
+TRIGRAM_INDEXES = [
+    ('core_student', 'student_id'),
+    ('core_student', 'name'),
+    ('core_project', 'identifier'),
+    ('core_project', 'name'),
+    ('core_area', 'name'),
+]
+
+
+def get_index_name(table, column):
+    return f'{table}_{column}_trgm'
+
+
+def enable_trigram_extension(connection):
+    """ Returns whether the pg_trgm extension is enabled, creating it if it is available and the database user is allowed to """
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if cursor.fetchone() is not None:
+            return True
+        cursor.execute(
+            "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            return False
+    try:
+        # Managed servers may list the extension as available without letting the database user create it,
+        # the savepoint keeps the failed statement from aborting the rest of the migration
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except DatabaseError:
+        return False
+    return True
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if not enable_trigram_extension(schema_editor.connection):
+        return
+    for table, column in TRIGRAM_INDEXES:
+        # Matches the expression of an icontains lookup, UPPER("column"::text) LIKE UPPER('%value%')
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {get_index_name(table, column)} ON {table} USING gin (UPPER({column}::text) gin_trgm_ops)')
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            f'DROP INDEX IF EXISTS {get_index_name(table, column)}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_allocationsummary'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -1,8 +1,12 @@
+import json
+
 from django import forms
 from django.contrib.auth.models import AbstractUser
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.db import models
-from django.db.models import Count, Q, F
+from django.db.models import Count, Exists, Min, Q, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 
@@ -15,14 +19,30 @@ class User(AbstractUser):
     is_manager = models.BooleanField(default=False)
     is_student = models.BooleanField(default=False)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        user._loaded_username = user.__dict__.get('username')
+        return user
+
+    def link_enrollments(self):
+        """
+            Link the students with the user's username to the user, in a single update rather than saving each student
+        """
+        students = Student.objects.filter(
+            student_id=self.username).exclude(user=self)
+        unit_ids = list(students.values_list('unit_id', flat=True))
+        if unit_ids:
+            students.update(user=self)
+            Unit.objects.filter(pk__in=unit_ids).update(
+                data_version=F('data_version') + 1)
+
     def save(self, *args, **kwargs):
         save = super().save(*args, **kwargs)
-        # Link to user
-        student_objects = Student.objects.filter(student_id=self.username)
-        if student_objects.exists():
-            for student in student_objects:
-                student.user = self
-                student.save()
+        # Only a new user or a changed username can match other students
+        if self.username != getattr(self, '_loaded_username', None):
+            self.link_enrollments()
+            self._loaded_username = self.username
         return save
 
 
@@ -79,15 +99,44 @@ class Unit(models.Model):
     START_ALLOCATION_TASK_NAME = 'Start Allocation'
     EMAIL_ALLOCATION_RESULTS_TASK_NAME = 'Email Allocation Results'
     EMAIL_PREFERENCES_TASK_NAME = 'Email Preferences List'
+    EMAIL_STUDENTS_ALLOCATION_TASK_NAME = 'Email Students Allocated Projects'
+    EMAIL_PROJECT_ROSTERS_TASK_NAME = 'Email Project Rosters'
     UPLOAD_PROJECTS_TASK_NAME = 'Upload Projects List'
     UPLOAD_STUDENTS_TASK_NAME = 'Upload Students List'
     UPLOAD_PREFERENCES_TASK_NAME = 'Upload Preferences List'
+    UPLOAD_PROGRESS_STATE = 'PROGRESS'
     celery_task = models.OneToOneField(
         TaskResult, on_delete=models.SET_NULL, null=True, related_name='unit')
 
+    # Incremented whenever the students, projects, preferences or allocation of the unit change
+    data_version = models.PositiveIntegerField(default=0, editable=False)
+
+    PREFERENCE_DISTRIBUTION_CACHE_TIMEOUT = 60 * 60 * 24
+
     def __str__(self):
         return f'{self.code}: {self.name}'
 
+    def save(self, *args, **kwargs):
+        # The data version is only changed by data_changed(), so saving an out of date instance does not reset it
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name != 'data_version']
+        return super().save(*args, **kwargs)
+
+    @classmethod
+    def data_changed(cls, unit_id):
+        cls.objects.filter(pk=unit_id).update(
+            data_version=F('data_version') + 1)
+
+    @staticmethod
+    def related_count(model):
+        """
+            Number of the unit's rows of model, as a scalar subquery so that annotating several counts does not join the relations together
+        """
+        counts = model.objects.filter(unit_id=OuterRef('pk')).order_by().values(
+            'unit_id').annotate(count=Count('pk')).values('count')
+        return Coalesce(Subquery(counts), 0)
+
     def clean(self) -> None:
         errors = {}
         if self.manager != None and not self.manager.is_manager:
@@ -127,9 +176,14 @@ class Unit(models.Model):
 
     def task_ready(self):
         if self.celery_task:
-            return self.celery_task.status != 'PENDING'
+            return self.celery_task.status not in {'PENDING', self.UPLOAD_PROGRESS_STATE}
         return True
 
+    def get_task_progress(self):
+        if self.celery_task and self.celery_task.status == self.UPLOAD_PROGRESS_STATE and self.celery_task.result:
+            return json.loads(self.celery_task.result)
+        return None
+
     def is_allocating(self):
         if not hasattr(self, 'allocating'):
             self.allocating = False
@@ -149,11 +203,63 @@ class Unit(models.Model):
     def get_allocation_descriptive(self):
         return self.ALLOCATION_STATUS[self.allocation_status]
 
+    def get_stats(self):
+        """
+            Counts used across the manager pages, calculated once per unit object with one query on the students and one on the projects
+        """
+        if not hasattr(self, 'stats'):
+            self.stats = {
+                **self.students.aggregate(
+                    students_count=Count('pk'),
+                    allocated_student_count=Count(
+                        'pk', filter=Q(allocated_project__isnull=False)),
+                    submitted_preferences_count=Count('pk', filter=Exists(
+                        ProjectPreference.objects.filter(student_id=OuterRef('pk'))))),
+                **self.projects.aggregate(
+                    projects_count=Count('pk'),
+                    min_project_spaces=Min('min_students'),
+                    max_project_spaces=Sum('max_students')),
+            }
+        return self.stats
+
+    def get_allocation_summary(self):
+        """
+            Statistics of the unit's allocation, as saved when the allocation was made or last edited,
+            they are only calculated here if the unit does not have a saved summary yet
+        """
+        if not hasattr(self, 'current_allocation_summary'):
+            try:
+                summary = self.allocation_summary
+            except AllocationSummary.DoesNotExist:
+                summary = AllocationSummary.calculate(
+                    self.id, self.data_version)
+            self.current_allocation_summary = summary
+        return self.current_allocation_summary
+
+    def get_preference_distribution(self):
+        """
+            Number of students who preferred each project at each rank, {project id: {rank: count}}, calculated in one
+            grouped query and cached until the unit's data changes
+        """
+        if not hasattr(self, 'preference_distribution'):
+            cache_key = f'preference-distribution:{self.id}:{self.data_version}'
+            distribution = cache.get(cache_key)
+            if distribution is None:
+                distribution = {}
+                counts = ProjectPreference.objects.filter(project__unit_id=self.id).order_by().values_list(
+                    'project_id', 'rank').annotate(count=Count('pk')).order_by('project_id', 'rank')
+                for project_id, rank, count in counts:
+                    distribution.setdefault(project_id, {})[rank] = count
+                cache.set(cache_key, distribution,
+                          self.PREFERENCE_DISTRIBUTION_CACHE_TIMEOUT)
+            self.preference_distribution = distribution
+        return self.preference_distribution
+
     def get_allocated_student_count(self):
-        if not hasattr(self, 'allocated_student_count'):
-            self.allocated_student_count = self.students.filter(
-                allocated_project__isnull=False).count()
-        return self.allocated_student_count
+        return self.get_stats()['allocated_student_count']
+
+    def get_submitted_preferences_count(self):
+        return self.get_stats()['submitted_preferences_count']
 
     def calculate_project_spaces(self):
         self.too_few_students = None
@@ -161,19 +267,12 @@ class Unit(models.Model):
         self.too_many_students = None
         self.max_project_spaces = None
 
-        projects_list = self.projects.all()
-        if projects_list.exists():
-            min_spaces = []
-            max_spaces = []
-            for project in projects_list.all():
-                min_spaces.append(project.min_students)
-                max_spaces.append(project.max_students)
-
-            students_count = self.students.count()
-            self.too_few_students = min(min_spaces) > students_count
-            self.min_project_spaces = min(min_spaces)
-            self.too_many_students = sum(max_spaces) < students_count
-            self.max_project_spaces = sum(max_spaces)
+        stats = self.get_stats()
+        if stats['projects_count']:
+            self.too_few_students = stats['min_project_spaces'] > stats['students_count']
+            self.min_project_spaces = stats['min_project_spaces']
+            self.too_many_students = stats['max_project_spaces'] < stats['students_count']
+            self.max_project_spaces = stats['max_project_spaces']
             return True
         return False
 
@@ -218,6 +317,16 @@ class Area(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        save = super().save(*args, **kwargs)
+        Unit.data_changed(self.unit_id)
+        return save
+
+    def delete(self, *args, **kwargs):
+        delete = super().delete(*args, **kwargs)
+        Unit.data_changed(self.unit_id)
+        return delete
+
     class Meta:
         ordering = ['name']
         constraints = [
@@ -249,17 +358,21 @@ class Project(models.Model):
     def __str__(self):
         return f'{self.identifier}: {self.name}'
 
-    def get_preference_counts(self):
-        if not hasattr(self, 'preference_counts'):
-            self.preference_counts = self.student_preferences.values('rank').annotate(
-                student_count=Count('student')).order_by('rank')
-        return self.preference_counts
-
     def is_allocated(self) -> bool:
         if not hasattr(self, 'allocated'):
             self.allocated = self.allocated_students.count() > 0
         return self.allocated
 
+    def save(self, *args, **kwargs):
+        save = super().save(*args, **kwargs)
+        Unit.data_changed(self.unit_id)
+        return save
+
+    def delete(self, *args, **kwargs):
+        delete = super().delete(*args, **kwargs)
+        Unit.data_changed(self.unit_id)
+        return delete
+
     class Meta:
         ordering = ['unit', 'identifier']
         constraints = [
@@ -314,7 +427,14 @@ class Student(models.Model):
             ).rank if allocated_project_pref.exists() else None
         else:
             self.allocated_preference_rank = None
-        return super().save(*args, **kwargs)
+        save = super().save(*args, **kwargs)
+        Unit.data_changed(self.unit_id)
+        return save
+
+    def delete(self, *args, **kwargs):
+        delete = super().delete(*args, **kwargs)
+        Unit.data_changed(self.unit_id)
+        return delete
 
     class Meta:
         ordering = ['student_id']
@@ -336,6 +456,16 @@ class ProjectPreference(models.Model):
     def __str__(self):
         return f'Student_{self.student}-Unit_{self.student.unit.code}-Rank_{self.rank}-Project_{self.project.identifier}'
 
+    def save(self, *args, **kwargs):
+        save = super().save(*args, **kwargs)
+        Unit.data_changed(self.project.unit_id)
+        return save
+
+    def delete(self, *args, **kwargs):
+        delete = super().delete(*args, **kwargs)
+        Unit.data_changed(self.project.unit_id)
+        return delete
+
     class Meta:
         ordering = ['student__student_id', 'rank', 'project_id',]
         constraints = [
@@ -344,3 +474,127 @@ class ProjectPreference(models.Model):
             models.UniqueConstraint(
                 fields=['student', 'project'], name='%(app_label)s_%(class)s_project_unique')
         ]
+
+
+class ListUpload(models.Model):
+    """
+        Checkpoint for a list upload task, records how many rows of the uploaded file have been committed.
+        Completed uploads record a fingerprint of the file and column mapping, and the unit's data version after the upload,
+        so that uploading the same file again can be skipped if the unit has not changed since
+    """
+    unit = models.ForeignKey(
+        Unit, on_delete=models.CASCADE, related_name='list_uploads')
+    task_id = models.CharField(max_length=255, unique=True)
+    task_name = models.CharField(max_length=255)
+    rows_total = models.PositiveIntegerField(default=0)
+    rows_committed = models.PositiveIntegerField(default=0)
+    completed = models.BooleanField(default=False)
+    fingerprint = models.CharField(max_length=64, blank=True, db_index=True)
+    data_version = models.PositiveIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.task_name}: {self.rows_committed} / {self.rows_total}'
+
+
+class AllocationEmail(models.Model):
+    """
+        Record of the email sending a student their allocated project, so that students are not emailed twice
+        about the same project and failed emails can be retried
+    """
+    student = models.OneToOneField(
+        Student, on_delete=models.CASCADE, related_name='allocation_email')
+    project = models.ForeignKey(
+        Project, on_delete=models.SET_NULL, null=True, related_name='+')
+    sent = models.BooleanField(default=False)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.student}: {"sent" if self.sent else "not sent"}'
+
+
+class AllocationSummary(models.Model):
+    """
+        Statistics of the allocation of a unit, saved when the allocation is made and recalculated when
+        allocations are edited by hand, rather than aggregated over all the students on each page view
+    """
+    unit = models.OneToOneField(
+        Unit, on_delete=models.CASCADE, related_name='allocation_summary')
+    # Data version of the unit when the statistics were calculated
+    data_version = models.PositiveIntegerField()
+
+    students_count = models.PositiveIntegerField(default=0)
+    allocated_students_count = models.PositiveIntegerField(default=0)
+    avg_allocated_pref = models.FloatField(null=True)
+    min_allocated_pref = models.PositiveIntegerField(null=True)
+    max_allocated_pref = models.PositiveIntegerField(null=True)
+    # Number of students allocated to each preference rank, {rank: count}
+    rank_counts = models.JSONField(default=dict)
+    # Allocated group size and average allocated preference of each project, {project id: [count, average]}
+    project_counts = models.JSONField(default=dict)
+
+    # Details of the solve which made the allocation
+    solver_status = models.CharField(
+        max_length=2, choices=Unit.ALLOCATION_STATUS_CHOICES, null=True)
+    solve_time = models.FloatField(null=True)
+    objective_value = models.FloatField(null=True)
+    allocated_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f'{self.unit}: allocation summary'
+
+    @classmethod
+    def calculate(cls, unit_id, data_version, **solve_details):
+        """
+            Calculate and save the statistics of the unit's allocation, in one query grouped by allocated project and rank
+        """
+        students_count = 0
+        allocated_students_count = 0
+        rank_counts = {}
+        project_ranks = {}
+        allocations = Student.objects.filter(unit_id=unit_id).order_by().values_list(
+            'allocated_project_id', 'allocated_preference_rank').annotate(count=Count('pk'))
+        for project_id, rank, count in allocations:
+            students_count = students_count + count
+            if project_id is None:
+                continue
+            allocated_students_count = allocated_students_count + count
+            project_ranks.setdefault(project_id, []).append((rank, count))
+            if rank is not None:
+                rank_counts[rank] = rank_counts.get(rank, 0) + count
+
+        project_counts = {}
+        for project_id, ranks in project_ranks.items():
+            ranked = [(rank, count) for rank, count in ranks if rank is not None]
+            project_counts[str(project_id)] = [sum(count for rank, count in ranks), cls.average_rank(ranked)]
+
+        summary, created = cls.objects.update_or_create(unit_id=unit_id, defaults={
+            'data_version': data_version,
+            'students_count': students_count,
+            'allocated_students_count': allocated_students_count,
+            'avg_allocated_pref': cls.average_rank(rank_counts.items()),
+            'min_allocated_pref': min(rank_counts) if rank_counts else None,
+            'max_allocated_pref': max(rank_counts) if rank_counts else None,
+            'rank_counts': {str(rank): count for rank, count in sorted(rank_counts.items())},
+            'project_counts': project_counts,
+            **solve_details,
+        })
+        return summary
+
+    @classmethod
+    def allocation_changed(cls, unit_id):
+        """ Recalculate the statistics after the unit's allocation has been edited, the details of the solve are kept """
+        data_version = Unit.objects.values_list(
+            'data_version', flat=True).get(pk=unit_id)
+        return cls.calculate(unit_id, data_version)
+
+    @staticmethod
+    def average_rank(rank_counts):
+        rank_counts = list(rank_counts)
+        count = sum(count for rank, count in rank_counts)
+        return sum(rank * count for rank, count in rank_counts) / count if count else None
+
+    def get_project_counts(self, project_id):
+        """ Allocated group size and average allocated preference of a project """
+        return self.project_counts.get(str(project_id), [0, None])
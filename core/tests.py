@@ -1,2 +1,57 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
 from . import models
+
+
+class EnrollmentLinkTests(TestCase):
+    def setUp(self):
+        self.manager = models.User.objects.create(
+            username='manager', email='manager@example.com', is_manager=True)
+
+    def create_enrollments(self, student_id, unit_count):
+        units = models.Unit.objects.bulk_create([models.Unit(
+            code=f'{student_id}-{i}', name=f'{student_id}-{i}', year='2024', semester='1', manager=self.manager) for i in range(unit_count)])
+        models.Student.objects.bulk_create(
+            [models.Student(unit=unit, student_id=student_id) for unit in units])
+        return units
+
+    def create_user(self, username):
+        with CaptureQueriesContext(connection) as queries:
+            user = models.User.objects.create(
+                username=username, email=f'{username}@example.com', is_student=True)
+        return user, len(queries)
+
+    def test_new_user(self):
+        self.create_enrollments('few', 1)
+        units = self.create_enrollments('many', 10)
+        few_user, few_count = self.create_user('few')
+        many_user, many_count = self.create_user('many')
+        self.assertEqual(few_count, many_count)
+        self.assertEqual(many_user.enrollments.count(), 10)
+        self.assertFalse(models.Unit.objects.filter(
+            pk__in=[unit.id for unit in units], data_version=0).exists())
+
+    def test_saved_user(self):
+        self.create_enrollments('renamed', 2)
+        user, count = self.create_user('student')
+        user = models.User.objects.get(pk=user.pk)
+        # Saving a user without changing the username does not look for students
+        with CaptureQueriesContext(connection) as queries:
+            user.first_name = 'Student'
+            user.save()
+        self.assertEqual(len(queries), 1)
+
+        user.username = 'renamed'
+        user.save()
+        self.assertEqual(sorted(user.enrollments.values_list('unit__code', flat=True)), [
+            'renamed-0', 'renamed-1'])
+
+    def test_registration(self):
+        self.create_enrollments('registered', 2)
+        self.client.post(reverse('register'), {'username': 'registered', 'email': 'registered@example.com',
+                         'password1': 'a-long-password-123', 'password2': 'a-long-password-123'})
+        self.assertEqual(models.User.objects.get(
+            username='registered').enrollments.count(), 2)
@@ -95,14 +95,8 @@ class StudentRegistrationView(FormMixin, TemplateView):
         if form.is_valid():
             # Set as student
             form.instance.is_student = True
+            # Saving the user adds them to their enrolled units
             user = form.save()
-            # Add to enrolled units
-            student_objects = models.Student.objects.filter(
-                student_id=user.username)
-            if student_objects.exists():
-                for student in student_objects:
-                    student.user = user
-                    student.save()
             # Log user in
             login(request, user)
             return self.form_valid(form)
@@ -1,4 +1,5 @@
 import os
+import ssl
 
 from .settings import *
 
@@ -31,6 +32,17 @@ REDIS_URL = os.environ['AZURE_REDIS_CONNECTIONSTRING']
 CELERY_BROKER_URL = REDIS_URL
 result_backend = REDIS_URL
 
+# Cache, shared by the web app and the celery workers
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'OPTIONS': {
+            'ssl_cert_reqs': ssl.CERT_NONE
+        } if REDIS_URL.startswith('rediss://') else {}
+    }
+}
+
 # EMAIL BACKEND
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = os.getenv('EMAIL_HOST')
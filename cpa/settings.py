@@ -167,3 +167,19 @@ DJANGO_TABLES2_TEMPLATE = 'django_tables2/bootstrap5-responsive.html'
 
 # EMAIL BACKEND
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+# List uploads
+UPLOAD_CHUNK_SIZE = 1000
+# Use PostgreSQL COPY for student and preference uploads when the database supports it
+UPLOAD_USE_COPY = True
+
+# Exports
+# Emailed exports larger than this (in characters) are attached as a zip file
+EXPORT_ATTACHMENT_ZIP_SIZE = 2 * 1024 * 1024
+
+# Emailing students their allocated projects
+# Number of emails sent over the SMTP connection at a time, and the number of seconds to wait between batches
+ALLOCATION_EMAIL_BATCH_SIZE = 50
+ALLOCATION_EMAIL_BATCH_DELAY = 1
+# Number of times a failed batch is sent before giving up
+ALLOCATION_EMAIL_MAX_ATTEMPTS = 3
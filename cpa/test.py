@@ -34,3 +34,11 @@ DATABASES = {
 REDIS_URL = 'redis://127.0.0.1:6379/0'
 CELERY_BROKER_URL = REDIS_URL
 result_backend = REDIS_URL
+
+# Cache, shared by the web app and the celery workers
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    }
+}
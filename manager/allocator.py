@@ -1,4 +1,5 @@
 from django.core.mail import EmailMultiAlternatives
+from django.utils import timezone
 
 from ortools.linear_solver import pywraplp
 
@@ -67,7 +68,7 @@ class Allocator:
         previous_allocation_successful = previous_allocation_status == models.Unit.OPTIMAL or previous_allocation_status == models.Unit.FEASIBLE
         # Save the allocation if it was successful
         if allocation_successful:
-            self.save_allocation()
+            self.save_allocation(result)
         # Update the allocation status -> only if this allocation was sucessful or there was no successful previous allocation
         unit.allocation_status = result if allocation_successful or not previous_allocation_successful else previous_allocation_status
         unit.save()
@@ -135,7 +136,7 @@ class Allocator:
     def get_bool_var_value(self, variable):
         return 1 if variable > 0.5 else 0
 
-    def save_allocation(self):
+    def save_allocation(self, status):
         student_allocated = []
         for project in self.projects:
             if self.project_vars[project.id]:
@@ -157,3 +158,11 @@ class Allocator:
 
         models.Student.objects.bulk_update(
             student_allocated, fields=['allocated_project', 'allocated_preference_rank'])
+        models.Unit.data_changed(self.unit.id)
+
+        # Save the statistics of the allocation for the unit's pages
+        data_version = models.Unit.objects.values_list(
+            'data_version', flat=True).get(pk=self.unit.id)
+        models.AllocationSummary.calculate(
+            self.unit.id, data_version, solver_status=status, solve_time=self.solver.WallTime() / 1000,
+            objective_value=self.solver.Objective().Value(), allocated_at=timezone.now())
@@ -1,12 +1,111 @@
 import datetime
 import csv
-from io import StringIO
-
+import io
+import itertools
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+
+from django.conf import settings
+from django.core.cache import cache
 from django.core.mail import EmailMessage
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 
 from core import models
 
+# Number of rows fetched from the database at a time when exporting
+EXPORT_CHUNK_SIZE = 2000
+# Exports are cached until the unit's data changes, larger exports are streamed without being cached
+EXPORT_CACHE_MAX_SIZE = 10 * 1024 * 1024
+EXPORT_CACHE_TIMEOUT = 60 * 60 * 24
+# Size of the pieces a cached export is streamed in
+EXPORT_STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class Echo:
+    """
+        Pseudo-buffer for csv.writer, returns each written row instead of storing it
+    """
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo(), delimiter=',', quoting=csv.QUOTE_ALL)
+    return (writer.writerow(row) for row in rows)
+
+
+def get_export_cache_key(unit, export_name):
+    return f'export:{export_name}:{unit.id}:{unit.data_version}'
+
+
+def stream_and_cache_csv(cache_key, rows):
+    """ Stream the rows as CSV, the CSV is cached once all of it has been streamed if it is small enough """
+    content = []
+    content_size = 0
+    for line in stream_csv(rows):
+        if content is not None:
+            content.append(line)
+            content_size = content_size + len(line)
+            if content_size > EXPORT_CACHE_MAX_SIZE:
+                content = None
+        yield line
+    if content is not None:
+        cache.set(cache_key, ''.join(content), EXPORT_CACHE_TIMEOUT)
+
+
+def stream_content(content):
+    for start in range(0, len(content), EXPORT_STREAM_CHUNK_SIZE):
+        yield content[start:start + EXPORT_STREAM_CHUNK_SIZE]
+
+
+def get_export_response(unit, export_name, generate_rows, filename):
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+    cache_key = get_export_cache_key(unit, export_name)
+    content = cache.get(cache_key)
+    if content is not None:
+        response = StreamingHttpResponse(stream_content(
+            content), content_type='text/csv', headers=headers)
+    else:
+        # Rows are written to the response as they are read from the database
+        response = StreamingHttpResponse(stream_and_cache_csv(
+            cache_key, generate_rows(unit.id)), content_type='text/csv', headers=headers)
+    return response
+
+
+def get_export_csv(unit, export_name, generate_rows):
+    """ The CSV written to a temporary file as it is generated, the file is only kept in memory while it is small """
+    content = cache.get(get_export_cache_key(unit, export_name))
+    lines = stream_content(content) if content is not None else stream_csv(
+        generate_rows(unit.id))
+    csv_file = tempfile.SpooledTemporaryFile(
+        max_size=settings.EXPORT_ATTACHMENT_ZIP_SIZE)
+    for line in lines:
+        csv_file.write(line.encode('utf-8'))
+    csv_file.seek(0)
+    return csv_file
+
+
+def attach_export(email, filename, csv_file):
+    """ Attach the CSV file to the email, zipped if it is larger than settings.EXPORT_ATTACHMENT_ZIP_SIZE """
+    size = csv_file.seek(0, io.SEEK_END)
+    csv_file.seek(0)
+    if size <= settings.EXPORT_ATTACHMENT_ZIP_SIZE:
+        email.attach(filename, csv_file.read().decode('utf-8'), 'text/csv')
+        return
+    with tempfile.SpooledTemporaryFile(max_size=settings.EXPORT_ATTACHMENT_ZIP_SIZE) as zip_file:
+        with zipfile.ZipFile(zip_file, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            with archive.open(filename, 'w') as archive_file:
+                shutil.copyfileobj(csv_file, archive_file,
+                                   EXPORT_STREAM_CHUNK_SIZE)
+        zip_file.seek(0)
+        email.attach(f'{os.path.splitext(filename)[0]}.zip',
+                     zip_file.read(), 'application/zip')
+
+
 """
 
 Exporting a list of student allocations
@@ -14,25 +113,22 @@ Exporting a list of student allocations
 """
 
 
-def generate_allocation_results_csv(unit):
-    file_output = StringIO()
-    # Write to file
-    writer = csv.writer(file_output, delimiter=',', quoting=csv.QUOTE_ALL)
-
+def generate_allocation_results_rows(unit_id):
     # Add headers to file
-    writer.writerow(['student_id', 'student_name', 'project_id',
-                    'project_name', 'project', 'allocated_preference_rank'])
+    yield ['student_id', 'student_name', 'project_id',
+           'project_name', 'project', 'allocated_preference_rank']
     # Write students to file
-    for student in unit.students.all():
-        if student.allocated_project:
-            writer.writerow(
-                [student.student_id, student.name, student.allocated_project.identifier, student.allocated_project.name, f'{student.allocated_project.identifier}_{student.allocated_project.name}', student.allocated_preference_rank])
+    students = models.Student.objects.filter(unit_id=unit_id).values_list(
+        'student_id', 'name', 'allocated_project_id', 'allocated_project__identifier', 'allocated_project__name', 'allocated_preference_rank')
+    for student_id, name, allocated_project_id, project_identifier, project_name, allocated_preference_rank in students.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        if allocated_project_id:
+            yield [student_id, name, project_identifier, project_name, f'{project_identifier}_{project_name}', allocated_preference_rank]
         else:
-            writer.writerow(
-                [student.student_id, student.name, '', '', ''])
+            yield [student_id, name, '', '', '']
+
 
-    file_output.seek(0)
-    return file_output
+def generate_allocation_results_csv(unit):
+    return get_export_csv(unit, 'allocation-results', generate_allocation_results_rows)
 
 
 def generate_allocation_results_filename(unit):
@@ -40,24 +136,12 @@ def generate_allocation_results_filename(unit):
 
 
 def download_allocation_results_csv(unit_id):
-    unit = models.Unit.objects.filter(pk=unit_id).prefetch_related('projects').prefetch_related(
-        'students').first()
-
-    response = HttpResponse(
-        content_type='text/csv',
-        headers={
-            'Content-Disposition': f'attachment; filename="{generate_allocation_results_filename(unit)}"'},
-        content=generate_allocation_results_csv(unit)
-    )
-
-    return response
+    unit = models.Unit.objects.filter(pk=unit_id).first()
+    return get_export_response(unit, 'allocation-results', generate_allocation_results_rows, generate_allocation_results_filename(unit))
 
 
 def email_allocation_results_csv(unit_id, manager_id):
-    unit = models.Unit.objects.filter(pk=unit_id).prefetch_related('projects').prefetch_related(
-        'students').first()
-
-    attachment = generate_allocation_results_csv(unit)
+    unit = models.Unit.objects.filter(pk=unit_id).first()
 
     # Email with attached file
     manager = models.User.objects.filter(pk=manager_id).first()
@@ -67,8 +151,9 @@ def email_allocation_results_csv(unit_id, manager_id):
             body=f'The results of the allocation of students to projects for {unit.name} are attached.\n',
             to=[manager.email]
         )
-        email.attach(generate_allocation_results_filename(
-            unit), attachment.read(), 'text/csv')
+        with generate_allocation_results_csv(unit) as attachment:
+            attach_export(email, generate_allocation_results_filename(
+                unit), attachment)
         result = email.send(fail_silently=False)
         return 'Email successful' if result else 'Email failed'
     return 'No email specified'
@@ -81,21 +166,19 @@ Exporting a list of student preferences
 """
 
 
-def generate_preferences_csv(preferences):
-    file_output = StringIO()
-    # Write to file
-    writer = csv.writer(file_output, delimiter=',', quoting=csv.QUOTE_ALL)
-
+def generate_preferences_rows(unit_id):
     # Add headers to file
-    writer.writerow(['student_id', 'student_name', 'preference_rank',
-                    'project_id', 'project_name'])
+    yield ['student_id', 'student_name', 'preference_rank',
+           'project_id', 'project_name']
     # Write preferences to file
-    for preference in preferences.all():
-        writer.writerow([preference.student.student_id, preference.student.name, preference.rank,
-                        preference.project.identifier, preference.project.name])
+    preferences = models.ProjectPreference.objects.filter(project__unit_id=unit_id).values_list(
+        'student__student_id', 'student__name', 'rank', 'project__identifier', 'project__name')
+    for preference in preferences.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield list(preference)
+
 
-    file_output.seek(0)
-    return file_output
+def generate_preferences_csv(unit):
+    return get_export_csv(unit, 'preferences', generate_preferences_rows)
 
 
 def generate_preferences_filename(unit):
@@ -104,25 +187,11 @@ def generate_preferences_filename(unit):
 
 def download_preferences_csv(unit_id):
     unit = models.Unit.objects.filter(pk=unit_id).first()
-    preferences = models.ProjectPreference.objects.filter(
-        project__unit_id=unit_id).prefetch_related('project').prefetch_related('student')
-
-    response = HttpResponse(
-        content_type='text/csv',
-        headers={
-            'Content-Disposition': f'attachment; filename="{generate_preferences_filename(unit)}"'},
-        content=generate_preferences_csv(preferences)
-    )
-
-    return response
+    return get_export_response(unit, 'preferences', generate_preferences_rows, generate_preferences_filename(unit))
 
 
 def email_preferences_csv(unit_id, manager_id):
     unit = models.Unit.objects.filter(pk=unit_id).first()
-    preferences = models.ProjectPreference.objects.filter(
-        project__unit_id=unit_id).prefetch_related('project').prefetch_related('student')
-
-    attachment = generate_preferences_csv(preferences)
 
     # Email with attached file
     manager = models.User.objects.filter(pk=manager_id).first()
@@ -132,9 +201,102 @@ def email_preferences_csv(unit_id, manager_id):
             body=f'The student project preferences for {unit.name} are attached.\n',
             to=[manager.email]
         )
-        email.attach(generate_preferences_filename(
-            unit), attachment.read(), 'text/csv')
+        with generate_preferences_csv(unit) as attachment:
+            attach_export(email, generate_preferences_filename(
+                unit), attachment)
         result = email.send(fail_silently=False)
 
         return 'Email successful' if result else 'Email failed'
     return 'No email specified'
+
+
+"""
+
+Exporting a roster of the students allocated to each project
+
+"""
+
+
+class ZipStream:
+    """
+        Unseekable file-like object that collects the bytes written by zipfile, so the archive can be streamed as it is written
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size = self.size + len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def generate_project_roster_rows(unit_id):
+    """ The students allocated to each project, grouped by project, in a single query """
+    projects = models.Project.objects.filter(unit_id=unit_id).order_by('identifier', 'allocated_students__student_id').values_list(
+        'identifier', 'name', 'allocated_students__student_id', 'allocated_students__name', 'allocated_students__user__email', 'allocated_students__allocated_preference_rank')
+    return projects.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def generate_project_roster_filename(identifier, name):
+    return re.sub(r'[^\w\-]+', '_', f'{identifier}-{name}') + '.csv'
+
+
+def stream_project_rosters_zip(unit_id):
+    """ Zip of a CSV for each project, the archive is yielded in pieces as it is written """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for (identifier, name), rows in itertools.groupby(generate_project_roster_rows(unit_id), key=lambda row: row[:2]):
+            with archive.open(generate_project_roster_filename(identifier, name), 'w') as archive_file:
+                # Projects without any allocated students have a single row with no student
+                students = ([row[2], row[3], row[4] if row[4] else '', row[5]]
+                            for row in rows if row[2] is not None)
+                for line in stream_csv(itertools.chain([['student_id', 'student_name', 'student_email', 'allocated_preference_rank']], students)):
+                    archive_file.write(line.encode('utf-8'))
+                    if stream.size >= EXPORT_STREAM_CHUNK_SIZE:
+                        yield stream.read()
+    yield stream.read()
+
+
+def generate_project_rosters_filename(unit):
+    return datetime.datetime.now().strftime('%Y%m%d-%H_%M_%S') + f'-{unit.code.lower()}-project-rosters.zip'
+
+
+def download_project_rosters_zip(unit_id):
+    unit = models.Unit.objects.filter(pk=unit_id).first()
+    return StreamingHttpResponse(
+        stream_project_rosters_zip(unit.id),
+        content_type='application/zip',
+        headers={
+            'Content-Disposition': f'attachment; filename="{generate_project_rosters_filename(unit)}"'}
+    )
+
+
+def email_project_rosters_zip(unit_id, manager_id):
+    unit = models.Unit.objects.filter(pk=unit_id).first()
+
+    attachment = b''.join(stream_project_rosters_zip(unit.id))
+
+    # Email with attached file
+    manager = models.User.objects.filter(pk=manager_id).first()
+    if manager.email != None:
+        email = EmailMessage(
+            subject=f'{unit.name}: Project Rosters',
+            body=f'A list of the students allocated to each project for {unit.name} is attached.\n',
+            to=[manager.email]
+        )
+        email.attach(generate_project_rosters_filename(
+            unit), attachment, 'application/zip')
+        result = email.send(fail_silently=False)
+        return 'Email successful' if result else 'Email failed'
+    return 'No email specified'
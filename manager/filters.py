@@ -1,4 +1,5 @@
-from django.db.models import Count
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 
 import django_filters
 
@@ -8,7 +9,7 @@ from crispy_forms.layout import Layout, Fieldset, Submit, HTML, Div
 from crispy_bootstrap5.bootstrap5 import FloatingField
 
 from core import models
-from core.filters import ExistsMultipleChoiceFilter, ExistsMultipleChoiceFilterSet
+from core.filters import ExistsMultipleChoiceFilter, ExistsMultipleChoiceFilterSet, SearchFilter
 
 
 def unit_projects(request):
@@ -46,10 +47,8 @@ Student Filters
 
 
 class StudentFilter(ExistsMultipleChoiceFilterSet):
-    student_id = django_filters.CharFilter(
-        lookup_expr='icontains', label='Student ID')
-    name = django_filters.CharFilter(
-        lookup_expr='icontains', label='Student Name')
+    student_id = SearchFilter(label='Student ID')
+    name = SearchFilter(label='Student Name')
     registered = ExistsMultipleChoiceFilter(
         field_name='user', exists_label='Registered Students', not_exists_label='Un-Registered Students')
     preferences = ExistsMultipleChoiceFilter(
@@ -128,9 +127,8 @@ Project Filters
 
 
 class ProjectFilter(django_filters.FilterSet):
-    identifier = django_filters.NumberFilter(
-        lookup_expr='contains', label='ID')
-    name = django_filters.CharFilter(lookup_expr='icontains', label='Name')
+    identifier = SearchFilter(label='ID')
+    name = SearchFilter(label='Name')
     min_students = django_filters.NumberFilter(label='Min. Group Size')
     max_students = django_filters.NumberFilter(label='Max. Group Size')
 
@@ -149,8 +147,10 @@ class ProjectAllocatedFilter(ExistsMultipleChoiceFilterSet, ProjectFilter):
         field_name='allocated_students', exists_label='Allocated Projects', not_exists_label='Unallocated Projects')
 
     def filter_num_allocated(self, queryset, name, value):
-        return queryset.annotate(allocated_student_count=Count(
-            'allocated_students')).filter(allocated_student_count=value)
+        # Count the allocated students in a subquery, rather than grouping the joined students of every project
+        allocated_student_count = models.Student.objects.filter(allocated_project_id=OuterRef('pk')).order_by().values(
+            'allocated_project_id').annotate(count=Count('pk')).values('count')
+        return queryset.alias(allocated_student_count=Coalesce(Subquery(allocated_student_count), 0)).filter(allocated_student_count=value)
 
 
 project_filter_form_layout_main = Fieldset(
@@ -203,14 +203,11 @@ Preference filters
 class PreferenceFilter(django_filters.FilterSet):
     rank = django_filters.NumberFilter(lookup_expr='exact')
 
-    project__identifier = django_filters.CharFilter(
-        lookup_expr='icontains', label='Project ID')
-    project__name = django_filters.CharFilter(
-        lookup_expr='icontains', label='Project Name')
+    project__identifier = SearchFilter(label='Project ID')
+    project__name = SearchFilter(label='Project Name')
     project = django_filters.ModelMultipleChoiceFilter(queryset=unit_projects)
 
-    student__student_id = django_filters.CharFilter(
-        lookup_expr='contains', label='Student ID')
+    student__student_id = SearchFilter(label='Student ID')
     student = django_filters.ModelMultipleChoiceFilter(queryset=unit_students)
 
     class Meta:
@@ -255,9 +252,8 @@ class PreferenceFilterFormHelper(FormHelper):
 
 
 class PreferenceDistributionFilter(django_filters.FilterSet):
-    identifier = django_filters.CharFilter(
-        lookup_expr='icontains', label='Project ID')
-    name = django_filters.CharFilter(lookup_expr='icontains', label='Name')
+    identifier = SearchFilter(label='Project ID')
+    name = SearchFilter(label='Name')
     project = django_filters.ModelMultipleChoiceFilter(queryset=unit_projects)
 
     class Meta:
@@ -292,8 +288,7 @@ Area filters
 
 
 class AreaFilter(ExistsMultipleChoiceFilterSet):
-    name = django_filters.CharFilter(
-        lookup_expr='icontains', label='Name')
+    name = SearchFilter(label='Name')
     has_projects = ExistsMultipleChoiceFilter(
         field_name='projects', exists_label='Has Projects', not_exists_label='Doesn\'t Have Projects')
     has_students = ExistsMultipleChoiceFilter(
@@ -1,10 +1,12 @@
 import csv
-from io import StringIO
+import io
 import os
 
 from django import forms
-from django.db.models import Q, ExpressionWrapper, BooleanField
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
 from django.templatetags.static import static
+from django.urls import reverse
 
 from crispy_forms.bootstrap import FormActions
 from crispy_forms.helper import FormHelper
@@ -15,22 +17,15 @@ from core import models
 
 
 class ListForm(forms.Form):
-    def clean(self):
-        file = self.cleaned_data.get('file')
-
-        # Check if CSV file
-        if os.path.splitext(file.name)[1].casefold() != '.csv'.casefold():
-            raise forms.ValidationError({'file': 'File must be CSV.'})
+    """
+        Form for uploading a list in a CSV file, the file is validated in a single streaming pass
+    """
+    max_errors = 20
 
-        # Check if CSV file has rows
-        file.seek(0)
-        csv_data = csv.DictReader(
-            StringIO(file.read().decode('utf-8-sig')), delimiter=',')
-        csv_len = sum(1 for row in csv_data)
-        if csv_len == 0:
-            raise forms.ValidationError(
-                {'file': 'The uploaded file must have at least one row, other than the header row.'})
+    dry_run = forms.BooleanField(
+        label='Preview the changes without uploading the list', required=False)
 
+    def get_columns_to_check(self):
         # Make a dictionary of all the columns to be checked
         columns_to_check = {}
         if hasattr(self, 'columns_required'):
@@ -40,19 +35,77 @@ class ListForm(forms.Form):
             for column in self.columns_optional:
                 if self.cleaned_data.get(column) != '':
                     columns_to_check[column] = self.cleaned_data.get(column)
+        return columns_to_check
+
+    def validate_row(self, row, row_number):
+        """ Returns a list of the errors for a row of the file, forms override this to check the values in each row """
+        return []
+
+    def validate_field(self, model, field_name, value, column, row_number, row_id):
+        """ Clean the value for a model field, returns the cleaned value and a list of errors """
+        try:
+            return model._meta.get_field(field_name).clean(value, None), []
+        except forms.ValidationError as e:
+            return None, [self.row_error(message, row_number, row_id, column) for message in e.messages]
+
+    def missing_value_errors(self, row, row_number, row_id, columns):
+        """ A row shorter than the header row has no value (not even a blank one) for its last columns """
+        return [self.row_error('The row does not have a value for this column.', row_number, row_id, column) for column in columns if column != '' and row[column] is None]
+
+    def row_error(self, message, row_number, row_id, column=None):
+        row = f'{row_number}{f" (ID {row_id})" if row_id else ""}'
+        if column:
+            return forms.ValidationError(f'The value for the "{column}" column in row {row} produced the following error: {message}')
+        return forms.ValidationError(f'Row {row} in the uploaded file produced the following error: {message}')
+
+    def clean(self):
+        file = self.cleaned_data.get('file')
+        if not file:
+            return super().clean()
+
+        # Check if CSV file
+        if os.path.splitext(file.name)[1].casefold() != '.csv'.casefold():
+            raise forms.ValidationError({'file': 'File must be CSV.'})
+
+        columns_to_check = self.get_columns_to_check()
 
-        # Check that the columns exist in the CSV file
         file.seek(0)
-        csv_data = csv.DictReader(
-            StringIO(file.read().decode('utf-8-sig')), delimiter=',')
-        csv_row = next(csv_data)
-
-        for field_name in columns_to_check:
-            try:
-                csv_row[columns_to_check[field_name]]
-            except KeyError:
+        file_text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+        try:
+            csv_data = csv.DictReader(file_text, delimiter=',')
+            if csv_data.fieldnames is None:
                 raise forms.ValidationError(
-                    {field_name: 'Please enter a valid column name for this file.'})
+                    {'file': 'The uploaded file must have at least one row, other than the header row.'})
+
+            # Check that the columns exist in the CSV file
+            for field_name in columns_to_check:
+                if columns_to_check[field_name] not in csv_data.fieldnames:
+                    raise forms.ValidationError(
+                        {field_name: 'Please enter a valid column name for this file.'})
+
+            # Count and validate the rows, stopping once there are enough errors to report
+            csv_len = 0
+            errors = []
+            for row in csv_data:
+                if all(row[field] == '' for field in row):
+                    continue
+                csv_len = csv_len + 1
+                errors = errors + self.validate_row(row, csv_data.line_num)
+                if len(errors) >= self.max_errors:
+                    errors = errors[:self.max_errors] + [forms.ValidationError(
+                        f'Only the first {self.max_errors} errors in the uploaded file are shown.')]
+                    break
+        except UnicodeDecodeError:
+            raise forms.ValidationError(
+                {'file': 'The uploaded file must be UTF-8 encoded.'})
+        finally:
+            file_text.detach()
+
+        if csv_len == 0:
+            raise forms.ValidationError(
+                {'file': 'The uploaded file must have at least one row, other than the header row.'})
+        if errors != []:
+            raise forms.ValidationError(errors)
 
         return super().clean()
 
@@ -70,6 +123,36 @@ class SplitDateTimeField(forms.SplitDateTimeField):
     widget = SplitDateTimeWidget
 
 
+class TypeaheadWidgetMixin:
+    """
+        Renders only the selected choices, the other choices are loaded from the typeahead url as the user searches
+    """
+    class Media:
+        js = ['scripts/typeahead.js']
+
+    def __init__(self, url, attrs=None):
+        super().__init__(attrs={**(attrs or {}), 'data-typeahead-url': url})
+
+    def optgroups(self, name, value, attrs=None):
+        choices = self.choices
+        # A re-rendered invalid form may have been submitted with values that are not ids
+        selected = [pk for pk in value if str(pk).isdigit()]
+        self.choices = ([('', choices.field.empty_label)] if choices.field.empty_label is not None else []) + \
+            [choices.choice(obj) for obj in choices.queryset.filter(pk__in=selected)]
+        try:
+            return super().optgroups(name, value, attrs)
+        finally:
+            self.choices = choices
+
+
+class TypeaheadSelect(TypeaheadWidgetMixin, forms.Select):
+    pass
+
+
+class TypeaheadSelectMultiple(TypeaheadWidgetMixin, forms.SelectMultiple):
+    pass
+
+
 class UnitKwargMixin:
     def __init__(self, *args, **kwargs):
         self.unit = kwargs.pop('unit', None)
@@ -294,9 +377,13 @@ class StudentForm(UnitKwargMixin, forms.ModelForm):
         fields = ['student_id', 'name']
 
 
+def allocated_project_label(project, group_size):
+    return f'{str(project)}    (Current Group Size = {group_size})'
+
+
 class AllocatedProjectChoiceField(forms.ModelChoiceField):
     def label_from_instance(self, obj):
-        return f'{str(obj)}    (Current Group Size = {obj.allocated_students.count()})'
+        return allocated_project_label(obj, obj.allocated_students.count())
 
 
 class StudentUpdateForm(UnitKwargMixin, forms.ModelForm):
@@ -332,7 +419,15 @@ class StudentAllocatedUpdateForm(StudentUpdateForm):
     def init_fields(self):
         super().init_fields()
         self.fields['allocated_project'] = AllocatedProjectChoiceField(
-            queryset=self.unit.projects.prefetch_related('allocated_students'), required=False, label='Allocated Project')
+            queryset=self.unit.projects.all(), required=False, label='Allocated Project', widget=TypeaheadSelect(
+                reverse('manager:unit_projects_typeahead', kwargs={'pk_unit': self.unit.id}) + '?group_size=1'))
+
+    def save(self, commit=True):
+        with transaction.atomic():
+            student = super().save(commit)
+            if commit and 'allocated_project' in self.changed_data:
+                models.AllocationSummary.allocation_changed(self.unit.id)
+            return student
 
     class Meta(StudentUpdateForm.Meta):
         fields = ['name', 'allocated_project', 'area']
@@ -351,6 +446,7 @@ class StudentListForm(UnitKwargMixin, ListForm):
             css_class='m-3'
         ),
         'list_override',
+        'dry_run',
         FloatingField('student_id_column'),
         FloatingField('student_name_column'),
         FloatingField('area_column'),
@@ -374,60 +470,26 @@ class StudentListForm(UnitKwargMixin, ListForm):
     def init_fields(self):
         self.fields['student_id_column'].initial = 'user_id'
 
-    def clean(self):
-        cleaned = super().clean()
-
-        file = self.cleaned_data.get(
-            'file')
-        file.seek(0)
-        csv_data = csv.DictReader(
-            StringIO(file.read().decode('utf-8-sig')), delimiter=',')
+    def validate_row(self, row, row_number):
         student_id_column = self.cleaned_data.get('student_id_column')
         student_name_column = self.cleaned_data.get('student_name_column')
         area_column = self.cleaned_data.get('area_column')
 
-        errors = []
-
-        for row in csv_data:
-            if not all(row[field] == '' for field in row):
-                student = models.Student()
-                student.student_id = row[student_id_column].strip()
-                student.unit = self.unit
-                if student_name_column != '' and row[student_name_column].strip():
-                    student.name = row[student_name_column].strip()
-                if area_column != '' and row[area_column] and row[area_column].strip() != '':
-                    areas = row[area_column].split(';')
-                    for area in areas:
-                        area = area.strip()
-                        area = models.Area(name=area, unit=self.unit)
-                        try:
-                            area.full_clean(validate_unique=False,
-                                            validate_constraints=False)
-                        except forms.ValidationError as e:
-                            for error in e:
-                                for message in error[1]:
-                                    errors.append(forms.ValidationError(
-                                        f'The value for the "area" column in the row with the ID "{student.student_id}" produced the following error: {message}' if student.student_id != '' else f'The value for the "area" column in a row without an ID produced the following error: {message}'))
-                try:
-                    student.full_clean(validate_unique=False,
-                                       validate_constraints=False)
-                except forms.ValidationError as e:
-                    for error in e:
-                        if type(error) == tuple:
-                            for message in error[1]:
-                                if error[0] == '__all__':
-                                    errors.append(forms.ValidationError(
-                                        f'The row with the ID "{student.student_id}" in the inputted file produced the following error: {message}' if student.student_id != '' else f'A row without an ID in the inputted file produced the following error: {message}'))
-                                else:
-                                    errors.append(forms.ValidationError(
-                                        f'The value for the "{error[0]}" column in the row with the ID "{student.student_id}" produced the following error: {message}' if student.student_id != '' else f'The value for the "{error[0]}" column in a row without an ID produced the following error: {message}'))
-                        else:
-                            errors.append(forms.ValidationError(
-                                f'The row with the ID "{student.student_id}" in the inputted file produced the following error: {error}' if student.student_id != '' else f'A row without an ID in the inputted file produced the following error: {error}'))
-
-        if errors != []:
-            raise forms.ValidationError(errors)
-        return cleaned
+        student_id = row[student_id_column].strip(
+        ) if row[student_id_column] else ''
+        errors = self.validate_field(
+            models.Student, 'student_id', student_id, student_id_column, row_number, student_id)[1]
+        errors = errors + \
+            self.missing_value_errors(
+                row, row_number, student_id, [student_name_column])
+        if student_name_column != '' and row[student_name_column]:
+            errors = errors + self.validate_field(
+                models.Student, 'name', row[student_name_column].strip(), student_name_column, row_number, student_id)[1]
+        if area_column != '' and row[area_column] and row[area_column].strip() != '':
+            for area_name in row[area_column].split(';'):
+                errors = errors + self.validate_field(
+                    models.Area, 'name', area_name.strip(), area_column, row_number, student_id)[1]
+        return errors
 
 
 """
@@ -500,27 +562,25 @@ class ProjectAllocatedUpdateForm(ProjectUpdateForm):
     def init_fields(self):
         super().init_fields()
         self.fields['allocated_students'] = forms.ModelMultipleChoiceField(
-            queryset=models.Student.objects.filter(unit_id=self.instance.unit_id).annotate(is_assigned=ExpressionWrapper(Q(allocated_project_id=self.instance.id), output_field=BooleanField())).order_by('-is_assigned'), initial=self.instance.allocated_students.all(), required=False)
-        self.fields['allocated_students'].widget.attrs['size'] = '10'
+            queryset=models.Student.objects.filter(unit_id=self.instance.unit_id), initial=self.instance.allocated_students.all(), required=False, widget=TypeaheadSelectMultiple(
+                reverse('manager:unit_students_typeahead', kwargs={'pk_unit': self.instance.unit_id}), attrs={'size': '10'}))
 
     def save(self, commit: bool = ...):
-        current_students = self.instance.allocated_students
         new_students = self.cleaned_data.get('allocated_students')
-        if current_students and new_students:
-            for student in current_students.all():
-                if student not in new_students:
-                    student.allocated_project = None
-                    student.allocated_preference_rank = None
-                    student.save()
-        if new_students:
-            for student in new_students.all():
-                student.allocated_project = self.instance
-                allocated_project_pref = student.project_preferences.filter(
-                    project_id=self.instance.id)
-                student.allocated_preference_rank = allocated_project_pref.first(
-                ).rank if allocated_project_pref.exists() else None
-                student.save()
-        return super().save(commit)
+        new_student_ids = [student.id for student in new_students] if new_students else []
+        with transaction.atomic():
+            # Unallocate the students that were removed, and allocate the students that were added with the rank of their preference for the project
+            models.Student.objects.filter(allocated_project=self.instance).exclude(pk__in=new_student_ids).update(
+                allocated_project=None, allocated_preference_rank=None)
+            preference_rank = models.ProjectPreference.objects.filter(
+                student_id=OuterRef('pk'), project_id=self.instance.id).values('rank')[:1]
+            models.Student.objects.filter(pk__in=new_student_ids).exclude(allocated_project=self.instance).update(
+                allocated_project=self.instance, allocated_preference_rank=Subquery(preference_rank))
+            models.Unit.data_changed(self.instance.unit_id)
+            project = super().save(commit)
+            models.AllocationSummary.allocation_changed(
+                self.instance.unit_id)
+            return project
 
 
 class ProjectListForm(UnitKwargMixin, ListForm):
@@ -536,6 +596,7 @@ class ProjectListForm(UnitKwargMixin, ListForm):
             css_class='m-3'
         ),
         'list_override',
+        'dry_run',
         FloatingField('identifier_column'),
         FloatingField('name_column'),
         FloatingField('min_students_column'),
@@ -573,14 +634,7 @@ class ProjectListForm(UnitKwargMixin, ListForm):
                         'min_students_column', 'max_students_column',]
     columns_optional = ['description_column', 'area_column']
 
-    def clean(self):
-        cleaned = super().clean()
-
-        file = self.cleaned_data.get(
-            'file')
-        file.seek(0)
-        csv_data = csv.DictReader(
-            StringIO(file.read().decode('utf-8-sig')), delimiter=',')
+    def validate_row(self, row, row_number):
         identifier_column = self.cleaned_data.get('identifier_column')
         name_column = self.cleaned_data.get('name_column')
         min_students_column = self.cleaned_data.get('min_students_column')
@@ -588,51 +642,30 @@ class ProjectListForm(UnitKwargMixin, ListForm):
         description_column = self.cleaned_data.get('description_column')
         area_column = self.cleaned_data.get('area_column')
 
-        errors = []
-        for row in csv_data:
-            if not all(row[field] == '' for field in row):
-                project = models.Project()
-                project.identifier = row[identifier_column].strip()
-                project.name = row[name_column].strip()
-                project.min_students = row[min_students_column].strip()
-                project.max_students = row[max_students_column].strip()
-                project.unit = self.unit
-                if description_column != '' and row[description_column] != '' and row[description_column] != None:
-                    project.description = row[description_column].strip()
-                if area_column != '' and row[area_column] != None and row[area_column].strip() != '':
-                    areas = row[area_column].split(';')
-                    for area_name in areas:
-                        area_name = area_name.strip()
-                        area = models.Area(name=area_name, unit=self.unit)
-                        try:
-                            area.full_clean(validate_unique=False,
-                                            validate_constraints=False)
-                        except forms.ValidationError as e:
-                            for error in e:
-                                for message in error[1]:
-                                    errors.append(forms.ValidationError(
-                                        f'The value for the "area" column in the row with the ID "{project.identifier}" produced the following error: {message}' if project.identifier != '' else f'The value for the "area" column in a row without an ID produced the following error: {message}'))
-                try:
-                    project.full_clean(validate_unique=False,
-                                       validate_constraints=False)
-                    models.project_min_lte_max_constraint.validate(
-                        models.Project, project)
-                except forms.ValidationError as e:
-                    for error in e:
-                        if type(error) == tuple:
-                            for message in error[1]:
-                                if error[0] == '__all__':
-                                    errors.append(forms.ValidationError(
-                                        f'The row with the Project ID "{project.identifier}" in the uploaded file produced the following error: {message}' if project.identifier != '' else f'A row without an ID in the uploaded file produced the following error: {message}'))
-                                else:
-                                    errors.append(forms.ValidationError(
-                                        f'The value for the "{error[0]}" column in the row with the Project ID "{project.identifier}" produced the following error: {message}' if project.identifier != '' else f'The value for the "{error[0]}" column in a row without an ID produced the following error: {message}'))
-                        else:
-                            errors.append(forms.ValidationError(
-                                f'The row with the Project ID "{project.identifier}" in the uploaded file produced the following error: {error}' if project.identifier != '' else f'A row without an ID in the uploaded file produced the following error: {error}'))
-        if errors != []:
-            raise forms.ValidationError(errors)
-        return cleaned
+        def value(column):
+            return row[column].strip() if row[column] else ''
+
+        identifier = value(identifier_column)
+        errors = self.validate_field(
+            models.Project, 'identifier', identifier, identifier_column, row_number, identifier)[1]
+        errors = errors + self.validate_field(
+            models.Project, 'name', value(name_column), name_column, row_number, identifier)[1]
+        min_students, min_students_errors = self.validate_field(
+            models.Project, 'min_students', value(min_students_column), min_students_column, row_number, identifier)
+        max_students, max_students_errors = self.validate_field(
+            models.Project, 'max_students', value(max_students_column), max_students_column, row_number, identifier)
+        errors = errors + min_students_errors + max_students_errors
+        if min_students is not None and max_students is not None and min_students > max_students:
+            errors.append(self.row_error(
+                models.project_min_lte_max_constraint.get_violation_error_message(), row_number, identifier))
+        if description_column != '' and value(description_column) != '':
+            errors = errors + self.validate_field(
+                models.Project, 'description', value(description_column), description_column, row_number, identifier)[1]
+        if area_column != '' and value(area_column) != '':
+            for area_name in row[area_column].split(';'):
+                errors = errors + self.validate_field(
+                    models.Area, 'name', area_name.strip(), area_column, row_number, identifier)[1]
+        return errors
 
 
 """
@@ -675,13 +708,17 @@ class AreaUpdateForm(AreaForm):
     def init_fields(self):
         super().init_fields()
         self.fields['projects'] = forms.ModelMultipleChoiceField(
-            queryset=self.unit.projects.all(), initial=self.instance.projects.all(), required=False)
+            queryset=self.unit.projects.all(), initial=self.instance.projects.all(), required=False, widget=TypeaheadSelectMultiple(
+                reverse('manager:unit_projects_typeahead', kwargs={'pk_unit': self.unit.id})))
         self.fields['students'] = forms.ModelMultipleChoiceField(
-            queryset=self.unit.students.all(), initial=self.instance.students.all(), required=False)
+            queryset=self.unit.students.all(), initial=self.instance.students.all(), required=False, widget=TypeaheadSelectMultiple(
+                reverse('manager:unit_students_typeahead', kwargs={'pk_unit': self.unit.id})))
 
     def clean(self):
-        self.instance.projects.set(self.cleaned_data.get('projects'))
-        self.instance.students.set(self.cleaned_data.get('students'))
+        if not self.errors:
+            self.instance.projects.set(self.cleaned_data.get('projects'))
+            self.instance.students.set(self.cleaned_data.get('students'))
+            models.Unit.data_changed(self.unit.id)
         return super(forms.ModelForm, self).clean()
 
     class Meta(AreaForm.Meta):
@@ -707,6 +744,7 @@ class PreferenceListForm(UnitKwargMixin, ListForm):
                 f'<a class="small d-flex gap-2 link-offset-4 link-offset-4-hover link-underline link-secondary link-underline-opacity-0 link-underline-opacity-75-hover" href="{static("templates/Preference-List-Template.csv")}"><i class="bi bi-download"></i><span>Preference List Template</span></a>'),
             css_class='m-3'
         ),
+        'dry_run',
         FloatingField('preference_rank_column'),
         FloatingField('student_id_column'),
         FloatingField('project_identifier_column'),
@@ -737,6 +775,26 @@ class PreferenceListForm(UnitKwargMixin, ListForm):
     columns_required = ['preference_rank_column',
                         'student_id_column', 'project_identifier_column']
 
+    def validate_row(self, row, row_number):
+        preference_rank_column = self.cleaned_data.get('preference_rank_column')
+        student_id_column = self.cleaned_data.get('student_id_column')
+        project_identifier_column = self.cleaned_data.get(
+            'project_identifier_column')
+
+        student_id = row[student_id_column].strip(
+        ) if row[student_id_column] else ''
+        errors = self.missing_value_errors(
+            row, row_number, student_id, [student_id_column, project_identifier_column])
+        rank = row[preference_rank_column].strip(
+        ) if row[preference_rank_column] else ''
+        rank, rank_errors = self.validate_field(
+            models.ProjectPreference, 'rank', rank, preference_rank_column, row_number, student_id)
+        errors = errors + rank_errors
+        if rank is not None and rank < 1:
+            errors.append(self.row_error(
+                'The preference rank must be a positive whole number.', row_number, student_id, preference_rank_column))
+        return errors
+
 
 """
 
@@ -0,0 +1,77 @@
+import base64
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from core import models
+from manager import upload
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compare the ORM and PostgreSQL COPY import paths for the student and preference uploads, using a generated unit that is rolled back afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=5000)
+        parser.add_argument('--projects', type=int, default=100)
+        parser.add_argument('--preferences', type=int, default=10,
+                            help='Number of preferences per student.')
+
+    def handle(self, *args, **options):
+        students_csv, preferences_csv = self.generate_files(
+            options['students'], options['projects'], options['preferences'])
+        paths = ['orm', 'copy'] if connection.vendor == 'postgresql' else [
+            'orm']
+        if connection.vendor != 'postgresql':
+            self.stdout.write(
+                'The COPY import path requires PostgreSQL, only the ORM path will be run.')
+        for path in paths:
+            self.stdout.write(
+                f'{path}: {self.run(path, options["projects"], students_csv, preferences_csv)}')
+
+    def generate_files(self, num_students, num_projects, num_preferences):
+        students_csv = 'user_id,name,area\n' + ''.join(
+            f'S{student},Student {student},Area {student % 5}\n' for student in range(num_students))
+        preferences_csv = 'preference_rank,student_id,project_id\n' + ''.join(
+            f'{rank + 1},S{student},{project}\n'
+            for student in range(num_students)
+            for rank, project in enumerate(random.sample(range(num_projects), min(num_preferences, num_projects))))
+        return base64.b64encode(students_csv.encode('utf-8')).decode('utf-8'), base64.b64encode(preferences_csv.encode('utf-8')).decode('utf-8')
+
+    def run(self, path, num_projects, students_csv, preferences_csv):
+        timings = {}
+        try:
+            with transaction.atomic():
+                unit = models.Unit.objects.create(
+                    code='BENCH', name='Upload Benchmark', year='0000', semester='0')
+                models.Project.objects.bulk_create([models.Project(
+                    identifier=str(project), name=f'Project {project}', min_students=0, max_students=999999, unit=unit) for project in range(num_projects)])
+
+                with upload.open_uploaded_file(students_csv) as file:
+                    start = time.perf_counter()
+                    if path == 'copy':
+                        upload.run_copy_import(upload.StudentListCopyImporter(
+                            unit.id, False, 'user_id', 'name', 'area'), file)
+                    else:
+                        upload.run_chunked_import(upload.StudentListImporter(
+                            unit.id, False, 'user_id', 'name', 'area'), file)
+                    timings['students'] = time.perf_counter() - start
+
+                with upload.open_uploaded_file(preferences_csv) as file:
+                    start = time.perf_counter()
+                    if path == 'copy':
+                        upload.run_copy_import(upload.PreferenceListCopyImporter(
+                            unit.id, 'preference_rank', 'student_id', 'project_id'), file)
+                    else:
+                        upload.run_chunked_import(upload.PreferenceListImporter(
+                            unit.id, 'preference_rank', 'student_id', 'project_id'), file)
+                    timings['preferences'] = time.perf_counter() - start
+                raise Rollback
+        except Rollback:
+            pass
+        return ', '.join(f'{name} {seconds:.2f}s' for name, seconds in timings.items())
@@ -0,0 +1,135 @@
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db.models import F, Q
+from django.template.loader import get_template
+from django.utils import timezone
+
+from core import models
+
+
+"""
+
+Emailing students their allocated projects
+
+"""
+
+
+def get_students_to_email(unit_id):
+    """ Allocated students with an email address, who have not already been sent an email about their allocated project """
+    return models.Student.objects.filter(unit_id=unit_id, allocated_project__isnull=False, user__isnull=False).exclude(user__email='').exclude(
+        Q(allocation_email__sent=True) & Q(allocation_email__project_id=F('allocated_project_id'))).select_related('user', 'allocated_project')
+
+
+def get_allocation_email_records(students):
+    """ Get or create the record of the email for each student, records for a different project are reset """
+    records = {record.student_id: record for record in models.AllocationEmail.objects.filter(
+        student__in=[student.id for student in students])}
+    record_create_list = []
+    for student in students:
+        record = records.get(student.id)
+        if not record:
+            record = models.AllocationEmail(student=student)
+            records[student.id] = record
+            record_create_list.append(record)
+        if record.project_id != student.allocated_project_id:
+            record.project_id = student.allocated_project_id
+            record.attempts = 0
+            record.error = ''
+        record.sent = False
+    models.AllocationEmail.objects.bulk_create(record_create_list)
+    return [records[student.id] for student in students]
+
+
+class AllocationEmailRenderer:
+    """
+        Renders the email for each student, the templates are loaded once for all of the students
+    """
+
+    def __init__(self, unit, unit_url):
+        self.unit = unit
+        self.unit_url = unit_url
+        self.text_template = get_template(
+            'manager/allocation_student_email.html')
+        self.html_template = get_template(
+            'manager/allocation_student_email_html.html')
+
+    def render(self, student, connection):
+        context = {'unit': self.unit, 'student': student,
+                   'project': student.allocated_project, 'unit_url': self.unit_url}
+        email = EmailMultiAlternatives(
+            subject=f'{self.unit.name}: Allocated Project',
+            body=self.text_template.render(context),
+            to=[student.user.email],
+            connection=connection
+        )
+        email.attach_alternative(
+            self.html_template.render(context), 'text/html')
+        return email
+
+
+def send_batch(connection, renderer, batch):
+    """
+        Send a batch of emails over the connection and record the result, returns whether the batch was sent.
+        The connection is opened if it is not already open, and closed if the batch fails so that the next batch reconnects.
+        If sending fails part way through a batch, the emails in the batch that were sent before the failure
+        will be sent again when the batch is retried.
+    """
+    try:
+        connection.open()
+        connection.send_messages(
+            [renderer.render(student, connection) for student, record in batch])
+        error = ''
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        # The connection may have been left in a broken state by the error
+        connection.close()
+    for student, record in batch:
+        record.sent = error == ''
+        record.attempts = record.attempts + 1
+        record.error = error
+        record.updated = timezone.now()
+    models.AllocationEmail.objects.bulk_update(
+        [record for student, record in batch], fields=['project', 'sent', 'attempts', 'error', 'updated'])
+    return error == ''
+
+
+def email_students_allocation(unit_id, unit_url):
+    unit = models.Unit.objects.filter(pk=unit_id).first()
+    if not unit.successfully_allocated():
+        return 'The unit has not been allocated'
+
+    students = list(get_students_to_email(unit_id))
+    pending = list(zip(students, get_allocation_email_records(students)))
+    renderer = AllocationEmailRenderer(unit, unit_url)
+    sent_count = 0
+
+    # Reuse a single connection for all of the emails, it is opened by the first batch
+    connection = get_connection()
+    try:
+        for attempt in range(settings.ALLOCATION_EMAIL_MAX_ATTEMPTS):
+            if attempt > 0:
+                # Retry the batches that failed
+                time.sleep(settings.ALLOCATION_EMAIL_BATCH_DELAY)
+            failed = []
+            for start in range(0, len(pending), settings.ALLOCATION_EMAIL_BATCH_SIZE):
+                if start > 0:
+                    # Limit the rate that emails are sent at
+                    time.sleep(settings.ALLOCATION_EMAIL_BATCH_DELAY)
+                batch = pending[start:start +
+                                settings.ALLOCATION_EMAIL_BATCH_SIZE]
+                if send_batch(connection, renderer, batch):
+                    sent_count = sent_count + len(batch)
+                else:
+                    failed = failed + batch
+            pending = failed
+            if not pending:
+                break
+    finally:
+        connection.close()
+
+    result = f'Emailed {sent_count} student{"s" if sent_count != 1 else ""}'
+    if pending:
+        result = result + f', {len(pending)} failed'
+    return result
@@ -0,0 +1,102 @@
+import base64
+import json
+
+from django.db import connections
+from django.db.models import Q
+
+
+"""
+
+Keyset pagination for the manager tables, which seeks past the last row of the previous page
+using the table's ordering, rather than counting and skipping every row before the page
+
+"""
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def get_row_values(row, ordering):
+    values = []
+    for field in ordering:
+        value = row
+        for attribute in field.split('__'):
+            value = getattr(value, attribute)
+        values.append(value)
+    return values
+
+
+def keyset_filter(ordering, values, before=False):
+    """
+        Rows after the values in the ordering, or before them
+    """
+    lookup = 'lt' if before else 'gt'
+    condition = Q()
+    for index, field in enumerate(ordering):
+        condition = condition | Q(**dict(zip(ordering[:index], values[:index])),
+                                  **{f'{field}__{lookup}': values[index]})
+    return condition
+
+
+def approximate_count(queryset):
+    """
+        Number of rows estimated by the PostgreSQL planner, which does not read the rows, or counted on other databases.
+        The estimate is only close for a table's rows without any filters or searches applied
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+class KeysetPage:
+    """
+        A page of rows after (or before) a cursor, the ordering must be unique so that no rows are skipped between pages
+    """
+
+    def __init__(self, queryset, ordering, per_page, after=None, before=None):
+        self.ordering = ordering
+        after = decode_cursor(after)
+        before = decode_cursor(before) if after is None else None
+        if after is not None and len(after) != len(ordering):
+            after = None
+        if before is not None and len(before) != len(ordering):
+            before = None
+
+        if before is not None:
+            # Seek backwards from the cursor, then put the rows back in order
+            rows = list(queryset.filter(keyset_filter(ordering, before, before=True)).order_by(
+                *[f'-{field}' for field in ordering])[:per_page + 1])
+            has_previous = len(rows) > per_page
+            rows = rows[:per_page][::-1]
+            has_next = True
+        else:
+            if after is not None:
+                queryset = queryset.filter(keyset_filter(ordering, after))
+            rows = list(queryset.order_by(*ordering)[:per_page + 1])
+            has_next = len(rows) > per_page
+            rows = rows[:per_page]
+            has_previous = after is not None
+
+        self.rows = rows
+        self.next_cursor = encode_cursor(get_row_values(
+            rows[-1], ordering)) if has_next and rows else None
+        self.previous_cursor = encode_cursor(get_row_values(
+            rows[0], ordering)) if has_previous and rows else None
@@ -17,6 +17,33 @@ class Table(tables.Table):
         }
         empty_text = '—'
 
+    def get_url(self, viewname, unit_id, pk):
+        """
+            URL of an object in a unit, reversed once for each view name rather than for each row
+        """
+        if not hasattr(self, 'url_templates'):
+            self.url_templates = {}
+        if (viewname, unit_id) not in self.url_templates:
+            self.url_templates[viewname, unit_id] = reverse(
+                viewname, kwargs={'pk_unit': unit_id, 'pk': 0}).rsplit('/0/', 1)
+        prefix, suffix = self.url_templates[viewname, unit_id]
+        return f'{prefix}/{pk}/{suffix}'
+
+    def render_area_links(self, record):
+        # Use the areas aggregated in the query, or iterate the prefetched areas, exists() would query each row
+        areas = record.area_links if hasattr(record, 'area_links') else [
+            {'id': area.id, 'name': area.name} for area in record.area.all()]
+        if not areas:
+            return '—'
+        areas_html = ''
+        first = True
+        for area in areas:
+            areas_html = areas_html + ('; ' if not first else '') + \
+                f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{self.get_url('manager:unit_area_detail', record.unit_id, area['id'])}">{area['name']}</a>"""
+            if first:
+                first = False
+        return format_html(f"""{areas_html}""")
+
 
 """
 
@@ -40,24 +67,15 @@ class ProjectsTable(Table):
         row_attrs = {'data-project-id': lambda record: record.pk}
 
     def render_identifier(self, value, record):
-        return format_html(f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{reverse('manager:unit_project_detail', kwargs={'pk_unit': record.unit_id, 'pk': record.id})}">{record.identifier}</a>""")
+        return format_html(f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{self.get_url('manager:unit_project_detail', record.unit_id, record.id)}">{record.identifier}</a>""")
 
     def render_area(self, value, record):
-        if not record.area.exists():
-            return '—'
-        areas_html = ''
-        first = True
-        for area in record.area.all():
-            areas_html = areas_html + ('; ' if not first else '') + \
-                f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{reverse('manager:unit_area_detail',kwargs={'pk_unit':area.unit_id,'pk':area.id})}">{area.name}</a>"""
-            if first:
-                first = False
-        return format_html(f"""{areas_html}""")
+        return self.render_area_links(record)
 
     def render_actions(self, value, record):
         return format_html(f"""<div class="d-flex flex-wrap gap-2 justify-content-end">
-                                <a class="btn btn-primary btn-sm" href="{reverse('manager:unit_project_update', kwargs={'pk_unit': record.unit_id, 'pk': record.id})}">Edit</a>
-                                <a class="btn btn-danger btn-sm" href="{reverse('manager:unit_project_delete', kwargs={'pk_unit': record.unit_id, 'pk': record.id})}">Remove</a>
+                                <a class="btn btn-primary btn-sm" href="{self.get_url('manager:unit_project_update', record.unit_id, record.id)}">Edit</a>
+                                <a class="btn btn-danger btn-sm" href="{self.get_url('manager:unit_project_delete', record.unit_id, record.id)}">Remove</a>
                             </div>
                             """)
 
@@ -126,7 +144,7 @@ class StudentsTable(Table):
     registered = tables.Column(
         accessor='user', empty_values=(), verbose_name='Registered')
     preferences = tables.Column(
-        accessor='project_preferences', empty_values=(), verbose_name='Submitted Preferences')
+        accessor='has_preferences', empty_values=(), verbose_name='Submitted Preferences')
     area = tables.Column(verbose_name='Area', orderable=False, attrs={
                          'td': {'class': 'small'}})
     actions = tables.Column(empty_values=(), orderable=False, verbose_name='')
@@ -139,7 +157,7 @@ class StudentsTable(Table):
         row_attrs = {'data-student-id': lambda record: record.pk}
 
     def render_student_id(self, value, record):
-        return format_html(f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{reverse('manager:unit_student_detail', kwargs={'pk_unit': record.unit_id, 'pk': record.id})}">{record.student_id}</a>""")
+        return format_html(f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{self.get_url('manager:unit_student_detail', record.unit_id, record.id)}">{record.student_id}</a>""")
 
     def render_name(self, value, record):
         return value if value else '—'
@@ -150,27 +168,17 @@ class StudentsTable(Table):
         return format_html(f"""<span class ="badge rounded-pill text-bg-{bg_colour}"><i class="bi bi-{icon_name}-lg"></i></span>""")
 
     def render_preferences(self, value, record):
-        submitted_prefs = record.project_preferences.count()
-        bg_colour = 'success' if submitted_prefs else 'danger'
-        icon_name = 'check' if submitted_prefs else 'x'
+        bg_colour = 'success' if value else 'danger'
+        icon_name = 'check' if value else 'x'
         return format_html(f"""<span class ="badge rounded-pill text-bg-{bg_colour}"><i class="bi bi-{icon_name}-lg"></i></span>""")
 
     def render_area(self, value, record):
-        if not record.area.exists():
-            return '—'
-        areas_html = ''
-        first = True
-        for area in record.area.all():
-            areas_html = areas_html + ('; ' if not first else '') + \
-                f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{reverse('manager:unit_area_detail',kwargs={'pk_unit':area.unit_id,'pk':area.id})}">{area.name}</a>"""
-            if first:
-                first = False
-        return format_html(f"""{areas_html}""")
+        return self.render_area_links(record)
 
     def render_actions(self, value, record):
         return format_html(f"""<div class="d-flex flex-wrap gap-2 justify-content-end">
-                                <a class="btn btn-primary btn-sm" href="{reverse('manager:unit_student_update', kwargs={'pk_unit': record.unit_id, 'pk': record.id})}">Edit</a>
-                                <a class="btn btn-danger btn-sm" href="{reverse('manager:unit_student_delete', kwargs={'pk_unit': record.unit_id, 'pk': record.id})}">Remove</a>
+                                <a class="btn btn-primary btn-sm" href="{self.get_url('manager:unit_student_update', record.unit_id, record.id)}">Edit</a>
+                                <a class="btn btn-danger btn-sm" href="{self.get_url('manager:unit_student_delete', record.unit_id, record.id)}">Remove</a>
                             </div>
                             """)
 
@@ -187,7 +195,7 @@ class StudentsAllocatedTable(StudentsTable):
 
     def render_allocated_project(self, value, record):
         if record.allocated_project:
-            return format_html(f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{reverse('manager:unit_project_detail', kwargs={'pk_unit': record.unit_id, 'pk': record.allocated_project.id})}">{record.allocated_project.identifier}: {record.allocated_project.name}</a>""")
+            return format_html(f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{self.get_url('manager:unit_project_detail', record.unit_id, record.allocated_project_id)}">{record.allocated_project.identifier}: {record.allocated_project.name}</a>""")
         else:
             return 'n/a'
 
@@ -239,7 +247,27 @@ class PreferencesDistributionTable(Table):
         fields = ['identifier']
 
     def render_identifier(self, value, record):
-        return format_html(f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{reverse('manager:unit_project_detail', kwargs={'pk_unit': record.unit_id, 'pk': record.id})}">{record.identifier}</a>""")
+        return format_html(f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{self.get_url('manager:unit_project_detail', record.unit_id, record.id)}">{record.identifier}</a>""")
+
+
+class PreferenceHeatMapColumn(tables.Column):
+    def __init__(self, *args, max_count=0, **kwargs):
+        self.max_count = max_count
+        super().__init__(*args, empty_values=(), **kwargs)
+
+    def render(self, value):
+        # Projects are not given a value for the ranks they were not preferred at
+        value = value if value else 0
+        opacity = round(value / self.max_count, 2) if self.max_count else 0
+        return format_html('<span class="d-block text-center rounded p-1" style="background-color: rgba(var(--bs-primary-rgb), {});">{}</span>', opacity, value)
+
+
+class PreferencesHeatMapTable(Table):
+    identifier = tables.Column(verbose_name='Project ID')
+    name = tables.Column(verbose_name='Project Name')
+
+    def render_identifier(self, value, record):
+        return format_html(f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{self.get_url('manager:unit_project_detail', record['unit_id'], record['id'])}">{value}</a>""")
 
 
 """
@@ -250,8 +278,10 @@ Area table
 
 
 class AreasTable(Table):
-    projects = tables.Column(verbose_name='Has Projects')
-    students = tables.Column(verbose_name='Has Students')
+    projects = tables.Column(accessor='has_projects',
+                             verbose_name='Has Projects')
+    students = tables.Column(accessor='has_students',
+                             verbose_name='Has Students')
     actions = tables.Column(empty_values=(), orderable=False, verbose_name='')
 
     class Meta(Table.Meta):
@@ -259,23 +289,23 @@ class AreasTable(Table):
         fields = ['name', 'projects', 'students']
 
     def render_name(self, value, record):
-        return format_html(f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{reverse('manager:unit_area_detail', kwargs={'pk_unit': record.unit_id, 'pk': record.id})}">{record.name}</a>""")
+        return format_html(f"""<a class="link-offset-2 link-offset-3-hover link-underline link-underline-opacity-0 link-underline-opacity-75-hover" href="{self.get_url('manager:unit_area_detail', record.unit_id, record.id)}">{record.name}</a>""")
 
     def render_actions(self, value, record):
         return format_html(f"""<div class="d-flex flex-wrap gap-2 justify-content-end">
-                                <a class="btn btn-primary btn-sm" href="{reverse('manager:unit_area_update', kwargs={'pk_unit': record.unit_id, 'pk': record.id})}">Edit</a>
-                                <a class="btn btn-danger btn-sm" href="{reverse('manager:unit_area_delete', kwargs={'pk_unit': record.unit_id, 'pk': record.id})}">Remove</a>
+                                <a class="btn btn-primary btn-sm" href="{self.get_url('manager:unit_area_update', record.unit_id, record.id)}">Edit</a>
+                                <a class="btn btn-danger btn-sm" href="{self.get_url('manager:unit_area_delete', record.unit_id, record.id)}">Remove</a>
                             </div>
                             """)
 
     def render_projects(self, value, record):
-        bg_colour = 'success' if record.projects.exists() else 'danger'
-        icon_name = 'check' if record.projects.exists() else 'x'
+        bg_colour = 'success' if value else 'danger'
+        icon_name = 'check' if value else 'x'
         return format_html(f"""<span class ="badge rounded-pill text-bg-{bg_colour}"><i class="bi bi-{icon_name}-lg"></i></span>""")
 
     def render_students(self, value, record):
-        bg_colour = 'success' if record.students.exists() else 'danger'
-        icon_name = 'check' if record.students.exists() else 'x'
+        bg_colour = 'success' if value else 'danger'
+        icon_name = 'check' if value else 'x'
         return format_html(f"""<span class ="badge rounded-pill text-bg-{bg_colour}"><i class="bi bi-{icon_name}-lg"></i></span>""")
 
 
@@ -8,6 +8,7 @@ from django_celery_results.models import TaskResult
 
 from . import allocator
 from . import export
+from . import notify
 from . import upload
 
 
@@ -29,8 +30,13 @@ def create_task_result_on_publish(sender=None, headers=None, body=None, **kwargs
 
 
 @shared_task(name=Unit.START_ALLOCATION_TASK_NAME)
-def start_allocation_task(unit_id, manager_id, results_url):
-    return allocator.start_allocation(unit_id, manager_id, results_url)
+def start_allocation_task(unit_id, manager_id, results_url, students_url=None):
+    result = allocator.start_allocation(unit_id, manager_id, results_url)
+    # Email the students their allocated projects if the manager asked for it when starting the allocation
+    if students_url and Unit.objects.get(pk=unit_id).successfully_allocated():
+        email_students_allocation_task.delay(
+            unit_id=unit_id, unit_url=students_url)
+    return result
 
 
 @shared_task(name=Unit.EMAIL_ALLOCATION_RESULTS_TASK_NAME)
@@ -43,16 +49,34 @@ def email_preferences_csv_task(*args, **kwargs):
     return export.email_preferences_csv(*args, **kwargs)
 
 
-@shared_task(name=Unit.UPLOAD_PROJECTS_TASK_NAME)
-def upload_projects_list_task(*args, **kwargs):
-    return upload.upload_projects_list(*args, **kwargs)
+@shared_task(name=Unit.EMAIL_PROJECT_ROSTERS_TASK_NAME)
+def email_project_rosters_zip_task(*args, **kwargs):
+    return export.email_project_rosters_zip(*args, **kwargs)
 
 
-@shared_task(name=Unit.UPLOAD_STUDENTS_TASK_NAME)
-def upload_students_list_task(*args, **kwargs):
-    return upload.upload_students_list(*args, **kwargs)
+@shared_task(name=Unit.EMAIL_STUDENTS_ALLOCATION_TASK_NAME)
+def email_students_allocation_task(*args, **kwargs):
+    return notify.email_students_allocation(*args, **kwargs)
 
 
-@shared_task(name=Unit.UPLOAD_PREFERENCES_TASK_NAME)
-def upload_preferences_list_task(*args, **kwargs):
-    return upload.upload_preferences_list(*args, **kwargs)
+def upload_progress(task):
+    def report_progress(rows_processed, rows_total):
+        task.update_state(state=Unit.UPLOAD_PROGRESS_STATE, meta={
+                          'rows_processed': rows_processed, 'rows_total': rows_total})
+    return report_progress
+
+
+# Upload tasks are acknowledged late so that they are re-run if the worker is lost, the re-run resumes from the last committed chunk
+@shared_task(bind=True, name=Unit.UPLOAD_PROJECTS_TASK_NAME, acks_late=True, reject_on_worker_lost=True)
+def upload_projects_list_task(self, *args, **kwargs):
+    return upload.upload_projects_list(*args, **kwargs, task_id=self.request.id, progress=upload_progress(self))
+
+
+@shared_task(bind=True, name=Unit.UPLOAD_STUDENTS_TASK_NAME, acks_late=True, reject_on_worker_lost=True)
+def upload_students_list_task(self, *args, **kwargs):
+    return upload.upload_students_list(*args, **kwargs, task_id=self.request.id, progress=upload_progress(self))
+
+
+@shared_task(bind=True, name=Unit.UPLOAD_PREFERENCES_TASK_NAME, acks_late=True, reject_on_worker_lost=True)
+def upload_preferences_list_task(self, *args, **kwargs):
+    return upload.upload_preferences_list(*args, **kwargs, task_id=self.request.id, progress=upload_progress(self))
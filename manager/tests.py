@@ -1,3 +1,1130 @@
-from django.test import TestCase
+import base64
+import gzip
+import io
+import zipfile
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.http import StreamingHttpResponse
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from core import models
+from . import allocator
+from . import export
+from . import forms
+from . import notify
+from . import tasks
+from . import upload
+
+
+class UnitTestCase(TestCase):
+    """
+        Creates units with three projects, students allocated round-robin to the projects and a full set of preferences
+    """
+
+    def setUp(self):
+        # Unit ids may be reused between tests, so exports and preference distributions cached by another test must not be used
+        cache.clear()
+        self.manager = models.User.objects.create(
+            username='manager', email='manager@example.com', is_manager=True)
+
+    def create_unit(self, code, student_count):
+        unit = models.Unit.objects.create(
+            code=code, name=code, year='2024', semester='1', manager=self.manager)
+        projects = models.Project.objects.bulk_create([models.Project(
+            unit=unit, identifier=f'p{i}', name=f'Project {i}', min_students=1, max_students=student_count) for i in range(3)])
+        students = models.Student.objects.bulk_create([models.Student(
+            unit=unit, student_id=f'{code}-s{i}', name=f'Student {i}', allocated_project=projects[i % 3], allocated_preference_rank=1) for i in range(student_count)])
+        models.ProjectPreference.objects.bulk_create([models.ProjectPreference(
+            student=student, project=project, rank=rank + 1) for student in students for rank, project in enumerate(projects)])
+        return unit
+
+
+class ExportTestCase(UnitTestCase):
+    def count_queries(self, download, unit):
+        with CaptureQueriesContext(connection) as queries:
+            response = download(unit.id)
+            content = b''.join(response.streaming_content)
+        return len(queries), content
+
+
+class ExportQueryCountTests(ExportTestCase):
+    """
+        The number of queries made by the exports must not depend on the number of students in the unit
+    """
+
+    def test_allocation_results_export(self):
+        small_count, small_content = self.count_queries(
+            export.download_allocation_results_csv, self.create_unit('SMALL', 3))
+        large_count, large_content = self.count_queries(
+            export.download_allocation_results_csv, self.create_unit('LARGE', 60))
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(large_content.count(b'\r\n'), 61)
+
+    def test_preferences_export(self):
+        small_count, small_content = self.count_queries(
+            export.download_preferences_csv, self.create_unit('SMALL', 3))
+        large_count, large_content = self.count_queries(
+            export.download_preferences_csv, self.create_unit('LARGE', 60))
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(large_content.count(b'\r\n'), 181)
+
+
+class ExportCacheTests(ExportTestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit = models.Unit.objects.create(
+            code='CACHE', name='CACHE', year='2024', semester='1', manager=self.manager)
+        self.project = models.Project.objects.create(
+            unit=self.unit, identifier='p1', name='Project 1', min_students=1, max_students=2)
+        self.student = models.Student.objects.create(
+            unit=self.unit, student_id='s1', name='Student 1')
+
+    def download(self):
+        response = export.download_allocation_results_csv(self.unit.id)
+        return b''.join(response.streaming_content)
+
+    def test_repeat_download_is_cached(self):
+        content = self.download()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.download(), content)
+        # Only the unit is fetched
+        self.assertEqual(len(queries), 1)
+        with export.generate_allocation_results_csv(models.Unit.objects.get(pk=self.unit.id)) as csv_file:
+            self.assertEqual(csv_file.read(), content)
+
+    def test_data_change_invalidates_cache(self):
+        self.download()
+        self.student.allocated_project = self.project
+        self.student.save()
+        self.assertIn(b'"p1_Project 1"', self.download())
+        models.Unit.objects.get(pk=self.unit.id).save()
+        self.unit.students.all().delete()
+        models.Unit.data_changed(self.unit.id)
+        self.assertNotIn(b'"s1"', self.download())
+
+
+class ExportCompressionTests(ExportTestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit = models.Unit.objects.create(
+            code='ZIP', name='ZIP', year='2024', semester='1', manager=self.manager)
+        models.Student.objects.bulk_create([models.Student(
+            unit=self.unit, student_id=f's{i}', name=f'Student {i}') for i in range(100)])
+
+    def test_download_gzip(self):
+        self.client.force_login(self.manager)
+        content = b''.join(export.download_preferences_csv(
+            self.unit.id).streaming_content)
+        for i in range(2):
+            # The first download is generated, the second is read from the cache
+            response = self.client.post(reverse('manager:unit_allocation', kwargs={
+                                        'pk_unit': self.unit.id}), {'download_results': ''}, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertIn(b'"s99","Student 99"', gzip.decompress(
+                b''.join(response.streaming_content)))
+        response = self.client.post(
+            reverse('manager:unit_preferences', kwargs={'pk_unit': self.unit.id}))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(b''.join(response.streaming_content), content)
+
+    @override_settings(EXPORT_ATTACHMENT_ZIP_SIZE=1024)
+    def test_email_attachment_zipped(self):
+        export.email_allocation_results_csv(self.unit.id, self.manager.id)
+        filename, content, mimetype = mail.outbox[0].attachments[0]
+        self.assertEqual(mimetype, 'application/zip')
+        self.assertTrue(filename.endswith('-zip-project-allocation.zip'))
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertIn(b'"s99","Student 99"', archive.read(
+                archive.namelist()[0]))
+
+        export.email_preferences_csv(self.unit.id, self.manager.id)
+        filename, content, mimetype = mail.outbox[1].attachments[0]
+        self.assertEqual(mimetype, 'text/csv')
+
+
+class StreamingExportTests(ExportTestCase):
+    def test_allocation_results_download(self):
+        unit = self.create_unit('STREAM', 2)
+        models.Student.objects.create(
+            unit=unit, student_id='STREAM-s2', name='Student 2')
+        response = export.download_allocation_results_csv(unit.id)
+        self.assertIsInstance(response, StreamingHttpResponse)
+        with CaptureQueriesContext(connection) as queries:
+            # The header row is sent before the students have been read
+            header = next(iter(response.streaming_content))
+            self.assertEqual(len(queries), 0)
+            content = header + b''.join(response.streaming_content)
+        self.assertEqual(content.decode().split('\r\n'), [
+            '"student_id","student_name","project_id","project_name","project","allocated_preference_rank"',
+            '"STREAM-s0","Student 0","p0","Project 0","p0_Project 0","1"',
+            '"STREAM-s1","Student 1","p1","Project 1","p1_Project 1","1"',
+            '"STREAM-s2","Student 2","","",""',
+            '',
+        ])
+        export.email_allocation_results_csv(unit.id, self.manager.id)
+        self.assertEqual(mail.outbox[0].attachments[0][1], content.decode())
+
+    def test_preferences_download(self):
+        unit = self.create_unit('STREAM', 1)
+        response = export.download_preferences_csv(unit.id)
+        self.assertIsInstance(response, StreamingHttpResponse)
+        content = b''.join(response.streaming_content)
+        self.assertEqual(content.decode().split('\r\n'), [
+            '"student_id","student_name","preference_rank","project_id","project_name"',
+            '"STREAM-s0","Student 0","1","p0","Project 0"',
+            '"STREAM-s0","Student 0","2","p1","Project 1"',
+            '"STREAM-s0","Student 0","3","p2","Project 2"',
+            '',
+        ])
+        export.email_preferences_csv(unit.id, self.manager.id)
+        self.assertEqual(mail.outbox[0].attachments[0][1], content.decode())
+
+
+class ProjectRosterExportTests(ExportTestCase):
+    def read_rosters(self, content):
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            return {name: archive.read(name).decode() for name in archive.namelist()}
+
+    def test_project_rosters_zip(self):
+        unit = self.create_unit('ROSTER', 5)
+        models.Project.objects.create(
+            unit=unit, identifier='p3', name='Empty/Project', min_students=1, max_students=2)
+        rosters = self.read_rosters(self.count_queries(
+            export.download_project_rosters_zip, unit)[1])
+        self.assertEqual(list(rosters), [
+            'p0-Project_0.csv', 'p1-Project_1.csv', 'p2-Project_2.csv', 'p3-Empty_Project.csv'])
+        self.assertEqual(rosters['p0-Project_0.csv'].splitlines(), [
+            '"student_id","student_name","student_email","allocated_preference_rank"',
+            '"ROSTER-s0","Student 0","","1"',
+            '"ROSTER-s3","Student 3","","1"',
+        ])
+        self.assertEqual(rosters['p3-Empty_Project.csv'].splitlines(), [
+            '"student_id","student_name","student_email","allocated_preference_rank"'])
+
+    def test_project_rosters_query_count(self):
+        small_count, small_content = self.count_queries(
+            export.download_project_rosters_zip, self.create_unit('SMALL', 3))
+        large_count, large_content = self.count_queries(
+            export.download_project_rosters_zip, self.create_unit('LARGE', 60))
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(sum(roster.count('\r\n') for roster in self.read_rosters(
+            large_content).values()), 63)
+
+
+class UnitCountTests(UnitTestCase):
+    def test_related_counts(self):
+        unit = self.create_unit('COUNT', 20)
+        models.Area.objects.bulk_create([models.Area(
+            unit=unit, name=f'Area {i}') for i in range(4)])
+        empty_unit = models.Unit.objects.create(
+            code='EMPTY', name='EMPTY', year='2024', semester='1', manager=self.manager)
+        units = models.Unit.objects.filter(pk__in=[unit.id, empty_unit.id]).annotate(
+            students_count=models.Unit.related_count(models.Student), projects_count=models.Unit.related_count(models.Project), areas_count=models.Unit.related_count(models.Area))
+        # The counts are independent subqueries, the students, projects and areas are not joined
+        self.assertNotIn('JOIN', str(units.query))
+        self.assertEqual(list(units.order_by('code').values_list('code', 'students_count', 'projects_count', 'areas_count')), [
+            ('COUNT', 20, 3, 4), ('EMPTY', 0, 0, 0)])
+
+
+class ManagerPageQueryCountTests(UnitTestCase):
+    """
+        The number of queries made by the manager pages must not depend on the number of students in the unit
+    """
+
+    def count_page_queries(self, url_name, unit):
+        models.Unit.objects.filter(pk=unit.id).update(
+            allocation_status=models.Unit.OPTIMAL)
+        self.client.force_login(self.manager)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse(url_name, kwargs={'pk_unit': unit.id}))
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_page_query_counts(self):
+        small_unit = self.create_unit('SMALL', 3)
+        large_unit = self.create_unit('LARGE', 60)
+        for url_name in ['manager:unit_students', 'manager:unit_areas', 'manager:unit_projects', 'manager:unit_preferences', 'manager:unit_allocation']:
+            with self.subTest(url_name=url_name):
+                small_count, response = self.count_page_queries(
+                    url_name, small_unit)
+                large_count, response = self.count_page_queries(
+                    url_name, large_unit)
+                self.assertEqual(small_count, large_count)
+
+    def test_allocation_page_info(self):
+        unit = self.create_unit('INFO', 6)
+        models.Student.objects.filter(student_id='INFO-s0').update(
+            allocated_project=None, allocated_preference_rank=None)
+        models.Student.objects.filter(student_id='INFO-s1').update(
+            allocated_preference_rank=3)
+        models.ProjectPreference.objects.filter(
+            student__student_id='INFO-s5').delete()
+        count, response = self.count_page_queries(
+            'manager:unit_allocation', unit)
+        self.assertEqual(response.context['view'].get_page_info()[1:], [
+            {'label': 'Percentage of Students who have Submitted Preferences',
+                'content': '83.3% (5 Students)'},
+            {'label': 'Allocation Status', 'content': 'Successful (Optimal)', 'classes': 'align-items-center',
+             'content_classes': 'rounded bg-success-subtle border border-success-subtle p-1 px-2'},
+            {'label': 'Average Allocated Preference', 'content': 1.4},
+            {'label': 'Best Allocated Preference', 'content': 1},
+            {'label': 'Worst Allocated Preference', 'content': 3},
+            {'label': 'Students Allocated to each Preference', 'content': '1: 4, 3: 1'},
+        ])
+
+
+class AllocationSummaryTests(UnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit = self.create_unit('SUMMARY', 6)
+        models.Unit.objects.filter(pk=self.unit.id).update(
+            allocation_status=models.Unit.OPTIMAL)
+        self.client.force_login(self.manager)
+
+    def get_projects_table(self):
+        response = self.client.get(
+            reverse('manager:unit_projects', kwargs={'pk_unit': self.unit.id}))
+        return [(row.record.identifier, row.record.allocated_students_count, row.record.avg_allocated_pref) for row in response.context['table'].rows]
+
+    def test_allocation(self):
+        models.Student.objects.filter(unit=self.unit).update(
+            allocated_project=None, allocated_preference_rank=None)
+        with mock.patch('manager.allocator.EmailMultiAlternatives'):
+            allocator.start_allocation(
+                self.unit.id, self.manager.id, 'http://testserver/')
+        summary = models.AllocationSummary.objects.get(unit=self.unit)
+        self.assertEqual(summary.data_version, models.Unit.objects.get(
+            pk=self.unit.id).data_version)
+        self.assertEqual(summary.solver_status, models.Unit.OPTIMAL)
+        self.assertEqual(summary.objective_value, 6)
+        self.assertEqual(summary.rank_counts, {'1': 6})
+        self.assertEqual(summary.allocated_students_count, 6)
+
+        # The saved summary is read rather than recalculated
+        with CaptureQueriesContext(connection) as queries:
+            self.get_projects_table()
+        self.assertFalse([query for query in queries.captured_queries if 'allocated_preference_rank' in query['sql']
+                          or 'core_allocationsummary" SET' in query['sql']])
+
+    def test_manual_edit(self):
+        self.assertEqual(self.get_projects_table(), [
+            ('p0', 2, 1.0), ('p1', 2, 1.0), ('p2', 2, 1.0)])
+        student = models.Student.objects.get(student_id='SUMMARY-s0')
+        projects = {project.identifier: project for project in self.unit.projects.all()}
+        self.client.post(reverse('manager:unit_student_update', kwargs={'pk_unit': self.unit.id, 'pk': student.id}), {
+                         'name': student.name, 'allocated_project': projects['p1'].id})
+        summary = models.AllocationSummary.objects.get(unit=self.unit)
+        self.assertEqual((summary.avg_allocated_pref, summary.min_allocated_pref,
+                         summary.max_allocated_pref), (7 / 6, 1, 2))
+        self.assertEqual(summary.rank_counts, {'1': 5, '2': 1})
+        self.assertEqual(self.get_projects_table(), [
+            ('p0', 1, 1.0), ('p1', 3, 4 / 3), ('p2', 2, 1.0)])
+
+        self.client.post(reverse('manager:unit_project_update', kwargs={'pk_unit': self.unit.id, 'pk': projects['p2'].id}), {
+                         'identifier': 'p2', 'name': 'Project 2', 'min_students': 1, 'max_students': 6, 'allocated_students': []})
+        self.assertEqual(self.get_projects_table(), [
+            ('p0', 1, 1.0), ('p1', 3, 4 / 3), ('p2', 0, None)])
+        self.assertEqual(models.AllocationSummary.objects.get(
+            unit=self.unit).allocated_students_count, 4)
+
+    def test_data_change_is_not_recalculated(self):
+        self.get_projects_table()
+        # Other changes to the unit, such as a student submitting preferences, do not recalculate the summary on the next page view
+        models.ProjectPreference.objects.filter(
+            student__student_id='SUMMARY-s0').first().delete()
+        with CaptureQueriesContext(connection) as queries:
+            self.get_projects_table()
+        self.assertFalse([query for query in queries.captured_queries if 'allocated_preference_rank' in query['sql']
+                          or 'core_allocationsummary" SET' in query['sql'] or 'INSERT INTO "core_allocationsummary"' in query['sql']])
+
+
+class StudentsTableTests(UnitTestCase):
+    def create_students(self, code, student_count):
+        unit = self.create_unit(code, student_count)
+        areas = models.Area.objects.bulk_create([models.Area(
+            unit=unit, name=f'Area {i}') for i in range(2)])
+        students = models.Student.objects.filter(unit=unit)
+        models.Student.area.through.objects.bulk_create([models.Student.area.through(
+            student_id=student.id, area_id=areas[i % 2].id) for i, student in enumerate(students)])
+        models.Unit.objects.filter(pk=unit.id).update(
+            allocation_status=models.Unit.OPTIMAL)
+        return unit
+
+    def render_students(self, unit):
+        self.client.force_login(self.manager)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(
+                'manager:unit_students', kwargs={'pk_unit': unit.id}), {'per_page': 2000})
+        return len(queries), response
+
+    def test_rendered_in_constant_queries(self):
+        small_count, response = self.render_students(
+            self.create_students('SMALL', 3))
+        large_count, response = self.render_students(
+            self.create_students('LARGE', 2000))
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(len(response.context['table'].rows), 2000)
+        student = models.Student.objects.get(student_id='LARGE-s1999')
+        for url_name in ['manager:unit_student_detail', 'manager:unit_student_update', 'manager:unit_student_delete']:
+            self.assertContains(response, f'href="{reverse(url_name, kwargs={"pk_unit": student.unit_id, "pk": student.id})}"')
+        self.assertContains(response, f'href="{reverse("manager:unit_project_detail", kwargs={"pk_unit": student.unit_id, "pk": student.allocated_project_id})}"', count=667)
+        area = models.Area.objects.get(unit=student.unit_id, name='Area 1')
+        self.assertContains(response, f'href="{reverse("manager:unit_area_detail", kwargs={"pk_unit": student.unit_id, "pk": area.id})}">Area 1</a>', count=1000)
+
+
+class AreasTableTests(UnitTestCase):
+    def create_areas(self, code, area_count):
+        unit = self.create_unit(code, 4)
+        areas = models.Area.objects.bulk_create([models.Area(
+            unit=unit, name=f'Area {i}') for i in range(area_count)])
+        projects = models.Project.objects.filter(unit=unit)
+        students = models.Student.objects.filter(unit=unit)
+        # Every second area has projects and every third area has students
+        models.Project.area.through.objects.bulk_create([models.Project.area.through(
+            project_id=project.id, area_id=area.id) for area in areas[::2] for project in projects])
+        models.Student.area.through.objects.bulk_create([models.Student.area.through(
+            student_id=student.id, area_id=area.id) for area in areas[::3] for student in students])
+        return unit
+
+    def get_page(self, url_name, unit):
+        self.client.force_login(self.manager)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(
+                url_name, kwargs={'pk_unit': unit.id}), {'per_page': 500})
+        return len(queries), response
+
+    def test_areas_table(self):
+        small_count, response = self.get_page(
+            'manager:unit_areas', self.create_areas('SMALL', 3))
+        large_count, response = self.get_page(
+            'manager:unit_areas', self.create_areas('LARGE', 300))
+        self.assertEqual(small_count, large_count)
+        rows = {row.record.name: (row.record.has_projects, row.record.has_students)
+                for row in response.context['table'].rows}
+        self.assertEqual(len(rows), 300)
+        self.assertEqual(rows['Area 0'], (True, True))
+        self.assertEqual(rows['Area 1'], (False, False))
+        self.assertEqual(rows['Area 2'], (True, False))
+        self.assertEqual(rows['Area 3'], (False, True))
+
+    def test_projects_table_areas(self):
+        small_count, response = self.get_page(
+            'manager:unit_projects', self.create_areas('SMALL', 3))
+        large_count, response = self.get_page(
+            'manager:unit_projects', self.create_areas('LARGE', 300))
+        self.assertEqual(small_count, large_count)
+        self.assertContains(response, '>Area 298</a>', count=3)
+
+
+class PreferenceDistributionTests(UnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit = self.create_unit('DIST', 4)
+        # The last student only prefers the second project
+        models.ProjectPreference.objects.filter(
+            student__student_id='DIST-s3').exclude(rank=2).delete()
+        self.client.force_login(self.manager)
+
+    def get_page(self, url_name, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse(url_name, kwargs={'pk_unit': self.unit.id, **kwargs}))
+        self.assertEqual(response.status_code, 200)
+        return queries, response
+
+    def test_distribution(self):
+        project_ids = list(models.Project.objects.filter(
+            unit=self.unit).order_by('identifier').values_list('id', flat=True))
+        with CaptureQueriesContext(connection) as queries:
+            distribution = models.Unit.objects.get(
+                pk=self.unit.id).get_preference_distribution()
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(distribution, {project_ids[0]: {1: 3}, project_ids[1]: {
+                         2: 4}, project_ids[2]: {3: 3}})
+
+        # The distribution is cached until a preference changes
+        queries, response = self.get_page('manager:unit_preferences_distribution')
+        self.assertFalse(
+            [query for query in queries.captured_queries if '"core_projectpreference"."rank"' in query['sql']])
+        self.assertEqual([(row.record.identifier, row.record.popularity) for row in response.context['table'].rows], [
+            ('p0', 6), ('p1', 4), ('p2', 0)])
+
+        models.ProjectPreference.objects.get(
+            student__student_id='DIST-s0', rank=3).delete()
+        queries, response = self.get_page(
+            'manager:unit_project_detail', pk=project_ids[2])
+        self.assertEqual(list(response.context['tables'][0].data), [
+            {'rank': 3, 'student_count': 2}])
+
+    def test_heat_map(self):
+        queries, response = self.get_page('manager:unit_preferences_heat_map')
+        table = response.context['table']
+        self.assertEqual([column.verbose_name for column in table.columns], [
+            'Project ID', 'Project Name', 'Rank 1', 'Rank 2', 'Rank 3'])
+        self.assertEqual([[row.record.get(column) for column in ['identifier', 'rank_1', 'rank_2', 'rank_3']] for row in table.rows], [
+            ['p0', 3, None, None], ['p1', None, 4, None], ['p2', None, None, 3]])
+        self.assertContains(
+            response, 'style="background-color: rgba(var(--bs-primary-rgb), 0.75);">3</span>', count=2)
+        self.assertContains(
+            response, 'style="background-color: rgba(var(--bs-primary-rgb), 0.0);">0</span>', count=6)
+
+
+class KeysetPaginationTests(UnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit = self.create_unit('PAGE', 20)
+        self.client.force_login(self.manager)
+
+    def get_page(self, url, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'per_page': 7, **params})
+        self.assertFalse([query for query in queries.captured_queries if 'OFFSET' in query['sql']])
+        return response
+
+    def get_preferences(self, response):
+        return [(row.record.student.student_id, row.record.rank) for row in response.context['table'].rows]
+
+    def test_preferences_pages(self):
+        url = reverse('manager:unit_preferences',
+                      kwargs={'pk_unit': self.unit.id})
+        expected = list(models.ProjectPreference.objects.filter(student__unit=self.unit).order_by(
+            'student__student_id', 'rank').values_list('student__student_id', 'rank'))
+        pages = [self.get_page(url)]
+        while pages[-1].context['keyset_pagination']['next_url']:
+            pages.append(self.client.get(
+                url + pages[-1].context['keyset_pagination']['next_url']))
+        self.assertEqual(len(pages), 9)
+        self.assertEqual(sum([self.get_preferences(page) for page in pages], []), expected)
+        # PostgreSQL estimates the count from its planner statistics, other databases count the rows
+        if connection.vendor != 'postgresql':
+            self.assertEqual(pages[0].context['keyset_pagination']['count'], 60)
+        self.assertIsInstance(pages[0].context['keyset_pagination']['count'], int)
+        self.assertIsNone(pages[0].context['keyset_pagination']['previous_url'])
+
+        # Seeking backwards from the last page returns the same pages
+        previous = self.client.get(
+            url + pages[-1].context['keyset_pagination']['previous_url'])
+        self.assertEqual(self.get_preferences(previous), self.get_preferences(pages[-2]))
+
+    def test_filtered_and_sorted(self):
+        url = reverse('manager:unit_students',
+                      kwargs={'pk_unit': self.unit.id})
+        response = self.get_page(url, student_id='PAGE-s1')
+        self.assertEqual([row.record.student_id for row in response.context['table'].rows], [
+            'PAGE-s1', 'PAGE-s10', 'PAGE-s11', 'PAGE-s12', 'PAGE-s13', 'PAGE-s14', 'PAGE-s15'])
+        # Filtered rows are counted rather than estimated, on every database
+        self.assertEqual(response.context['keyset_pagination']['count'], 11)
+        response = self.client.get(
+            url + response.context['keyset_pagination']['next_url'])
+        self.assertEqual([row.record.student_id for row in response.context['table'].rows], [
+            'PAGE-s16', 'PAGE-s17', 'PAGE-s18', 'PAGE-s19'])
+        self.assertIsNone(response.context['keyset_pagination']['next_url'])
+
+        # Sorting by a column uses the table's numbered pages
+        response = self.client.get(url, {'sort': '-name', 'per_page': 7})
+        self.assertNotIn('keyset_pagination', response.context)
+        self.assertEqual(response.context['table'].page.paginator.num_pages, 3)
+
+
+class ExistsFilterTests(UnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit = self.create_unit('FILTER', 6)
+        models.Unit.objects.filter(pk=self.unit.id).update(
+            allocation_status=models.Unit.OPTIMAL)
+        models.Project.objects.create(
+            unit=self.unit, identifier='p3', name='Project 3', min_students=1, max_students=2)
+        models.Area.objects.create(unit=self.unit, name='Empty Area')
+        area = models.Area.objects.create(unit=self.unit, name='Area')
+        area.projects.add(models.Project.objects.get(
+            unit=self.unit, identifier='p0'))
+        # Students without preferences or an allocated project
+        models.ProjectPreference.objects.filter(
+            student__student_id__in=['FILTER-s4', 'FILTER-s5']).delete()
+        models.Student.objects.filter(student_id='FILTER-s5').update(
+            allocated_project=None, allocated_preference_rank=None)
+        self.client.force_login(self.manager)
+
+    def get_rows(self, url_name, accessor, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse(url_name, kwargs={'pk_unit': self.unit.id}), params)
+        self.assertFalse([query for query in queries.captured_queries if 'DISTINCT' in query['sql']])
+        return [getattr(row.record, accessor) for row in response.context['table'].rows]
+
+    def test_students_filters(self):
+        self.assertEqual(self.get_rows('manager:unit_students', 'student_id', preferences='N_EXISTS'), [
+            'FILTER-s4', 'FILTER-s5'])
+        self.assertEqual(self.get_rows('manager:unit_students', 'student_id', preferences='EXISTS', allocated='EXISTS'), [
+            'FILTER-s0', 'FILTER-s1', 'FILTER-s2', 'FILTER-s3'])
+        self.assertEqual(self.get_rows('manager:unit_students', 'student_id', allocated='N_EXISTS'), [
+            'FILTER-s5'])
+        self.assertEqual(len(self.get_rows('manager:unit_students', 'student_id', preferences=['EXISTS', 'N_EXISTS'])), 6)
+
+    def test_projects_filters(self):
+        self.assertEqual(self.get_rows('manager:unit_projects', 'identifier', allocated='N_EXISTS'), [
+            'p3'])
+        self.assertEqual(self.get_rows('manager:unit_projects', 'identifier', num_allocated=2), [
+            'p0', 'p1'])
+        self.assertEqual(self.get_rows('manager:unit_projects', 'identifier', num_allocated=0), [
+            'p3'])
+
+    def test_areas_filters(self):
+        self.assertEqual(self.get_rows('manager:unit_areas', 'name', has_projects='EXISTS'), [
+            'Area'])
+        self.assertEqual(self.get_rows('manager:unit_areas', 'name', has_students='N_EXISTS'), [
+            'Area', 'Empty Area'])
+
+
+class SearchFilterTests(UnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit = self.create_unit('SEARCH', 12)
+        models.Project.objects.create(
+            unit=self.unit, identifier='A7', name='Robotics', min_students=1, max_students=2)
+        self.client.force_login(self.manager)
+
+    def get_rows(self, url_name, accessor, **params):
+        response = self.client.get(
+            reverse(url_name, kwargs={'pk_unit': self.unit.id}), params)
+        return [getattr(row.record, accessor) for row in response.context['table'].rows]
+
+    def test_substring_search(self):
+        self.assertEqual(self.get_rows('manager:unit_students', 'student_id', name=' student 1'), [
+            'SEARCH-s1', 'SEARCH-s10', 'SEARCH-s11'])
+        self.assertEqual(self.get_rows('manager:unit_projects', 'identifier', identifier='a'), [
+            'A7'])
+        self.assertEqual(self.get_rows('manager:unit_projects', 'identifier', name='OBOT'), [
+            'A7'])
+        self.assertEqual(len(self.get_rows('manager:unit_preferences', 'rank', student__student_id='s1', per_page=100)), 9)
+
+    def has_trigram_index(self, name):
+        if connection.vendor != 'postgresql':
+            return False
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', [name])
+            return cursor.fetchone() is not None
+
+    def test_trigram_index(self):
+        if not self.has_trigram_index('core_student_name_trgm'):
+            self.skipTest('Trigram indexes are only created on PostgreSQL with the pg_trgm extension')
+        queryset = models.Student.objects.filter(name__icontains='dent 1')
+        with connection.cursor() as cursor:
+            # The table is too small for the planner to choose the index unless scanning it is ruled out
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+        self.assertIn('core_student_name_trgm', plan)
+
+
+class TypeaheadTests(UnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit = self.create_unit('TYPE', 30)
+        models.Unit.objects.filter(pk=self.unit.id).update(
+            allocation_status=models.Unit.OPTIMAL)
+        self.client.force_login(self.manager)
+
+    def get_results(self, url_name, **params):
+        return self.client.get(reverse(url_name, kwargs={'pk_unit': self.unit.id}), params).json()
+
+    def test_students_pages(self):
+        first = self.get_results('manager:unit_students_typeahead')
+        self.assertEqual(len(first['results']), 20)
+        second = self.get_results(
+            'manager:unit_students_typeahead', after=first['next'])
+        self.assertEqual(len(second['results']), 10)
+        self.assertIsNone(second['next'])
+        self.assertEqual(sorted(result['text'] for result in first['results'] + second['results']), sorted(
+            models.Student.objects.filter(unit=self.unit).values_list('student_id', flat=True)))
+
+        search = self.get_results('manager:unit_students_typeahead', q='s2')
+        self.assertEqual([result['text'] for result in search['results']], [
+            'TYPE-s2'] + [f'TYPE-s2{i}' for i in range(10)])
+
+    def test_projects_group_size(self):
+        results = self.get_results(
+            'manager:unit_projects_typeahead', q='p1', group_size=1)['results']
+        self.assertEqual([result['text'] for result in results], [
+            'p1: Project 1    (Current Group Size = 10)'])
+
+    def test_other_manager(self):
+        other = models.User.objects.create(
+            username='other', email='other@example.com', is_manager=True)
+        self.client.force_login(other)
+        response = self.client.get(
+            reverse('manager:unit_students_typeahead', kwargs={'pk_unit': self.unit.id}))
+        self.assertEqual(response.status_code, 403)
+
+    def test_edit_pages_render_selected_choices(self):
+        area = models.Area.objects.create(unit=self.unit, name='Area')
+        area.students.add(*models.Student.objects.filter(
+            student_id__in=['TYPE-s1', 'TYPE-s2']))
+        url = reverse('manager:unit_area_update', kwargs={
+                      'pk_unit': self.unit.id, 'pk': area.id})
+        response = self.client.get(url)
+        self.assertContains(response, 'data-typeahead-url', count=2)
+        self.assertContains(response, '<option', count=2)
+        self.assertContains(response, 'selected>TYPE-s1</option>')
+
+        students = models.Student.objects.filter(
+            student_id__in=['TYPE-s3', 'TYPE-s29'])
+        self.client.post(url, {'name': 'Area', 'students': [
+                         student.id for student in students]})
+        self.assertEqual(sorted(area.students.values_list(
+            'student_id', flat=True)), ['TYPE-s29', 'TYPE-s3'])
+
+        project = models.Project.objects.get(unit=self.unit, identifier='p0')
+        response = self.client.get(reverse('manager:unit_project_update', kwargs={
+                                   'pk_unit': self.unit.id, 'pk': project.id}))
+        self.assertContains(response, 'selected>TYPE-s', count=10)
+
+        student = models.Student.objects.get(unit=self.unit, student_id='TYPE-s0')
+        response = self.client.get(reverse('manager:unit_student_update', kwargs={
+                                   'pk_unit': self.unit.id, 'pk': student.id}))
+        # The empty choice and the allocated project, as well as the unit's area
+        self.assertContains(response, '<option', count=3)
+        self.assertContains(
+            response, 'selected>p0: Project 0    (Current Group Size = 10)</option>')
+
+    def test_invalid_choice_rerendered(self):
+        area = models.Area.objects.create(unit=self.unit, name='Area')
+        response = self.client.post(reverse('manager:unit_area_update', kwargs={
+                                    'pk_unit': self.unit.id, 'pk': area.id}), {'name': 'Area', 'students': ['abc']})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].errors['students'])
+
+        student = models.Student.objects.get(unit=self.unit, student_id='TYPE-s0')
+        response = self.client.post(reverse('manager:unit_student_update', kwargs={
+                                    'pk_unit': self.unit.id, 'pk': student.id}), {'name': student.name, 'allocated_project': 'abc'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(
+            response.context['form'].errors['allocated_project'])
+
+
+class ProjectReassignmentTests(UnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit = self.create_unit('MOVE', 90)
+        models.Unit.objects.filter(pk=self.unit.id).update(
+            allocation_status=models.Unit.OPTIMAL)
+        # An allocated unit has a saved allocation summary
+        models.AllocationSummary.allocation_changed(self.unit.id)
+        self.project = models.Project.objects.get(
+            unit=self.unit, identifier='p0')
+        self.client.force_login(self.manager)
+
+    def reassign(self, students):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('manager:unit_project_update', kwargs={'pk_unit': self.unit.id, 'pk': self.project.id}), {
+                'identifier': 'p0', 'name': 'Project 0', 'min_students': 1, 'max_students': 90, 'allocated_students': [student.id for student in students]})
+        self.assertEqual(response.status_code, 302)
+        return len(queries)
+
+    def test_reassignment(self):
+        students = list(models.Student.objects.filter(
+            unit=self.unit).order_by('id'))
+        # Keep half of the project's students and move in five students from the other projects
+        small_count = self.reassign(students[0:30:6] + students[1:15:3])
+        self.assertEqual(self.project.allocated_students.count(), 10)
+        # Move in fifty students
+        large_count = self.reassign(students[1:75:3] + students[2:75:3])
+        self.assertEqual(small_count, large_count)
+
+        allocated = models.Student.objects.filter(allocated_project=self.project)
+        self.assertEqual(allocated.count(), 50)
+        self.assertFalse(allocated.exclude(allocated_preference_rank=1).exists())
+        # Every student first allocated to the project has been removed from it
+        unallocated = models.Student.objects.filter(
+            unit=self.unit, allocated_project__isnull=True)
+        self.assertEqual(set(unallocated), set(students[0::3]))
+        self.assertFalse(unallocated.exclude(allocated_preference_rank=None).exists())
+
+
+class ProjectDeleteTests(UnitTestCase):
+    def delete_project(self, unit, identifier):
+        project = models.Project.objects.get(unit=unit, identifier=identifier)
+        self.client.force_login(self.manager)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('manager:unit_project_delete', kwargs={
+                                        'pk_unit': unit.id, 'pk': project.id}))
+        self.assertEqual(response.status_code, 302)
+        return len(queries)
+
+    def get_preferences(self, unit):
+        return list(models.ProjectPreference.objects.filter(student__unit=unit).order_by(
+            'student__student_id', 'rank').values_list('student__student_id', 'rank', 'project__identifier'))
+
+    def test_ranks_compacted(self):
+        small_count = self.delete_project(
+            self.create_unit('SMALL', 3), 'p1')
+        unit = self.create_unit('LARGE', 60)
+        # A student who did not prefer the project, and a student who ranked it last
+        models.ProjectPreference.objects.filter(
+            student__student_id='LARGE-s0', project__identifier='p0').delete()
+        models.ProjectPreference.objects.filter(student__student_id='LARGE-s1').delete()
+        student = models.Student.objects.get(student_id='LARGE-s1')
+        models.ProjectPreference.objects.bulk_create([models.ProjectPreference(student=student, project=project, rank=rank + 1)
+                                                      for rank, project in enumerate(models.Project.objects.filter(unit=unit).order_by('-identifier'))])
+        large_count = self.delete_project(unit, 'p0')
+        self.assertEqual(small_count, large_count)
+
+        preferences = self.get_preferences(unit)
+        self.assertEqual(len(preferences), 120)
+        self.assertEqual(preferences[:5], [
+            ('LARGE-s0', 2, 'p1'), ('LARGE-s0', 3, 'p2'), ('LARGE-s1', 1, 'p2'), ('LARGE-s1', 2, 'p1'), ('LARGE-s10', 1, 'p1')])
+        self.assertEqual(
+            {rank for student_id, rank, identifier in preferences if identifier == 'p2'}, {1, 2, 3})
+
+        # Allocated ranks follow the renumbered preferences
+        allocations = dict((student_id, (identifier, rank)) for student_id, identifier, rank in models.Student.objects.filter(
+            unit=unit).values_list('student_id', 'allocated_project__identifier', 'allocated_preference_rank'))
+        self.assertEqual(allocations['LARGE-s0'], (None, None))
+        self.assertEqual(allocations['LARGE-s1'], ('p1', 2))
+        self.assertEqual(allocations['LARGE-s2'], ('p2', 2))
+        self.assertEqual(allocations['LARGE-s4'], ('p1', 1))
+
+
+@override_settings(ALLOCATION_EMAIL_BATCH_SIZE=2, ALLOCATION_EMAIL_BATCH_DELAY=0)
+class AllocationEmailTests(TestCase):
+    def setUp(self):
+        self.manager = models.User.objects.create(
+            username='manager', email='manager@example.com', is_manager=True)
+        self.unit = models.Unit.objects.create(
+            code='EMAIL', name='EMAIL', year='2024', semester='1', manager=self.manager, allocation_status=models.Unit.OPTIMAL)
+        self.projects = models.Project.objects.bulk_create([models.Project(
+            unit=self.unit, identifier=f'p{i}', name=f'Project {i}', min_students=1, max_students=5) for i in range(2)])
+        users = [models.User.objects.create(
+            username=f's{i}', email=f's{i}@example.com', is_student=True) for i in range(6)]
+        models.Student.objects.bulk_create([models.Student(
+            unit=self.unit, student_id=f's{i}', user=users[i], allocated_project=self.projects[i % 2]) for i in range(5)] + [
+            # Students who are not allocated or not registered are not emailed
+            models.Student(unit=self.unit, student_id='s5', user=users[5]),
+            models.Student(unit=self.unit, student_id='unregistered', allocated_project=self.projects[0])
+        ])
+
+    def test_email_students(self):
+        self.assertEqual(notify.email_students_allocation(
+            self.unit.id, 'http://testserver/units/1/'), 'Emailed 5 students')
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(mail.outbox[0].to, ['s0@example.com'])
+        self.assertIn('"p0: Project 0"', mail.outbox[0].body)
+
+        # Students are only emailed again if their allocated project changes
+        self.assertEqual(notify.email_students_allocation(
+            self.unit.id, 'http://testserver/units/1/'), 'Emailed 0 students')
+        models.Student.objects.filter(student_id='s0').update(
+            allocated_project=self.projects[1])
+        self.assertEqual(notify.email_students_allocation(
+            self.unit.id, 'http://testserver/units/1/'), 'Emailed 1 student')
+        self.assertIn('"p1: Project 1"', mail.outbox[5].body)
+
+    def test_emailed_after_allocation(self):
+        with mock.patch('manager.allocator.start_allocation') as start_allocation, mock.patch('manager.tasks.email_students_allocation_task.delay') as delay:
+            tasks.start_allocation_task(
+                self.unit.id, self.manager.id, 'http://testserver/results/')
+            self.assertFalse(delay.called)
+            tasks.start_allocation_task(self.unit.id, self.manager.id, 'http://testserver/results/',
+                                        students_url='http://testserver/units/1/')
+            delay.assert_called_once_with(
+                unit_id=self.unit.id, unit_url='http://testserver/units/1/')
+
+            # Students are not emailed if the allocation failed
+            models.Unit.objects.filter(pk=self.unit.id).update(
+                allocation_status=None)
+            tasks.start_allocation_task(self.unit.id, self.manager.id, 'http://testserver/results/',
+                                        students_url='http://testserver/units/1/')
+            self.assertEqual(delay.call_count, 1)
+        self.assertEqual(start_allocation.call_count, 3)
+
+    def test_failed_batch_is_retried(self):
+        send_messages = mail.get_connection().__class__.send_messages
+        calls = []
+
+        def fail_first_batch(connection, messages):
+            calls.append(len(messages))
+            if len(calls) == 1:
+                raise ConnectionError('Connection lost')
+            return send_messages(connection, messages)
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', fail_first_batch):
+            self.assertEqual(notify.email_students_allocation(
+                self.unit.id, 'http://testserver/units/1/'), 'Emailed 5 students')
+        self.assertEqual(calls, [2, 2, 1, 2])
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(models.AllocationEmail.objects.filter(
+            sent=True, attempts=2).count(), 2)
+
+        with override_settings(ALLOCATION_EMAIL_MAX_ATTEMPTS=2), mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=ConnectionError('Connection lost')):
+            models.AllocationEmail.objects.all().delete()
+            self.assertEqual(notify.email_students_allocation(
+                self.unit.id, 'http://testserver/units/1/'), 'Emailed 0 students, 5 failed')
+        self.assertEqual(list(models.AllocationEmail.objects.values_list(
+            'sent', 'attempts', 'error').distinct()), [(False, 2, 'Connection lost')])
+
+    def test_connection_failure_is_recorded(self):
+        open_calls = []
+
+        def fail_to_reconnect(connection):
+            open_calls.append(connection)
+            if len(open_calls) > 1:
+                raise ConnectionRefusedError('SMTP server unavailable')
+
+        # The first batch loses the connection, then every reconnection is refused
+        with override_settings(ALLOCATION_EMAIL_MAX_ATTEMPTS=2), mock.patch('django.core.mail.backends.locmem.EmailBackend.open', fail_to_reconnect), mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=ConnectionError('Connection lost')):
+            self.assertEqual(notify.email_students_allocation(
+                self.unit.id, 'http://testserver/units/1/'), 'Emailed 0 students, 5 failed')
+        self.assertEqual(list(models.AllocationEmail.objects.order_by('student__student_id').values_list('sent', 'attempts', 'error')), [
+                         (False, 2, 'SMTP server unavailable')] * 5)
+
+
+class UploadTestCase(TestCase):
+    def setUp(self):
+        self.manager = models.User.objects.create(
+            username='manager', email='manager@example.com', is_manager=True)
+        self.unit = self.create_unit('UPLOAD')
+
+    def create_unit(self, code):
+        unit = models.Unit.objects.create(
+            code=code, name=code, year='2024', semester='1', manager=self.manager)
+        projects = models.Project.objects.bulk_create([models.Project(
+            unit=unit, identifier=f'p{i}', name=f'Project {i}', min_students=1, max_students=2) for i in range(2)])
+        students = models.Student.objects.bulk_create([models.Student(
+            unit=unit, student_id=f's{i}', name=f'Student {i}') for i in range(2)])
+        models.ProjectPreference.objects.bulk_create([models.ProjectPreference(
+            student=student, project=project, rank=rank + 1) for student in students for rank, project in enumerate(projects)])
+        return unit
+
+    def get_unit_data(self, unit=None):
+        unit = unit if unit else self.unit
+        return (list(unit.projects.order_by('identifier').values_list('identifier', 'name', 'min_students', 'max_students')),
+                list(unit.students.order_by('student_id').values_list(
+                    'student_id', 'name', 'user_id')),
+                list(models.Student.area.through.objects.filter(student__unit=unit).order_by(
+                    'student__student_id', 'area__name').values_list('student__student_id', 'area__name')),
+                list(models.ProjectPreference.objects.filter(student__unit=unit).order_by('student__student_id', 'rank').values_list('student__student_id', 'project__identifier', 'rank')))
+
+    def csv_file(self, rows):
+        return SimpleUploadedFile('list.csv', ''.join(f'{row}\r\n' for row in rows).encode('utf-8'), content_type='text/csv')
+
+    def get_form(self, form_class, rows, **data):
+        return form_class(data, {'file': self.csv_file(rows)}, unit=self.unit)
+
+
+class ListFormValidationTests(UploadTestCase):
+    def test_preference_ranks(self):
+        form = self.get_form(forms.PreferenceListForm, ['student_id,project_id,preference_rank', 's0,p0,1', 's0,p1,abc', 's1,p0,', 's1,p1,0', 's2,p0,-2', 's2,p1'],
+                             preference_rank_column='preference_rank', student_id_column='student_id', project_identifier_column='project_id')
+        self.assertFalse(form.is_valid())
+        errors = form.non_field_errors()
+        self.assertEqual(len(errors), 5)
+        self.assertIn('row 3 (ID s0)', errors[0])
+        self.assertIn('"preference_rank" column', errors[0])
+        self.assertIn('row 5 (ID s1)', errors[2])
+        self.assertIn('positive whole number', errors[2])
+        self.assertIn('row 7 (ID s2)', errors[4])
+
+        form = self.get_form(forms.PreferenceListForm, ['student_id,project_id,preference_rank', 's0,p0,1', 's0,p1,2'],
+                             preference_rank_column='preference_rank', student_id_column='student_id', project_identifier_column='project_id')
+        self.assertTrue(form.is_valid())
+
+    def test_short_student_rows(self):
+        form = self.get_form(forms.StudentListForm, ['user_id,name', 's0,Student 0', 's1', 's2,'],
+                             student_id_column='user_id', student_name_column='name', area_column='')
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.non_field_errors(), [
+                         'The value for the "name" column in row 3 (ID s1) produced the following error: The row does not have a value for this column.'])
+
+    def test_max_errors(self):
+        form = self.get_form(forms.StudentListForm, ['user_id'] + [''.ljust(20, 'x') for i in range(30)],
+                             student_id_column='user_id', student_name_column='', area_column='')
+        self.assertFalse(form.is_valid())
+        errors = form.non_field_errors()
+        self.assertEqual(len(errors), forms.ListForm.max_errors + 1)
+        self.assertIn('row 21 ', errors[forms.ListForm.max_errors - 1])
+        self.assertEqual(errors[-1], 'Only the first 20 errors in the uploaded file are shown.')
+
+
+class UploadPreviewTests(UploadTestCase):
+    def test_invalid_rows_are_reported(self):
+        unit_data = self.get_unit_data()
+        preview = upload.preview_preferences_list(self.unit.id, self.csv_file(['student_id,project_id,preference_rank', 's0,p1,1', 's0,p0,abc', 's1']),
+                                                  preference_rank_column='preference_rank', student_id_column='student_id', project_identifier_column='project_id')
+        self.assertEqual(preview.counts['update'], 1)
+        self.assertEqual(preview.counts['error'], 2)
+        self.assertEqual(preview.samples['error'], ['s0, p0, abc', 's1'])
+
+        preview = upload.preview_students_list(self.unit.id, self.csv_file(['user_id,name', 's0,Student 0', 's2']),
+                                               override_list=True, student_id_column='user_id', student_name_column='name', area_column='')
+        self.assertEqual(preview.counts['unchanged'], 1)
+        self.assertEqual(preview.counts['delete'], 1)
+        self.assertEqual(preview.samples['error'], ['s2'])
+        self.assertEqual(self.get_unit_data(), unit_data)
+
+    def test_dry_run_changes_nothing(self):
+        self.client.force_login(self.manager)
+        unit_data = self.get_unit_data()
+        data_version = models.Unit.objects.get(pk=self.unit.id).data_version
+        response = self.client.post(reverse('manager:unit_students_new_list', kwargs={'pk_unit': self.unit.id}), {
+            'file': self.csv_file(['user_id,name', 's0,Renamed', 's2,Student 2']), 'student_id_column': 'user_id', 'student_name_column': 'name', 'area_column': '', 'list_override': 'on', 'dry_run': 'on'})
+        self.assertEqual(response.status_code, 200)
+        upload_preview = response.context['upload_preview']
+        self.assertEqual(upload_preview.counts['create'], 1)
+        self.assertEqual(upload_preview.counts['update'], 1)
+        self.assertEqual(upload_preview.counts['delete'], 1)
+        self.assertEqual(self.get_unit_data(), unit_data)
+        self.assertEqual(models.Unit.objects.get(
+            pk=self.unit.id).data_version, data_version)
+        self.assertFalse(models.ListUpload.objects.exists())
+
+
+class ChunkedImportTests(UploadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.file = io.StringIO(
+            '\r\n'.join(['user_id,name'] + [f'n{i},New {i}' for i in range(5)]))
+
+    def get_importer(self):
+        return upload.StudentListImporter(self.unit.id, False, 'user_id', 'name', '')
+
+    def test_progress(self):
+        progress = mock.Mock()
+        upload.run_chunked_import(self.get_importer(), self.file,
+                                  task_id='task', progress=progress, chunk_size=2)
+        self.assertEqual(progress.call_args_list, [
+                         mock.call(2, 5), mock.call(4, 5), mock.call(5, 5)])
+        list_upload = models.ListUpload.objects.get(task_id='task')
+        self.assertEqual(list_upload.rows_total, 5)
+        self.assertEqual(list_upload.rows_committed, 5)
+        self.assertTrue(list_upload.completed)
+        self.assertEqual(self.unit.students.count(), 7)
+
+    def test_resume_after_failure(self):
+        importer = self.get_importer()
+        import_chunk = importer.import_chunk
+
+        def fail_after_first_chunk(rows):
+            if importer.import_chunk.call_count > 1:
+                raise RuntimeError('Worker lost')
+            import_chunk(rows)
+
+        with mock.patch.object(importer, 'import_chunk', side_effect=fail_after_first_chunk):
+            with self.assertRaises(RuntimeError):
+                upload.run_chunked_import(
+                    importer, self.file, task_id='task', chunk_size=2)
+        self.assertEqual(models.ListUpload.objects.get(
+            task_id='task').rows_committed, 2)
+        self.assertEqual(set(self.unit.students.filter(
+            student_id__startswith='n').values_list('student_id', flat=True)), {'n0', 'n1'})
+
+        # The re-run task only writes the rows after the committed chunk
+        importer = self.get_importer()
+        progress = mock.Mock()
+        with mock.patch.object(importer, 'import_chunk', wraps=importer.import_chunk) as import_chunk:
+            upload.run_chunked_import(
+                importer, self.file, task_id='task', progress=progress, chunk_size=2)
+        self.assertEqual([[row['user_id'] for row in call.args[0]] for call in import_chunk.call_args_list], [
+                         ['n2', 'n3'], ['n4']])
+        self.assertEqual(progress.call_args_list, [
+                         mock.call(4, 5), mock.call(5, 5)])
+        self.assertEqual(sorted(self.unit.students.filter(student_id__startswith='n').values_list(
+            'student_id', flat=True)), ['n0', 'n1', 'n2', 'n3', 'n4'])
+        self.assertTrue(models.ListUpload.objects.get(
+            task_id='task').completed)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'COPY imports are only used with PostgreSQL')
+class CopyImportTests(UploadTestCase):
+    def encode_file(self, rows):
+        return base64.b64encode(''.join(f'{row}\r\n' for row in rows).encode('utf-8')).decode('utf-8')
+
+    def upload_lists(self, unit):
+        upload.upload_students_list(unit.id, self.manager.id, self.encode_file(['user_id,name,area', 's0,Renamed,Web', 's0,Duplicate,', 's2,Student 2,Web;Data']),
+                                    override_list=True, student_id_column='user_id', student_name_column='name', area_column='area')
+        upload.upload_preferences_list(unit.id, self.manager.id, self.encode_file(['student_id,project_id,preference_rank', 's0,p1,1', 's0,p0,2', 's2,p0,1', 's2,p1,1', 'x9,p0,1', 's0,p9,3']),
+                                       preference_rank_column='preference_rank', student_id_column='student_id', project_identifier_column='project_id')
+
+    def test_copy_and_orm_imports_match(self):
+        models.User.objects.create(username='s2', email='s2@example.com')
+        copy_unit = self.create_unit('COPY')
+        with override_settings(UPLOAD_USE_COPY=False):
+            self.upload_lists(self.unit)
+        with override_settings(UPLOAD_USE_COPY=True):
+            self.upload_lists(copy_unit)
+        unit_data = self.get_unit_data()
+        self.assertEqual(unit_data[1], [('s0', 'Renamed', None), ('s2', 'Student 2',
+                         models.User.objects.get(username='s2').id)])
+        self.assertEqual(unit_data[3], [('s0', 'p1', 1), ('s0', 'p0', 2), ('s2', 'p0', 1)])
+        self.assertEqual(self.get_unit_data(copy_unit), unit_data)
+
+
+class DuplicateUploadTests(UploadTestCase):
+    def post_students_list(self, rows=['user_id,name', 's0,Renamed', 's2,Student 2'], area_column=''):
+        return self.client.post(reverse('manager:unit_students_new_list', kwargs={'pk_unit': self.unit.id}), {
+            'file': self.csv_file(rows), 'student_id_column': 'user_id', 'student_name_column': 'name', 'area_column': area_column})
+
+    def run_upload(self, **kwargs):
+        # Run the upload task synchronously with a task id, as the worker would
+        upload.upload_students_list(task_id=f'task-{self.delay.call_count}', **kwargs)
+        return mock.Mock(id=f'task-{self.delay.call_count}')
+
+    def test_duplicate_upload_is_skipped(self):
+        self.client.force_login(self.manager)
+        with mock.patch('manager.tasks.upload_students_list_task.delay', side_effect=self.run_upload) as self.delay:
+            self.post_students_list()
+            self.assertEqual(self.delay.call_count, 1)
+            self.assertEqual(self.unit.students.count(), 3)
+
+            # The unit has not changed since the same file was uploaded
+            response = self.post_students_list()
+            self.assertEqual(self.delay.call_count, 1)
+            self.assertContains(
+                response, 'This list has already been uploaded')
+
+            # The check compares the unit's data version, rather than reading the unit's students
+            fingerprint = models.ListUpload.objects.get().fingerprint
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(upload.is_duplicate_upload(
+                    self.unit.id, models.Unit.UPLOAD_STUDENTS_TASK_NAME, fingerprint))
+            self.assertEqual(len(queries), 2)
+
+            # Once the unit has changed the file is uploaded again
+            student = self.unit.students.get(student_id='s0')
+            student.name = 'Changed'
+            student.save()
+            response = self.post_students_list()
+            self.assertEqual(self.delay.call_count, 2)
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(self.unit.students.get(
+                student_id='s0').name, 'Renamed')
+
+    def test_area_edit_invalidates_upload(self):
+        self.client.force_login(self.manager)
+        rows = ['user_id,name,area', 's0,Student 0,Web', 's1,Student 1,Web']
+        with mock.patch('manager.tasks.upload_students_list_task.delay', side_effect=self.run_upload) as self.delay:
+            self.post_students_list(rows, 'area')
+            area = self.unit.areas.get(name='Web')
+            self.assertEqual(area.students.count(), 2)
+
+            # Removing the area's students changes the unit, so uploading the list again restores them
+            self.client.post(reverse('manager:unit_area_update', kwargs={
+                             'pk_unit': self.unit.id, 'pk': area.id}), {'name': 'Web', 'students': []})
+            self.assertEqual(area.students.count(), 0)
+            response = self.post_students_list(rows, 'area')
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(self.delay.call_count, 2)
+            self.assertEqual(area.students.count(), 2)
+
+            self.client.post(reverse('manager:unit_area_delete', kwargs={
+                             'pk_unit': self.unit.id, 'pk': area.id}))
+            self.assertFalse(self.unit.areas.exists())
+            response = self.post_students_list(rows, 'area')
+            self.assertEqual(self.delay.call_count, 3)
+            self.assertEqual(self.unit.areas.get(
+                name='Web').students.count(), 2)
@@ -1,221 +1,914 @@
-import csv
 import base64
-import tempfile
+import contextlib
+import csv
+import hashlib
+import io
+import itertools
+import json
 import os
+import tempfile
+from io import StringIO
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
 
 from core import models
 
 
-def upload_projects_list(unit_id, manager_id, file_bytes_base64_str, override_list, identifier_column, name_column, min_students_column, max_students_column, description_column, area_column):
-    file_bytes_base64 = file_bytes_base64_str.encode('utf-8')
-    file_bytes = base64.b64decode(file_bytes_base64)
-    # Write the file to a temporary location, deletion is guaranteed
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        tmp_file = os.path.join(tmp_dir, 'blank.zip')
-        with open(tmp_file, 'wb') as file:
-            file.write(file_bytes)
-        with open(tmp_file, 'r', encoding='utf-8-sig') as file:
-            # Process the file
-            unit = models.Unit.objects.get(pk=unit_id)
-            unit_projects = models.Project.objects.filter(unit_id=unit_id)
-
-            csv_data = csv.DictReader(file, delimiter=',')
-
-            project_create_list = []
-            project_update_list = []
-            area_create_list = []
-            project_areas_list = []
-            for row in csv_data:
-                if not all(row[field] == '' for field in row):
-                    project = models.Project()
-                    project.identifier = row[identifier_column].strip()
-                    project.name = row[name_column].strip()
-                    project.min_students = row[min_students_column].strip()
-                    project.max_students = row[max_students_column].strip()
-                    project.unit_id = unit_id
-                    project.description = row[description_column].strip(
-                    ) if description_column != '' and row[description_column] and row[description_column].strip() != '' else None
-                    if area_column != '' and row[area_column] != None and row[area_column].strip() != '':
-                        areas = row[area_column].split(';')
-                        for area in areas:
-                            area = area.strip()
-                            area = models.Area(name=area, unit=unit)
-                            area_create_list.append(area)
-                            project_areas_list.append((project, area))
-                    existing_project = unit_projects.filter(
-                        identifier=project.identifier)
-                    if existing_project.exists():
-                        unit_projects = unit_projects.exclude(
-                            identifier=project.identifier)
-                        no_update_project = existing_project.filter(
-                            name=project.name, min_students=project.min_students, max_students=project.max_students, description=project.description)
-                        if not no_update_project.exists():
-                            project.id = existing_project.first().id
-                            project_update_list.append(project)
-                    else:
-                        project_create_list.append(project)
-
-            if override_list:
-                unit_projects.delete()
-            models.Project.objects.bulk_create(
-                project_create_list,
-                ignore_conflicts=True
-            )
-            models.Project.objects.bulk_update(
-                project_update_list,
-                fields=['name', 'description', 'min_students', 'max_students'],
-            )
-            models.Area.objects.bulk_create(
-                area_create_list, ignore_conflicts=True)
-
-            # Add area
-            project_areas_create = []
-            project_areas_model = models.Project.area.through
-            for project, area in project_areas_list:
-                project = unit.projects.filter(identifier=project.identifier)
-                area = unit.areas.filter(name=area.name)
-                if project.exists() and area.exists():
-                    project = project.first()
-                    area = area.first()
-                    project_areas_create.append(project_areas_model(
-                        project_id=project.id, area_id=area.id))
-
-            project_areas_model.objects.bulk_create(
-                project_areas_create, ignore_conflicts=True)
-
-            return 'Success'
-        return 'Failed'
-
-
-def upload_students_list(unit_id, manager_id, file_bytes_base64_str, override_list, student_id_column, student_name_column, area_column):
-    file_bytes_base64 = file_bytes_base64_str.encode('utf-8')
-    file_bytes = base64.b64decode(file_bytes_base64)
-    # Write the file to a temporary location, deletion is guaranteed
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        tmp_file = os.path.join(tmp_dir, 'blank.zip')
-        with open(tmp_file, 'wb') as file:
-            file.write(file_bytes)
-        with open(tmp_file, 'r', encoding='utf-8-sig') as file:
-            # Process the file
-            unit = models.Unit.objects.get(pk=unit_id)
-            unit_students = models.Student.objects.filter(unit_id=unit_id)
-
-            csv_data = csv.DictReader(file, delimiter=',')
-
-            student_create_list = []
-            area_create_list = []
-            student_areas_list = []
-            for row in csv_data:
-                if not all(row[field] == '' for field in row):
-                    student = models.Student()
-                    student.student_id = row[student_id_column].strip()
-                    student.unit_id = unit_id
-                    if student_name_column != '' and row[student_name_column].strip():
-                        student.name = row[student_name_column].strip()
-                    # Check if user account exists for student
-                    user = models.User.objects.filter(
-                        username=row[student_id_column])
-                    if user.exists():
-                        student.user_id = user.first().id
-                    if area_column != '' and row[area_column] != '' and row[area_column] != None:
-                        areas = row[area_column].split(';')
-                        for area in areas:
-                            area = area.strip()
-                            area = models.Area(
-                                name=area, unit=unit)
-                            area_create_list.append(area)
-                            student_areas_list.append((student, area))
-                    existing_student = unit_students.filter(
-                        student_id=student.student_id)
-                    if existing_student.exists():
-                        unit_students = unit_students.exclude(
-                            student_id=student.student_id)
-                    if not existing_student.exists() or existing_student.first().user_id != student.user_id:
-                        student_create_list.append(student)
-
-            if override_list:
-                # Clear previous students
-                unit_students.delete()
-            models.Student.objects.bulk_create(
-                student_create_list,
-                unique_fields=['student_id', 'unit_id'],
-                update_conflicts=True,
-                update_fields=['user', 'name']
-            )
-            models.Area.objects.bulk_create(
-                area_create_list, ignore_conflicts=True)
-
-            # Add area
-            student_areas_create = []
-            student_areas_model = models.Student.area.through
-            for student, area in student_areas_list:
-                student = unit.students.filter(student_id=student.student_id)
-                area = unit.areas.filter(name=area.name)
-                if student.exists() and area.exists():
-                    student = student.first()
-                    area = area.first()
-                    student_areas_create.append(student_areas_model(
-                        student_id=student.id, area_id=area.id))
-
-            student_areas_model.objects.bulk_create(
-                student_areas_create, ignore_conflicts=True)
-            return 'Success'
-        return 'Failed'
-
-
-def upload_preferences_list(unit_id, manager_id, file_bytes_base64_str, preference_rank_column, student_id_column, project_identifier_column):
-    file_bytes_base64 = file_bytes_base64_str.encode('utf-8')
-    file_bytes = base64.b64decode(file_bytes_base64)
+"""
+
+Reading uploaded files
+
+"""
+
+
+@contextlib.contextmanager
+def open_uploaded_file(file_bytes_base64_str):
+    file_bytes = base64.b64decode(file_bytes_base64_str.encode('utf-8'))
     # Write the file to a temporary location, deletion is guaranteed
     with tempfile.TemporaryDirectory() as tmp_dir:
-        tmp_file = os.path.join(tmp_dir, 'blank.zip')
+        tmp_file = os.path.join(tmp_dir, 'upload.csv')
         with open(tmp_file, 'wb') as file:
             file.write(file_bytes)
-        with open(tmp_file, 'r', encoding='utf-8-sig') as file:
-            # Process the file
-            unit = models.Unit.objects.get(pk=unit_id)
-            unit_preferences = models.ProjectPreference.objects.prefetch_related('project').filter(
-                project__unit_id=unit_id)
-
-            csv_data = csv.DictReader(file, delimiter=',')
-
-            unit_projects = unit.projects
-            unit_students = unit.students
-
-            preference_create_list = []
-            student_update_list = []
-            for row in csv_data:
-                if not all(row[field] == '' for field in row):
-                    student_id = row[student_id_column].strip()
-                    project_identifier = row[project_identifier_column].strip()
-                    student = unit_students.filter(student_id=student_id)
-                    project = unit_projects.filter(
-                        identifier=project_identifier)
-                    rank = row[preference_rank_column].strip()
-                    if student.exists() and project.exists():
-                        student = student.first()
-                        project = project.first()
-                        if unit_preferences.filter(student=student, project=project, rank=rank).exists():
-                            unit_preferences = unit_preferences.exclude(
-                                student=student, project=project, rank=rank)
-                        else:
-                            preference = models.ProjectPreference()
-                            preference.rank = rank
-                            preference.student = student
-                            preference.project = project
-                            if student.allocated_project == project:
-                                student.allocated_preference_rank = preference.rank
-                                student_update_list.append(student)
-                            preference_create_list.append(preference)
-
-            unit_preferences.delete()
-            models.ProjectPreference.objects.bulk_create(
-                preference_create_list,
-                ignore_conflicts=True
+        del file_bytes
+        with open(tmp_file, 'r', encoding='utf-8-sig', newline='') as file:
+            yield file
+
+
+@contextlib.contextmanager
+def open_form_file(file):
+    """ Read a file uploaded through a form as text, the uploaded file is left open """
+    file.seek(0)
+    file_text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    try:
+        yield file_text
+    finally:
+        file_text.detach()
+
+
+def row_is_blank(row):
+    return all(row[field] == '' for field in row)
+
+
+def read_rows(file):
+    file.seek(0)
+    return (row for row in csv.DictReader(file, delimiter=',') if not row_is_blank(row))
+
+
+def count_rows(file):
+    return sum(1 for row in read_rows(file))
+
+
+def read_chunks(file, chunk_size):
+    rows = read_rows(file)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def split_areas(value):
+    if value is None or value.strip() == '':
+        return []
+    return [area.strip() for area in value.split(';')]
+
+
+def run_chunked_import(importer, file, task_id=None, progress=None, chunk_size=None, fingerprint=None):
+    """
+        Stream the file through the importer in chunks, committing each chunk in its own transaction.
+        If the task has already committed some rows (i.e. the worker was lost and the task was re-run),
+        those rows are only replayed through importer.resume_chunk() and are not written again.
+    """
+    chunk_size = chunk_size if chunk_size else settings.UPLOAD_CHUNK_SIZE
+    rows_total = count_rows(file)
+
+    list_upload = None
+    rows_committed = 0
+    if task_id:
+        list_upload, created = models.ListUpload.objects.get_or_create(
+            task_id=task_id, defaults={'unit_id': importer.unit.id, 'task_name': importer.task_name})
+        rows_committed = list_upload.rows_committed
+        list_upload.rows_total = rows_total
+        list_upload.save()
+
+    rows_processed = 0
+    for chunk in read_chunks(file, chunk_size):
+        num_skipped = max(0, min(len(chunk), rows_committed - rows_processed))
+        if num_skipped:
+            importer.resume_chunk(chunk[:num_skipped])
+        if num_skipped < len(chunk):
+            with transaction.atomic():
+                importer.import_chunk(chunk[num_skipped:])
+                models.Unit.data_changed(importer.unit.id)
+                if list_upload:
+                    list_upload.rows_committed = rows_processed + len(chunk)
+                    list_upload.save()
+                if progress:
+                    progress(rows_processed + len(chunk), rows_total)
+        rows_processed = rows_processed + len(chunk)
+
+    with transaction.atomic():
+        importer.finish()
+        models.Unit.data_changed(importer.unit.id)
+        if list_upload:
+            list_upload.completed = True
+            if fingerprint:
+                list_upload.fingerprint = fingerprint
+                list_upload.data_version = unit_data_version(
+                    importer.unit.id)
+            list_upload.save()
+
+
+class ListImporter:
+    """
+        Base class for importing a list of rows into a unit, holds in-memory indexes of the unit's data
+        so that rows can be matched without a query per row
+    """
+    task_name = None
+
+    def __init__(self, unit_id, batch_size=None):
+        self.unit = models.Unit.objects.get(pk=unit_id)
+        self.batch_size = batch_size if batch_size else settings.UPLOAD_CHUNK_SIZE
+        self.areas = dict(self.unit.areas.values_list('name', 'id'))
+
+    def import_chunk(self, rows):
+        raise NotImplementedError
+
+    def resume_chunk(self, rows):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+    def get_area_ids(self, area_names):
+        """ Create any areas that do not exist yet and return the ids of the areas, keyed by name """
+        new_area_names = {name for name in area_names if name not in self.areas}
+        if new_area_names:
+            models.Area.objects.bulk_create([models.Area(name=name, unit=self.unit) for name in new_area_names],
+                                            ignore_conflicts=True, batch_size=self.batch_size)
+            self.areas.update(self.unit.areas.filter(
+                name__in=new_area_names).values_list('name', 'id'))
+        return {name: self.areas[name] for name in area_names if name in self.areas}
+
+    def preview_start(self):
+        pass
+
+    def preview_chunk(self, rows, preview):
+        for row in rows:
+            try:
+                self.preview_row(row, preview)
+            except (ValueError, AttributeError):
+                # The row could not be read (e.g. a rank that is not a number or a missing value), so it is reported instead of stopping the preview
+                preview.add('error', ', '.join(
+                    value.strip() for value in row.values() if isinstance(value, str)))
+
+    def preview_row(self, row, preview):
+        raise NotImplementedError
+
+    def preview_finish(self, preview):
+        pass
+
+
+"""
+
+Previewing uploads
+
+"""
+
+
+class UploadPreview:
+    """
+        The changes an upload would make to a unit, counted by action with a sample of the rows for each action
+    """
+    ACTIONS = [
+        ('create', 'To be created'),
+        ('update', 'To be updated'),
+        ('delete', 'To be deleted'),
+        ('unchanged', 'Unchanged'),
+        ('skip', 'Ignored'),
+        ('error', 'Invalid rows'),
+    ]
+    sample_size = 10
+
+    def __init__(self):
+        self.counts = {action: 0 for action, label in self.ACTIONS}
+        self.samples = {action: [] for action, label in self.ACTIONS}
+
+    def add(self, action, row_label):
+        self.counts[action] = self.counts[action] + 1
+        if len(self.samples[action]) < self.sample_size:
+            self.samples[action].append(row_label)
+
+    def get_actions(self):
+        return [{'action': action, 'label': label, 'count': self.counts[action], 'samples': self.samples[action]} for action, label in self.ACTIONS]
+
+
+def run_preview(importer, file):
+    """
+        Compare the file against the importer's in-memory indexes, nothing is written to the database
+    """
+    preview = UploadPreview()
+    importer.preview_start()
+    for chunk in read_chunks(file, importer.batch_size):
+        importer.preview_chunk(chunk, preview)
+    importer.preview_finish(preview)
+    return preview
+
+
+"""
+
+Fingerprinting uploads
+
+"""
+
+
+def fingerprint_upload(unit_id, task_name, file, list_options):
+    """ Hash of an uploaded file together with the unit and column mapping it is uploaded with """
+    hasher = hashlib.sha256(json.dumps(
+        [int(unit_id), task_name, list_options], sort_keys=True).encode('utf-8'))
+    for chunk in file.chunks():
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def unit_data_version(unit_id):
+    return models.Unit.objects.filter(pk=unit_id).values_list('data_version', flat=True).first()
+
+
+def is_duplicate_upload(unit_id, task_name, fingerprint):
+    """
+        Check if the same file has already been uploaded to the unit with the same column mapping,
+        and the unit's data has not changed since, in which case uploading it again would not change anything
+    """
+    list_upload = models.ListUpload.objects.filter(
+        unit_id=unit_id, task_name=task_name, fingerprint=fingerprint, completed=True).order_by('-id').first()
+    return list_upload is not None and list_upload.data_version == unit_data_version(unit_id)
+
+
+"""
+
+PostgreSQL COPY imports
+
+"""
+
+
+def use_copy_import():
+    return settings.UPLOAD_USE_COPY and connection.vendor == 'postgresql'
+
+
+class CopyStream:
+    """
+        File-like object that feeds rows to COPY as CSV, a few rows at a time
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+        self.output = StringIO()
+        self.writer = csv.writer(self.output)
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow(row)
+            self.buffer = self.buffer + self.output.getvalue()
+            self.output.seek(0)
+            self.output.truncate(0)
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class CopyImporter:
+    """
+        Base class for importing a list with PostgreSQL COPY, the file is streamed into a temporary
+        staging table and merged into the unit with set-based statements
+    """
+    task_name = None
+    staging_table = None
+    staging_columns = []
+
+    def __init__(self, unit_id):
+        self.unit = models.Unit.objects.get(pk=unit_id)
+
+    def read_row(self, row):
+        raise NotImplementedError
+
+    def merge(self, cursor):
+        raise NotImplementedError
+
+    def create_temporary_table(self, cursor, table, definition, params=None):
+        # Temporary tables are dropped on commit, but may still exist if the import is run inside an outer transaction
+        cursor.execute(f'DROP TABLE IF EXISTS {table}')
+        cursor.execute(
+            f'CREATE TEMPORARY TABLE {table} {definition}', params)
+
+    def stage(self, cursor, file):
+        self.create_temporary_table(
+            cursor, self.staging_table, f'(row_number integer, {", ".join(f"{column} text" for column in self.staging_columns)}) ON COMMIT DROP')
+        cursor.copy_expert(
+            f'COPY {self.staging_table} (row_number, {", ".join(self.staging_columns)}) FROM STDIN WITH (FORMAT csv)',
+            CopyStream([row_number] + self.read_row(row) for row_number, row in enumerate(read_rows(file))))
+
+
+def run_copy_import(importer, file, task_id=None, progress=None, fingerprint=None):
+    """
+        Stage the whole file with COPY and merge it into the unit in a single transaction.
+        There are no partial commits, so a re-run of the task starts from the beginning of the file.
+    """
+    rows_total = count_rows(file)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            importer.stage(cursor, file)
+            importer.merge(cursor)
+        models.Unit.data_changed(importer.unit.id)
+        if task_id:
+            models.ListUpload.objects.update_or_create(task_id=task_id, defaults={
+                'unit_id': importer.unit.id, 'task_name': importer.task_name, 'rows_total': rows_total, 'rows_committed': rows_total, 'completed': True,
+                'fingerprint': fingerprint if fingerprint else '', 'data_version': unit_data_version(importer.unit.id) if fingerprint else None})
+        if progress:
+            progress(rows_total, rows_total)
+
+
+"""
+
+Uploading a list of projects
+
+"""
+
+
+class ProjectListImporter(ListImporter):
+    task_name = models.Unit.UPLOAD_PROJECTS_TASK_NAME
+
+    def __init__(self, unit_id, override_list, identifier_column, name_column, min_students_column, max_students_column, description_column, area_column, batch_size=None):
+        super().__init__(unit_id, batch_size=batch_size)
+        self.override_list = override_list
+        self.identifier_column = identifier_column
+        self.name_column = name_column
+        self.min_students_column = min_students_column
+        self.max_students_column = max_students_column
+        self.description_column = description_column
+        self.area_column = area_column
+
+        self.projects = {identifier: (id, name, min_students, max_students, description) for id, identifier, name, min_students, max_students, description in self.unit.projects.values_list(
+            'id', 'identifier', 'name', 'min_students', 'max_students', 'description')}
+        self.seen_identifiers = set()
+
+    def read_row(self, row):
+        project = models.Project()
+        project.identifier = row[self.identifier_column].strip()
+        project.name = row[self.name_column].strip()
+        project.min_students = int(row[self.min_students_column].strip())
+        project.max_students = int(row[self.max_students_column].strip())
+        project.unit_id = self.unit.id
+        project.description = row[self.description_column].strip(
+        ) if self.description_column != '' and row[self.description_column] and row[self.description_column].strip() != '' else None
+        areas = split_areas(
+            row[self.area_column]) if self.area_column != '' else []
+        return project, areas
+
+    def import_chunk(self, rows):
+        project_create_list = []
+        project_update_list = []
+        project_areas_list = []
+        for row in rows:
+            project, areas = self.read_row(row)
+            for area in areas:
+                project_areas_list.append((project.identifier, area))
+            if project.identifier in self.seen_identifiers:
+                # Only the first row for each project is used
+                continue
+            self.seen_identifiers.add(project.identifier)
+            existing_project = self.projects.get(project.identifier)
+            if existing_project:
+                if existing_project[1:] != (project.name, project.min_students, project.max_students, project.description):
+                    project.id = existing_project[0]
+                    project_update_list.append(project)
+            else:
+                project_create_list.append(project)
+
+        models.Project.objects.bulk_create(
+            project_create_list,
+            ignore_conflicts=True,
+            batch_size=self.batch_size
+        )
+        models.Project.objects.bulk_update(
+            project_update_list,
+            fields=['name', 'description', 'min_students', 'max_students'],
+            batch_size=self.batch_size
+        )
+        for project in project_update_list:
+            self.projects[project.identifier] = (
+                project.id, project.name, project.min_students, project.max_students, project.description)
+        if project_create_list:
+            for id, identifier, name, min_students, max_students, description in self.unit.projects.filter(identifier__in=[project.identifier for project in project_create_list]).values_list(
+                    'id', 'identifier', 'name', 'min_students', 'max_students', 'description'):
+                self.projects[identifier] = (
+                    id, name, min_students, max_students, description)
+
+        # Add area
+        area_ids = self.get_area_ids(
+            [area for identifier, area in project_areas_list])
+        project_areas_model = models.Project.area.through
+        project_areas_model.objects.bulk_create([
+            project_areas_model(
+                project_id=self.projects[identifier][0], area_id=area_ids[area])
+            for identifier, area in project_areas_list if identifier in self.projects and area in area_ids
+        ], ignore_conflicts=True, batch_size=self.batch_size)
+
+    def resume_chunk(self, rows):
+        for row in rows:
+            self.seen_identifiers.add(row[self.identifier_column].strip())
+
+    def preview_start(self):
+        # Areas are only added by an upload, so they are only needed to tell whether a project would change
+        self.project_areas = {}
+        for project_id, area_name in models.Project.area.through.objects.filter(project__unit_id=self.unit.id).values_list('project_id', 'area__name'):
+            self.project_areas.setdefault(project_id, set()).add(area_name)
+
+    def preview_row(self, row, preview):
+        project, areas = self.read_row(row)
+        row_label = f'{project.identifier}: {project.name}'
+        if project.identifier in self.seen_identifiers:
+            preview.add('skip', row_label)
+            return
+        self.seen_identifiers.add(project.identifier)
+        existing_project = self.projects.get(project.identifier)
+        if not existing_project:
+            preview.add('create', row_label)
+        elif existing_project[1:] != (project.name, project.min_students, project.max_students, project.description) or not set(areas) <= self.project_areas.get(existing_project[0], set()):
+            preview.add('update', row_label)
+        else:
+            preview.add('unchanged', row_label)
+
+    def preview_finish(self, preview):
+        if self.override_list:
+            for identifier, project in self.projects.items():
+                if identifier not in self.seen_identifiers:
+                    preview.add('delete', f'{identifier}: {project[1]}')
+
+    def finish(self):
+        if self.override_list:
+            models.Project.objects.filter(id__in=[project[0] for identifier, project in self.projects.items(
+            ) if identifier not in self.seen_identifiers]).delete()
+
+
+def upload_projects_list(unit_id, manager_id, file_bytes_base64_str, override_list, identifier_column, name_column, min_students_column, max_students_column, description_column, area_column, task_id=None, progress=None, fingerprint=None):
+    with open_uploaded_file(file_bytes_base64_str) as file:
+        importer = ProjectListImporter(unit_id, override_list, identifier_column, name_column,
+                                       min_students_column, max_students_column, description_column, area_column)
+        run_chunked_import(importer, file, task_id=task_id,
+                           progress=progress, fingerprint=fingerprint)
+        return 'Success'
+    return 'Failed'
+
+
+def preview_projects_list(unit_id, file, override_list, identifier_column, name_column, min_students_column, max_students_column, description_column, area_column):
+    with open_form_file(file) as file_text:
+        importer = ProjectListImporter(unit_id, override_list, identifier_column, name_column,
+                                       min_students_column, max_students_column, description_column, area_column)
+        return run_preview(importer, file_text)
+
+
+"""
+
+Uploading a list of students
+
+"""
+
+
+class StudentListImporter(ListImporter):
+    task_name = models.Unit.UPLOAD_STUDENTS_TASK_NAME
+
+    def __init__(self, unit_id, override_list, student_id_column, student_name_column, area_column, batch_size=None):
+        super().__init__(unit_id, batch_size=batch_size)
+        self.override_list = override_list
+        self.student_id_column = student_id_column
+        self.student_name_column = student_name_column
+        self.area_column = area_column
+
+        self.students = {student_id: (id, user_id, name) for id, student_id, user_id, name in self.unit.students.values_list(
+            'id', 'student_id', 'user_id', 'name')}
+        self.seen_student_ids = set()
+
+    def read_row(self, row):
+        student = models.Student()
+        student.student_id = row[self.student_id_column].strip()
+        student.unit_id = self.unit.id
+        if self.student_name_column != '' and row[self.student_name_column].strip():
+            student.name = row[self.student_name_column].strip()
+        areas = split_areas(
+            row[self.area_column]) if self.area_column != '' else []
+        return student, areas
+
+    def get_user_ids(self, rows):
+        # Check if user accounts exist for the students
+        return dict(models.User.objects.filter(username__in=[row[self.student_id_column] for row in rows]).values_list('username', 'id'))
+
+    def import_chunk(self, rows):
+        user_ids = self.get_user_ids(rows)
+
+        student_create_list = []
+        student_areas_list = []
+        for row in rows:
+            student, areas = self.read_row(row)
+            student.user_id = user_ids.get(row[self.student_id_column])
+            for area in areas:
+                student_areas_list.append((student.student_id, area))
+            if student.student_id in self.seen_student_ids:
+                # Only the first row for each student is used
+                continue
+            self.seen_student_ids.add(student.student_id)
+            existing_student = self.students.get(student.student_id)
+            if not existing_student or existing_student[1] != student.user_id or (self.student_name_column != '' and existing_student[2] != student.name):
+                student_create_list.append(student)
+
+        models.Student.objects.bulk_create(
+            student_create_list,
+            unique_fields=['student_id', 'unit_id'],
+            update_conflicts=True,
+            update_fields=['user', 'name'] if self.student_name_column != '' else [
+                'user'],
+            batch_size=self.batch_size
+        )
+        if student_create_list:
+            for id, student_id, user_id, name in self.unit.students.filter(student_id__in=[student.student_id for student in student_create_list]).values_list(
+                    'id', 'student_id', 'user_id', 'name'):
+                self.students[student_id] = (id, user_id, name)
+
+        # Add area
+        area_ids = self.get_area_ids(
+            [area for student_id, area in student_areas_list])
+        student_areas_model = models.Student.area.through
+        student_areas_model.objects.bulk_create([
+            student_areas_model(
+                student_id=self.students[student_id][0], area_id=area_ids[area])
+            for student_id, area in student_areas_list if student_id in self.students and area in area_ids
+        ], ignore_conflicts=True, batch_size=self.batch_size)
+
+    def resume_chunk(self, rows):
+        for row in rows:
+            self.seen_student_ids.add(row[self.student_id_column].strip())
+
+    def preview_start(self):
+        # Areas are only added by an upload, so they are only needed to tell whether a student would change
+        self.student_areas = {}
+        for student_id, area_name in models.Student.area.through.objects.filter(student__unit_id=self.unit.id).values_list('student_id', 'area__name'):
+            self.student_areas.setdefault(student_id, set()).add(area_name)
+
+    def preview_chunk(self, rows, preview):
+        self.user_ids = self.get_user_ids(rows)
+        super().preview_chunk(rows, preview)
+
+    def preview_row(self, row, preview):
+        student, areas = self.read_row(row)
+        student.user_id = self.user_ids.get(row[self.student_id_column])
+        row_label = f'{student.student_id}: {student.name}' if student.name else student.student_id
+        if student.student_id in self.seen_student_ids:
+            preview.add('skip', row_label)
+            return
+        self.seen_student_ids.add(student.student_id)
+        existing_student = self.students.get(student.student_id)
+        if not existing_student:
+            preview.add('create', row_label)
+        elif existing_student[1] != student.user_id or (self.student_name_column != '' and existing_student[2] != student.name) or not set(areas) <= self.student_areas.get(existing_student[0], set()):
+            preview.add('update', row_label)
+        else:
+            preview.add('unchanged', row_label)
+
+    def preview_finish(self, preview):
+        if self.override_list:
+            for student_id, student in self.students.items():
+                if student_id not in self.seen_student_ids:
+                    preview.add(
+                        'delete', f'{student_id}: {student[2]}' if student[2] else student_id)
+
+    def finish(self):
+        if self.override_list:
+            # Clear previous students
+            models.Student.objects.filter(id__in=[student[0] for student_id, student in self.students.items(
+            ) if student_id not in self.seen_student_ids]).delete()
+
+
+class StudentListCopyImporter(CopyImporter):
+    task_name = models.Unit.UPLOAD_STUDENTS_TASK_NAME
+    staging_table = 'upload_students_staging'
+    staging_columns = ['student_id', 'name', 'areas']
+
+    def __init__(self, unit_id, override_list, student_id_column, student_name_column, area_column):
+        super().__init__(unit_id)
+        self.override_list = override_list
+        self.student_id_column = student_id_column
+        self.student_name_column = student_name_column
+        self.area_column = area_column
+
+    def read_row(self, row):
+        return [
+            row[self.student_id_column].strip(),
+            row[self.student_name_column].strip(
+            ) if self.student_name_column != '' and row[self.student_name_column] else '',
+            row[self.area_column] if self.area_column != '' and row[self.area_column] else ''
+        ]
+
+    def merge(self, cursor):
+        student_table = models.Student._meta.db_table
+        user_table = models.User._meta.db_table
+        area_table = models.Area._meta.db_table
+        student_area_table = models.Student.area.through._meta.db_table
+
+        # Only the first row for each student is used
+        self.create_temporary_table(cursor, 'upload_students', f"""ON COMMIT DROP AS
+            SELECT DISTINCT ON (student_id) student_id, name
+            FROM {self.staging_table}
+            ORDER BY student_id, row_number
+        """)
+        # Add new students and update the user (and name) of existing students
+        cursor.execute(f"""
+            INSERT INTO {student_table} (student_id, name, unit_id, user_id)
+            SELECT upload.student_id, COALESCE(upload.name, ''), %s, student_user.id
+            FROM upload_students upload
+            LEFT JOIN {user_table} student_user ON student_user.username = upload.student_id
+            ON CONFLICT (student_id, unit_id) DO UPDATE SET user_id = EXCLUDED.user_id{', name = EXCLUDED.name' if self.student_name_column != '' else ''}
+            WHERE {student_table}.user_id IS DISTINCT FROM EXCLUDED.user_id{f' OR {student_table}.name IS DISTINCT FROM EXCLUDED.name' if self.student_name_column != '' else ''}
+        """, [self.unit.id])
+        # Add area
+        self.create_temporary_table(cursor, 'upload_student_areas', f"""ON COMMIT DROP AS
+            SELECT DISTINCT staging.student_id, btrim(area.name) AS name
+            FROM {self.staging_table} staging
+            CROSS JOIN unnest(string_to_array(staging.areas, ';')) AS area(name)
+            WHERE btrim(area.name) <> ''
+        """)
+        cursor.execute(f"""
+            INSERT INTO {area_table} (name, unit_id)
+            SELECT DISTINCT upload.name, %s FROM upload_student_areas upload
+            ON CONFLICT DO NOTHING
+        """, [self.unit.id])
+        cursor.execute(f"""
+            INSERT INTO {student_area_table} (student_id, area_id)
+            SELECT student.id, area.id
+            FROM upload_student_areas upload
+            JOIN {student_table} student ON student.unit_id = %s AND student.student_id = upload.student_id
+            JOIN {area_table} area ON area.unit_id = %s AND area.name = upload.name
+            ON CONFLICT DO NOTHING
+        """, [self.unit.id, self.unit.id])
+
+        if self.override_list:
+            # Clear previous students, through the ORM so that their preferences and areas are removed as well
+            models.Student.objects.filter(unit_id=self.unit.id).exclude(id__in=RawSQL(f"""
+                SELECT student.id FROM {student_table} student
+                JOIN upload_students upload ON upload.student_id = student.student_id
+                WHERE student.unit_id = %s
+            """, [self.unit.id])).delete()
+
+
+def upload_students_list(unit_id, manager_id, file_bytes_base64_str, override_list, student_id_column, student_name_column, area_column, task_id=None, progress=None, fingerprint=None):
+    with open_uploaded_file(file_bytes_base64_str) as file:
+        if use_copy_import():
+            importer = StudentListCopyImporter(
+                unit_id, override_list, student_id_column, student_name_column, area_column)
+            run_copy_import(importer, file, task_id=task_id,
+                            progress=progress, fingerprint=fingerprint)
+        else:
+            importer = StudentListImporter(
+                unit_id, override_list, student_id_column, student_name_column, area_column)
+            run_chunked_import(importer, file, task_id=task_id,
+                               progress=progress, fingerprint=fingerprint)
+        return 'Success'
+    return 'Failed'
+
+
+def preview_students_list(unit_id, file, override_list, student_id_column, student_name_column, area_column):
+    with open_form_file(file) as file_text:
+        importer = StudentListImporter(
+            unit_id, override_list, student_id_column, student_name_column, area_column)
+        return run_preview(importer, file_text)
+
+
+"""
+
+Uploading a list of preferences
+
+"""
+
+
+class PreferenceListImporter(ListImporter):
+    task_name = models.Unit.UPLOAD_PREFERENCES_TASK_NAME
+
+    def __init__(self, unit_id, preference_rank_column, student_id_column, project_identifier_column, batch_size=None):
+        super().__init__(unit_id, batch_size=batch_size)
+        self.preference_rank_column = preference_rank_column
+        self.student_id_column = student_id_column
+        self.project_identifier_column = project_identifier_column
+
+        self.students = {student_id: (id, allocated_project_id) for id, student_id, allocated_project_id in self.unit.students.values_list(
+            'id', 'student_id', 'allocated_project_id')}
+        self.projects = dict(
+            self.unit.projects.values_list('identifier', 'id'))
+
+        # Existing preferences, indexed by each of their unique keys
+        self.preferences = {}
+        self.preferences_by_rank = {}
+        self.preferences_by_project = {}
+        for id, student_id, project_id, rank in models.ProjectPreference.objects.filter(project__unit_id=unit_id).values_list('id', 'student_id', 'project_id', 'rank'):
+            self.preferences[student_id, project_id, rank] = id
+            self.preferences_by_rank[student_id, rank] = id
+            self.preferences_by_project[student_id, project_id] = id
+
+        self.seen_preference_ids = set()
+        self.claimed_ranks = set()
+        self.claimed_projects = set()
+
+    def read_row(self, row):
+        student = self.students.get(row[self.student_id_column].strip())
+        project_id = self.projects.get(
+            row[self.project_identifier_column].strip())
+        if not student or not project_id:
+            return None
+        return student, project_id, int(row[self.preference_rank_column].strip())
+
+    def claim(self, student_id, project_id, rank):
+        """ Claim the rank and project for the student, only the first preference in the file for each is retained """
+        if (student_id, rank) in self.claimed_ranks or (student_id, project_id) in self.claimed_projects:
+            return False
+        self.claimed_ranks.add((student_id, rank))
+        self.claimed_projects.add((student_id, project_id))
+        return True
+
+    def import_chunk(self, rows):
+        preference_create_list = []
+        preference_delete_list = []
+        student_update_list = []
+        for row in rows:
+            preference = self.read_row(row)
+            if not preference:
+                continue
+            (student_id, allocated_project_id), project_id, rank = preference
+            if not self.claim(student_id, project_id, rank):
+                continue
+            existing_preference_id = self.preferences.get(
+                (student_id, project_id, rank))
+            if existing_preference_id:
+                self.seen_preference_ids.add(existing_preference_id)
+                continue
+            # Remove existing preferences that conflict with this preference
+            for conflicting_preference_id in {self.preferences_by_rank.get((student_id, rank)), self.preferences_by_project.get((student_id, project_id))}:
+                if conflicting_preference_id:
+                    preference_delete_list.append(conflicting_preference_id)
+            preference_create_list.append(models.ProjectPreference(
+                student_id=student_id, project_id=project_id, rank=rank))
+            if allocated_project_id == project_id:
+                student_update_list.append(models.Student(
+                    id=student_id, allocated_preference_rank=rank))
+
+        models.ProjectPreference.objects.filter(
+            id__in=preference_delete_list).delete()
+        models.ProjectPreference.objects.bulk_create(
+            preference_create_list,
+            ignore_conflicts=True,
+            batch_size=self.batch_size
+        )
+        models.Student.objects.bulk_update(
+            student_update_list,
+            fields=['allocated_preference_rank'],
+            batch_size=self.batch_size
+        )
+
+    def resume_chunk(self, rows):
+        for row in rows:
+            preference = self.read_row(row)
+            if not preference:
+                continue
+            (student_id, allocated_project_id), project_id, rank = preference
+            if self.claim(student_id, project_id, rank):
+                existing_preference_id = self.preferences.get(
+                    (student_id, project_id, rank))
+                if existing_preference_id:
+                    self.seen_preference_ids.add(existing_preference_id)
+
+    def preview_row(self, row, preview):
+        row_label = f'{row[self.student_id_column].strip()}: {row[self.project_identifier_column].strip()} (rank {row[self.preference_rank_column].strip()})'
+        preference = self.read_row(row)
+        if not preference:
+            # The student or project is not in the unit
+            preview.add('skip', row_label)
+            return
+        (student_id, allocated_project_id), project_id, rank = preference
+        if not self.claim(student_id, project_id, rank):
+            preview.add('skip', row_label)
+            return
+        existing_preference_id = self.preferences.get(
+            (student_id, project_id, rank))
+        if existing_preference_id:
+            self.seen_preference_ids.add(existing_preference_id)
+            preview.add('unchanged', row_label)
+            return
+        # A preference that replaces an existing preference for the same rank or project is counted as an update
+        for conflicting_preference_id in [self.preferences_by_rank.get((student_id, rank)), self.preferences_by_project.get((student_id, project_id))]:
+            if conflicting_preference_id and conflicting_preference_id not in self.seen_preference_ids:
+                self.seen_preference_ids.add(conflicting_preference_id)
+                preview.add('update', row_label)
+                break
+        else:
+            preview.add('create', row_label)
+
+    def preview_finish(self, preview):
+        student_ids = {student[0]: student_id for student_id,
+                       student in self.students.items()}
+        project_identifiers = {id: identifier for identifier,
+                               id in self.projects.items()}
+        for (student_id, project_id, rank), id in self.preferences.items():
+            if id not in self.seen_preference_ids:
+                preview.add(
+                    'delete', f'{student_ids.get(student_id)}: {project_identifiers.get(project_id)} (rank {rank})')
+
+    def finish(self):
+        # Remove the preferences that were not in the uploaded file
+        models.ProjectPreference.objects.filter(id__in=[id for id in self.preferences.values(
+        ) if id not in self.seen_preference_ids]).delete()
+
+
+class PreferenceListCopyImporter(CopyImporter):
+    """
+        If a student has multiple preferences with the same rank only the first is retained,
+        then if a student has multiple preferences for the same project only the first of those is retained
+    """
+    task_name = models.Unit.UPLOAD_PREFERENCES_TASK_NAME
+    staging_table = 'upload_preferences_staging'
+    staging_columns = ['student_id', 'project_identifier', 'rank']
+
+    def __init__(self, unit_id, preference_rank_column, student_id_column, project_identifier_column):
+        super().__init__(unit_id)
+        self.preference_rank_column = preference_rank_column
+        self.student_id_column = student_id_column
+        self.project_identifier_column = project_identifier_column
+
+    def read_row(self, row):
+        return [row[self.student_id_column].strip(), row[self.project_identifier_column].strip(), row[self.preference_rank_column].strip()]
+
+    def merge(self, cursor):
+        preference_table = models.ProjectPreference._meta.db_table
+        student_table = models.Student._meta.db_table
+        project_table = models.Project._meta.db_table
+
+        # Resolve the student and project of each preference, preferences referencing students or projects that are not in the unit are dropped
+        self.create_temporary_table(cursor, 'upload_preferences', f"""ON COMMIT DROP AS
+            WITH resolved AS (
+                SELECT staging.row_number, student.id AS student_id, project.id AS project_id, staging.rank::integer AS rank
+                FROM {self.staging_table} staging
+                JOIN {student_table} student ON student.unit_id = %s AND student.student_id = staging.student_id
+                JOIN {project_table} project ON project.unit_id = %s AND project.identifier = staging.project_identifier
+            ), first_rank AS (
+                SELECT DISTINCT ON (student_id, rank) * FROM resolved ORDER BY student_id, rank, row_number
             )
-            models.Student.objects.bulk_update(
-                student_update_list,
-                fields=['allocated_preference_rank']
+            SELECT DISTINCT ON (student_id, project_id) * FROM first_rank ORDER BY student_id, project_id, row_number
+        """, [self.unit.id, self.unit.id])
+        # Remove the preferences that were not in the uploaded file
+        cursor.execute(f"""
+            DELETE FROM {preference_table} preference
+            USING {project_table} project
+            WHERE preference.project_id = project.id AND project.unit_id = %s
+            AND NOT EXISTS (
+                SELECT 1 FROM upload_preferences upload
+                WHERE upload.student_id = preference.student_id AND upload.project_id = preference.project_id AND upload.rank = preference.rank
             )
-            return 'Success'
-        return 'Failed'
+        """, [self.unit.id])
+        # Add the new preferences, unchanged preferences already exist
+        cursor.execute(f"""
+            INSERT INTO {preference_table} (student_id, project_id, rank)
+            SELECT upload.student_id, upload.project_id, upload.rank FROM upload_preferences upload
+            ON CONFLICT DO NOTHING
+        """)
+        cursor.execute(f"""
+            UPDATE {student_table} student SET allocated_preference_rank = upload.rank
+            FROM upload_preferences upload
+            WHERE upload.student_id = student.id AND upload.project_id = student.allocated_project_id
+        """)
+
+
+def upload_preferences_list(unit_id, manager_id, file_bytes_base64_str, preference_rank_column, student_id_column, project_identifier_column, task_id=None, progress=None, fingerprint=None):
+    with open_uploaded_file(file_bytes_base64_str) as file:
+        if use_copy_import():
+            importer = PreferenceListCopyImporter(
+                unit_id, preference_rank_column, student_id_column, project_identifier_column)
+            run_copy_import(importer, file, task_id=task_id,
+                            progress=progress, fingerprint=fingerprint)
+        else:
+            importer = PreferenceListImporter(
+                unit_id, preference_rank_column, student_id_column, project_identifier_column)
+            run_chunked_import(importer, file, task_id=task_id,
+                               progress=progress, fingerprint=fingerprint)
+        return 'Success'
+    return 'Failed'
+
+
+def preview_preferences_list(unit_id, file, preference_rank_column, student_id_column, project_identifier_column):
+    with open_form_file(file) as file_text:
+        importer = PreferenceListImporter(
+            unit_id, preference_rank_column, student_id_column, project_identifier_column)
+        return run_preview(importer, file_text)
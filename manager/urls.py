@@ -19,6 +19,8 @@ urlpatterns = [
     # Student views
     re_path(r'^units/(?P<pk_unit>[0-9]+)/students/$',
             views.StudentsListView.as_view(), name='unit_students'),
+    re_path(r'^units/(?P<pk_unit>[0-9]+)/students/typeahead/$',
+            views.StudentsTypeaheadView.as_view(), name='unit_students_typeahead'),
     re_path(r'^units/(?P<pk_unit>[0-9]+)/students/new_list/$',
             views.StudentsUploadListView.as_view(), name='unit_students_new_list'),
     re_path(r'^units/(?P<pk_unit>[0-9]+)/students/clear/$',
@@ -34,6 +36,8 @@ urlpatterns = [
     # Project views
     re_path(r'^units/(?P<pk_unit>[0-9]+)/projects/$',
             views.ProjectsListView.as_view(), name='unit_projects'),
+    re_path(r'^units/(?P<pk_unit>[0-9]+)/projects/typeahead/$',
+            views.ProjectsTypeaheadView.as_view(), name='unit_projects_typeahead'),
     re_path(r'^units/(?P<pk_unit>[0-9]+)/projects/new_list/$',
             views.ProjectsUploadListView.as_view(), name='unit_projects_new_list'),
     re_path(r'^units/(?P<pk_unit>[0-9]+)/projects/clear/$',
@@ -64,6 +68,8 @@ urlpatterns = [
             views.PreferencesView.as_view(), name='unit_preferences'),
     re_path(r'^units/(?P<pk_unit>[0-9]+)/preferences/distribution/$',
             views.PreferencesDistributionView.as_view(), name='unit_preferences_distribution'),
+    re_path(r'^units/(?P<pk_unit>[0-9]+)/preferences/heat_map/$',
+            views.PreferencesHeatMapView.as_view(), name='unit_preferences_heat_map'),
     re_path(r'^units/(?P<pk_unit>[0-9]+)/preferences/upload/$',
             views.PreferencesUploadListView.as_view(), name='unit_preferences_new_list'),
     # Allocation Views
@@ -1,13 +1,16 @@
 import base64
 
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.db import models
-from django.db.models import Count, Sum, F, Avg, Min, Max
-from django.db.models.functions import Round, Coalesce
-from django.http import HttpResponseRedirect
+from django.contrib.postgres.expressions import ArraySubquery
+from django.db import connections, models, transaction
+from django.db.models import Count, Exists, F, Max, OuterRef, Q, Subquery
+from django.db.models.functions import JSONObject
+from django.http import HttpResponseRedirect, JsonResponse
 from django.urls import reverse, reverse_lazy, Resolver404, resolve
+from django.utils.decorators import method_decorator
 from django.utils.html import format_html
-from django.views.generic import TemplateView, DetailView, CreateView, DeleteView, UpdateView
+from django.views.decorators.gzip import gzip_page
+from django.views.generic import View, TemplateView, DetailView, CreateView, DeleteView, UpdateView
 from django.views.generic.edit import FormMixin
 
 from django_filters.views import FilterView
@@ -17,8 +20,10 @@ from core import models
 from core.views import IndexView
 from . import filters
 from . import forms
+from . import pagination
 from . import tables
 from . import tasks
+from . import upload
 
 
 def render_exists_badge(value: bool):
@@ -36,12 +41,56 @@ def render_area_list(areas):
     return format_html(f"""{areas_html}""")
 
 
+UNCHANGED_UPLOAD_WARNING = {'type': 'success', 'content': 'This list has already been uploaded with the same column names and the unit has not changed since, so there are no changes to upload.'}
+
+
 def user_is_manager(user):
     return user.is_manager
 
 
+def annotate_area_links(queryset, related_name):
+    """
+        The id and name of each row's areas for the table's area links, aggregated in the query on PostgreSQL,
+        other databases prefetch the areas in a second query
+    """
+    if connections[queryset.db].vendor != 'postgresql':
+        return queryset.prefetch_related('area')
+    return queryset.annotate(area_links=ArraySubquery(models.Area.objects.filter(
+        **{related_name: OuterRef('pk')}).order_by('name').values(link=JSONObject(id='id', name='name'))))
+
+
 class FilteredTableMixin(SingleTableMixin):
     filter_formhelper_class = None
+    # Unique ordering of the table's rows, pages are found by seeking past this ordering unless the table is sorted by a column
+    keyset_ordering = None
+    keyset_approximate_count = True
+
+    def use_keyset_pagination(self):
+        return self.keyset_ordering is not None and not self.request.GET.get('sort')
+
+    def get_keyset_per_page(self):
+        per_page = self.request.GET.get('per_page', '')
+        return int(per_page) if per_page.isdigit() and int(per_page) > 0 else self.get_table_class()._meta.per_page
+
+    def get_keyset_url(self, **cursor):
+        query = self.request.GET.copy()
+        for key in ['after', 'before']:
+            query.pop(key, None)
+        query.update(cursor)
+        return f'?{query.urlencode()}'
+
+    def get_table_pagination(self, table):
+        if self.use_keyset_pagination():
+            return False
+        return super().get_table_pagination(table)
+
+    def get_table_data(self):
+        data = super().get_table_data()
+        if not self.use_keyset_pagination():
+            return data
+        self.keyset_page = pagination.KeysetPage(data, self.keyset_ordering, self.get_keyset_per_page(
+        ), after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        return self.keyset_page.rows
 
     def get_filter_formhelper_class(self):
         if self.filter_formhelper_class:
@@ -53,11 +102,57 @@ class FilteredTableMixin(SingleTableMixin):
         filterset.form.helper = self.get_filter_formhelper_class()()
         return filterset
 
+    def get_keyset_count(self, filterset):
+        if not self.keyset_approximate_count:
+            return None
+        # The planner's estimate can be far off for a filtered or searched table, so those rows are counted
+        if any(self.request.GET.get(field) for field in filterset.get_fields()):
+            return filterset.qs.count()
+        return pagination.approximate_count(filterset.qs)
+
     def get_context_data(self, **kwargs):
         f = self.get_filterset(self.get_filterset_class())
         self.table_data = f.qs
-        return {**super().get_context_data(**kwargs), 'filter': f, 'has_filter': any(
+        context = {**super().get_context_data(**kwargs), 'filter': f, 'has_filter': any(
             field in self.request.GET for field in set(f.get_fields()))}
+        if hasattr(self, 'keyset_page'):
+            context['keyset_pagination'] = {
+                'previous_url': self.get_keyset_url(before=self.keyset_page.previous_cursor) if self.keyset_page.previous_cursor else None,
+                'next_url': self.get_keyset_url(after=self.keyset_page.next_cursor) if self.keyset_page.next_cursor else None,
+                'first_url': self.get_keyset_url(),
+                'count': self.get_keyset_count(f),
+            }
+        return context
+
+
+class TypeaheadMixin:
+    """
+        Choices for the typeahead pickers in the forms, as a page of JSON results matching the search
+    """
+    search_fields = []
+    keyset_ordering = None
+    per_page = 20
+
+    def get_label(self, obj):
+        return str(obj)
+
+    def get_typeahead_queryset(self):
+        queryset = self.get_queryset()
+        search = self.request.GET.get('q', '').strip()
+        if search:
+            condition = Q()
+            for field in self.search_fields:
+                condition = condition | Q(**{f'{field}__icontains': search})
+            queryset = queryset.filter(condition)
+        return queryset
+
+    def get(self, request, *args, **kwargs):
+        page = pagination.KeysetPage(self.get_typeahead_queryset(
+        ), self.keyset_ordering, self.per_page, after=request.GET.get('after'))
+        return JsonResponse({
+            'results': [{'id': obj.pk, 'text': self.get_label(obj)} for obj in page.rows],
+            'next': page.next_cursor,
+        })
 
 
 """
@@ -73,13 +168,13 @@ class UnitMixin(LoginRequiredMixin, UserPassesTestMixin):
 
     def test_func(self):
         unit = self.get_unit_object()
-        return self.get_unit_queryset().exists() and user_is_manager(self.request.user) and unit.manager_id == self.request.user.id
+        return unit is not None and user_is_manager(self.request.user) and unit.manager_id == self.request.user.id
 
     def get_unit_queryset(self):
         unit_pk = self.kwargs[self.unit_id_arg]
         if not hasattr(self, 'unit_queryset'):
-            self.unit_queryset = models.Unit.objects.filter(pk=unit_pk).select_related('celery_task').annotate(students_count=Count('students', distinct=True)).annotate(
-                projects_count=Count('projects', distinct=True)).annotate(areas_count=Count('areas', distinct=True))
+            self.unit_queryset = models.Unit.objects.filter(pk=unit_pk).select_related('celery_task', 'allocation_summary').annotate(
+                students_count=models.Unit.related_count(models.Student), projects_count=models.Unit.related_count(models.Project), areas_count=models.Unit.related_count(models.Area))
         return self.unit_queryset
 
     def get_unit_object(self):
@@ -142,6 +237,20 @@ class UnitMixin(LoginRequiredMixin, UserPassesTestMixin):
                     <p>You can not make changes to the unit while this is happening.</p>
                     <p class="mb-0">Please refresh the page to check if the email of the preference list has been completed.</p>
                 """)
+            elif self.unit.celery_task.task_name == models.Unit.EMAIL_PROJECT_ROSTERS_TASK_NAME:
+                warning_message = format_html(
+                    """
+                    <p class="fw-bold">Email of Project Rosters In Progress</p>
+                    <p>You can not make changes to the unit while this is happening.</p>
+                    <p class="mb-0">Please refresh the page to check if the email of the project rosters has been completed.</p>
+                """)
+            elif self.unit.celery_task.task_name == models.Unit.EMAIL_STUDENTS_ALLOCATION_TASK_NAME:
+                warning_message = format_html(
+                    """
+                    <p class="fw-bold">Email of Allocated Projects to Students In Progress</p>
+                    <p>You can not make changes to the unit while this is happening.</p>
+                    <p class="mb-0">This may take a few minutes, please refresh the page to check if it has been completed.</p>
+                """)
             elif self.unit.celery_task.task_name == models.Unit.UPLOAD_PROJECTS_TASK_NAME:
                 warning_message = format_html(
                     """
@@ -163,6 +272,10 @@ class UnitMixin(LoginRequiredMixin, UserPassesTestMixin):
                     <p>You can not make changes to the unit while this is happening.</p>
                     <p class="mb-0">This may take a few minutes, please refresh the page to check if it has been completed.</p>
                 """)
+            task_progress = self.unit.get_task_progress()
+            if task_progress:
+                warning_message = warning_message + format_html(
+                    """<p class="mt-3 mb-0">{} of {} rows processed.</p>""", task_progress.get('rows_processed'), task_progress.get('rows_total'))
             self.warnings.append(
                 {'type': 'danger', 'content': warning_message})
         if not unit.is_active:
@@ -171,9 +284,10 @@ class UnitMixin(LoginRequiredMixin, UserPassesTestMixin):
         if unit.minimum_preference_limit and unit.minimum_preference_limit > unit.projects_count:
             self.warnings.append(
                 {'type': 'danger', 'content': 'The minimum preference limit is greater than the total number of projects in the unit. Please change this or else students will not be able to submit any preferences.'})
+        # The allocated student count is only needed, and so only queried, once the unit has been allocated
         unallocated_student_count = unit.students_count - \
-            unit.get_allocated_student_count()
-        if unit.completed_allocation() and unallocated_student_count > 0:
+            unit.get_allocated_student_count() if unit.completed_allocation() else 0
+        if unallocated_student_count > 0:
             self.warnings.append({'type': 'warning', 'content': format_html(f"""
             <p>There {'are' if unallocated_student_count > 1 else 'is'} {unallocated_student_count} student{'s' if unallocated_student_count > 1 else ''} who {'are' if unallocated_student_count > 1 else 'is'} not allocated to a project.</p>
             <p class="mb-0">To fix this:</p>
@@ -234,6 +348,8 @@ class UnitMixin(LoginRequiredMixin, UserPassesTestMixin):
                 'nested_items': [
                     {'url': reverse('manager:unit_preferences_distribution', kwargs={'pk_unit': unit.pk}),
                          'label': 'Project Popularity'},
+                    {'url': reverse('manager:unit_preferences_heat_map', kwargs={'pk_unit': unit.pk}),
+                     'label': 'Preference Heat Map'},
                     {'url': reverse('manager:unit_preferences_new_list', kwargs={'pk_unit': unit.pk}),
                      'label': 'Upload Preference List'},
                 ]
@@ -447,7 +563,15 @@ class StudentsMixin(UnitMixin):
         qs = models.Student.objects
         if hasattr(super(), 'get_queryset'):
             qs = super().get_queryset()
-        return qs.filter(unit=self.kwargs['pk_unit']).select_related('user').prefetch_related('project_preferences').select_related('allocated_project').prefetch_related('area').order_by('student_id')
+        return qs.filter(unit=self.kwargs['pk_unit']).select_related('user').select_related('allocated_project').order_by('student_id')
+
+
+class StudentsTypeaheadView(StudentsMixin, TypeaheadMixin, View):
+    search_fields = ['student_id', 'name']
+    keyset_ordering = ('student_id',)
+
+    def get_queryset(self):
+        return models.Student.objects.filter(unit=self.kwargs['pk_unit'])
 
 
 class StudentsListMixin(StudentsMixin):
@@ -475,6 +599,13 @@ class StudentsListMixin(StudentsMixin):
 
 
 class StudentsListView(StudentsListMixin, FilteredTableMixin, FilterView):
+    keyset_ordering = ('student_id',)
+
+    def get_queryset(self):
+        # The table shows whether each student has submitted preferences, not the preferences themselves
+        return annotate_area_links(super().get_queryset(), 'students').annotate(has_preferences=Exists(
+            models.ProjectPreference.objects.filter(student_id=OuterRef('pk'))))
+
     def get_page_actions(self):
         return [
             {'url': reverse('manager:unit_students_new_list',
@@ -526,8 +657,26 @@ class StudentsUploadListView(StudentsListMixin, FormMixin, TemplateView):
         form = forms.StudentListForm(
             request.POST, request.FILES, unit=self.get_unit_object())
         if form.is_valid():
-            # Reset file position after checking headers in form.clean()
             file = request.FILES['file']
+            list_options = {
+                'override_list': form.cleaned_data.get('list_override'),
+                'student_id_column': form.cleaned_data.get('student_id_column'),
+                'student_name_column': form.cleaned_data.get('student_name_column'),
+                'area_column': form.cleaned_data.get('area_column'),
+            }
+            if form.cleaned_data.get('dry_run'):
+                upload_preview = upload.preview_students_list(
+                    self.kwargs['pk_unit'], file, **list_options)
+                return self.render_to_response(self.get_context_data(form=form, upload_preview=upload_preview))
+
+            # Skip the upload if the same list has already been uploaded and the unit has not changed since
+            fingerprint = upload.fingerprint_upload(
+                self.kwargs['pk_unit'], models.Unit.UPLOAD_STUDENTS_TASK_NAME, file, list_options)
+            if upload.is_duplicate_upload(self.kwargs['pk_unit'], models.Unit.UPLOAD_STUDENTS_TASK_NAME, fingerprint):
+                self.warnings = [UNCHANGED_UPLOAD_WARNING]
+                return self.render_to_response(self.get_context_data(form=form))
+
+            # Reset file position after checking headers in form.clean()
             file.seek(0)
 
             file_bytes_base64 = base64.b64encode(file.read())
@@ -537,13 +686,8 @@ class StudentsUploadListView(StudentsListMixin, FormMixin, TemplateView):
                 unit_id=self.kwargs['pk_unit'],
                 manager_id=self.request.user.id,
                 file_bytes_base64_str=file_bytes_base64_str,
-                override_list=form.cleaned_data.get('list_override'),
-
-                student_id_column=form.cleaned_data.get('student_id_column'),
-                student_name_column=form.cleaned_data.get(
-                    'student_name_column'),
-                area_column=form.cleaned_data.get(
-                    'area_column')
+                fingerprint=fingerprint,
+                **list_options
             )
             self.get_unit_object().save_task(task=task)
 
@@ -565,6 +709,7 @@ class StudentsClearView(StudentsListMixin, FormMixin, TemplateView):
             unit.students.all().delete()
             unit.allocation_status = None
             unit.save()
+            models.Unit.data_changed(unit.id)
             return self.form_valid(form)
         else:
             return self.form_invalid(form)
@@ -644,6 +789,12 @@ class StudentDeleteView(StudentPageMixin, DeleteView):
     def get_success_url(self):
         return reverse('manager:unit_students', kwargs={'pk_unit': self.kwargs['pk_unit']})
 
+    def form_valid(self, form):
+        with transaction.atomic():
+            response = super().form_valid(form)
+            models.AllocationSummary.allocation_changed(self.kwargs['pk_unit'])
+        return response
+
     def get_form_kwargs(self):
         return {**super().get_form_kwargs(), 'cancel_url': self.get_page_title_url()}
 
@@ -662,7 +813,23 @@ class ProjectsMixin(UnitMixin):
         qs = models.Project.objects
         if hasattr(super(), 'get_queryset'):
             qs = super().get_queryset()
-        return qs.filter(unit=self.kwargs['pk_unit']).prefetch_related('area').prefetch_related('allocated_students').annotate(allocated_students_count=Count('allocated_students', distinct=True)).annotate(avg_allocated_pref=Avg('allocated_students__allocated_preference_rank')).order_by('identifier')
+        return qs.filter(unit=self.kwargs['pk_unit']).order_by('identifier')
+
+
+class ProjectsTypeaheadView(ProjectsMixin, TypeaheadMixin, View):
+    search_fields = ['identifier', 'name']
+    keyset_ordering = ('identifier',)
+
+    def get_queryset(self):
+        queryset = models.Project.objects.filter(unit=self.kwargs['pk_unit'])
+        if self.request.GET.get('group_size'):
+            queryset = queryset.annotate(allocated_students_count=Count('allocated_students'))
+        return queryset
+
+    def get_label(self, obj):
+        if hasattr(obj, 'allocated_students_count'):
+            return forms.allocated_project_label(obj, obj.allocated_students_count)
+        return super().get_label(obj)
 
 
 class ProjectsListMixin(ProjectsMixin):
@@ -674,7 +841,7 @@ class ProjectsListMixin(ProjectsMixin):
         if unit.is_allocated():
             allocated_info = [
                 {'label': 'No. Allocated Projects',
-                    'content': self.get_queryset().filter(allocated_students_count__gt=0).count()},
+                    'content': len(unit.get_allocation_summary().project_counts)},
             ]
         return [
             {'label': 'No. Projects', 'content': unit.projects_count},
@@ -688,6 +855,11 @@ class ProjectsListMixin(ProjectsMixin):
 
 
 class ProjectsListView(ProjectsListMixin, FilteredTableMixin, FilterView):
+    keyset_ordering = ('identifier',)
+
+    def get_queryset(self):
+        return annotate_area_links(super().get_queryset(), 'projects')
+
     def get_page_actions(self):
         return [
             {'url': reverse('manager:unit_projects_new_list',
@@ -707,6 +879,18 @@ class ProjectsListView(ProjectsListMixin, FilteredTableMixin, FilterView):
     def get_table_class(self):
         return tables.ProjectsAllocatedTable if self.get_unit_object().successfully_allocated() else tables.ProjectsTable
 
+    def get_table_data(self):
+        projects = super().get_table_data()
+        if not self.get_unit_object().successfully_allocated():
+            return projects
+        # Read the allocated group sizes from the allocation summary rather than aggregating the students of each project
+        summary = self.get_unit_object().get_allocation_summary()
+        projects = list(projects)
+        for project in projects:
+            project.allocated_students_count, project.avg_allocated_pref = summary.get_project_counts(
+                project.id)
+        return projects
+
 
 class ProjectCreateView(ProjectsListMixin, FormMixin, TemplateView):
     form_class = forms.ProjectForm
@@ -731,8 +915,29 @@ class ProjectsUploadListView(ProjectsListMixin, FormMixin, TemplateView):
         form = forms.ProjectListForm(
             request.POST, request.FILES, unit=self.get_unit_object())
         if form.is_valid():
-            # Reset file position after checking headers in form.clean()
             file = request.FILES['file']
+            list_options = {
+                'override_list': form.cleaned_data.get('list_override'),
+                'identifier_column': form.cleaned_data.get('identifier_column'),
+                'name_column': form.cleaned_data.get('name_column'),
+                'min_students_column': form.cleaned_data.get('min_students_column'),
+                'max_students_column': form.cleaned_data.get('max_students_column'),
+                'description_column': form.cleaned_data.get('description_column'),
+                'area_column': form.cleaned_data.get('area_column'),
+            }
+            if form.cleaned_data.get('dry_run'):
+                upload_preview = upload.preview_projects_list(
+                    self.kwargs['pk_unit'], file, **list_options)
+                return self.render_to_response(self.get_context_data(form=form, upload_preview=upload_preview))
+
+            # Skip the upload if the same list has already been uploaded and the unit has not changed since
+            fingerprint = upload.fingerprint_upload(
+                self.kwargs['pk_unit'], models.Unit.UPLOAD_PROJECTS_TASK_NAME, file, list_options)
+            if upload.is_duplicate_upload(self.kwargs['pk_unit'], models.Unit.UPLOAD_PROJECTS_TASK_NAME, fingerprint):
+                self.warnings = [UNCHANGED_UPLOAD_WARNING]
+                return self.render_to_response(self.get_context_data(form=form))
+
+            # Reset file position after checking headers in form.clean()
             file.seek(0)
 
             file_bytes_base64 = base64.b64encode(file.read())
@@ -740,16 +945,10 @@ class ProjectsUploadListView(ProjectsListMixin, FormMixin, TemplateView):
 
             task = tasks.upload_projects_list_task.delay(
                 unit_id=self.kwargs['pk_unit'],
-                manager_id=self.request.user.id, file_bytes_base64_str=file_bytes_base64_str,
-                override_list=form.cleaned_data.get('list_override'),
-                identifier_column=form.cleaned_data.get('identifier_column'),
-                name_column=form.cleaned_data.get('name_column'),
-                min_students_column=form.cleaned_data.get(
-                    'min_students_column'),
-                max_students_column=form.cleaned_data.get(
-                    'max_students_column'),
-                description_column=form.cleaned_data.get('description_column'),
-                area_column=form.cleaned_data.get('area_column')
+                manager_id=self.request.user.id,
+                file_bytes_base64_str=file_bytes_base64_str,
+                fingerprint=fingerprint,
+                **list_options
             )
             self.get_unit_object().save_task(task=task)
 
@@ -771,6 +970,7 @@ class ProjectsClearView(ProjectsListMixin, FormMixin, TemplateView):
             unit.projects.all().delete()
             unit.allocation_status = None
             unit.save()
+            models.Unit.data_changed(unit.id)
             return self.form_valid(form)
         else:
             return self.form_invalid(form)
@@ -783,13 +983,15 @@ class ProjectPageMixin(ProjectsMixin):
         project = self.get_object()
         allocated_info = []
         if self.get_unit_object().is_allocated():
+            allocated_students_count, avg_allocated_pref = self.get_unit_object(
+            ).get_allocation_summary().get_project_counts(project.id)
             allocated_info = [
                 {'label': 'Is Allocated', 'content': render_exists_badge(
                     project.is_allocated())},
                 {'label': 'Allocated Group Size',
-                    'content': project.allocated_students.count()},
+                    'content': allocated_students_count},
                 {'label': 'Average Allocated Preference',
-                    'content': project.avg_allocated_pref if project.avg_allocated_pref else 'n/a'},
+                    'content': round(avg_allocated_pref, 2) if avg_allocated_pref else 'n/a'},
             ]
         description_info = []
         if project.description:
@@ -829,10 +1031,10 @@ class ProjectDetailView(ProjectPageMixin, MultiTableMixin, DetailView):
         project_tables = []
         project = self.get_object()
 
-        preference_counts = project.get_preference_counts()
-        if preference_counts.exists():
+        preference_counts = self.get_unit_object().get_preference_distribution().get(project.id)
+        if preference_counts:
             preference_table = tables.ProjectPreferencesTable(
-                data=project.get_preference_counts())
+                data=[{'rank': rank, 'student_count': count} for rank, count in preference_counts.items()])
             preference_table.name = 'Preference Distribution'
             preference_table.id = 'preferences'
             project_tables.append(preference_table)
@@ -871,16 +1073,26 @@ class ProjectDeleteView(ProjectPageMixin, DeleteView):
 
     def form_valid(self, form):
         success_url = self.get_success_url()
-        # Adjust student preferences
-        update_prefs = []
-        for preference in self.object.student_preferences.all():
-            for preference in preference.student.project_preferences.all()[
-                    preference.rank - 1:]:
-                preference.rank = preference.rank - 1
-                update_prefs.append(preference)
-        self.object.delete()
-        models.ProjectPreference.objects.bulk_update(
-            update_prefs, fields=['rank'])
+        unit_preferences = models.ProjectPreference.objects.filter(
+            project__unit_id=self.object.unit_id)
+        with transaction.atomic():
+            # Move the preferences ranked after the project past every rank in the unit, so that no two preferences of a student share a rank while they are renumbered
+            offset = unit_preferences.aggregate(max_rank=Max('rank'))['max_rank'] or 0
+            project_rank = models.ProjectPreference.objects.filter(
+                student_id=OuterRef('student_id'), project_id=self.object.id).values('rank')[:1]
+            unit_preferences.filter(rank__gt=Subquery(project_rank)).update(
+                rank=F('rank') + offset)
+            self.object.delete()
+            # Move them back one rank lower, into the gap left by the project's preference
+            unit_preferences.filter(rank__gt=offset).update(
+                rank=F('rank') - offset - 1)
+            # Match the allocated ranks to the renumbered preferences, students who were allocated the project no longer have an allocated rank
+            allocated_rank = models.ProjectPreference.objects.filter(
+                student_id=OuterRef('pk'), project_id=OuterRef('allocated_project_id')).values('rank')[:1]
+            models.Student.objects.filter(unit_id=self.object.unit_id, allocated_preference_rank__isnull=False).update(
+                allocated_preference_rank=Subquery(allocated_rank))
+            models.Unit.data_changed(self.kwargs['pk_unit'])
+            models.AllocationSummary.allocation_changed(self.kwargs['pk_unit'])
         return HttpResponseRedirect(success_url)
 
     def get_form_kwargs(self):
@@ -901,7 +1113,7 @@ class AreasMixin(UnitMixin):
         qs = models.Area.objects
         if hasattr(super(), 'get_queryset'):
             qs = super().get_queryset()
-        return qs.filter(unit=self.kwargs['pk_unit']).prefetch_related('students').prefetch_related('projects').order_by('name')
+        return qs.filter(unit=self.kwargs['pk_unit']).order_by('name')
 
 
 class AreasListMixin(AreasMixin):
@@ -924,11 +1136,17 @@ class AreasListMixin(AreasMixin):
 
 class AreasListView(AreasListMixin, FilteredTableMixin, FilterView):
     model = models.Area
-
     table_class = tables.AreasTable
     filterset_class = filters.AreaFilter
     filter_formhelper_class = filters.AreaFilterFormHelper
 
+    def get_queryset(self):
+        # The table only shows whether each area has projects and students
+        return super().get_queryset().annotate(
+            has_projects=Exists(models.Project.area.through.objects.filter(
+                area_id=OuterRef('pk'))),
+            has_students=Exists(models.Student.area.through.objects.filter(area_id=OuterRef('pk'))))
+
     def get_page_actions(self):
         return [
             {'url': reverse('manager:unit_areas_new',
@@ -1051,11 +1269,8 @@ class PreferencesMixin(UnitMixin):
         unit = self.get_unit_object()
         students_exist_info = []
 
-        students_list = unit.students
-        submitted_prefs_count = students_list.annotate(project_preference_count=Count(
-            'project_preferences')).filter(project_preference_count__gt=0).count()
-
         if unit.students_count != 0:
+            submitted_prefs_count = unit.get_submitted_preferences_count()
             submitted_prefs_perc = round(
                 (submitted_prefs_count/unit.students_count)*100, 1)
 
@@ -1082,6 +1297,7 @@ class PreferencesView(PreferencesMixin, FilteredTableMixin, FilterView):
     table_class = tables.PreferencesTable
     filterset_class = filters.PreferenceFilter
     filter_formhelper_class = filters.PreferenceFilterFormHelper
+    keyset_ordering = ('student__student_id', 'rank')
 
     def get_page_actions(self):
         return [
@@ -1092,6 +1308,8 @@ class PreferencesView(PreferencesMixin, FilteredTableMixin, FilterView):
     def get_queryset(self):
         return super().get_queryset().filter(project__unit_id=self.kwargs['pk_unit']).prefetch_related('project').prefetch_related('student')
 
+    # Downloads are gzipped as they are streamed if the client accepts it
+    @method_decorator(gzip_page)
     def post(self, request, *args, **kwargs):
         email_results = 'email_results' in request.POST
         from . import export
@@ -1123,14 +1341,40 @@ class PreferencesDistributionView(PreferencesMixin, FilteredTableMixin, FilterVi
 
     def get_queryset(self):
         if not hasattr(self, 'queryset') or self.queryset == None:
-            project_queryset = super().get_queryset().filter(
-                unit_id=self.kwargs['pk_unit']).prefetch_related(
-                'student_preferences')
-            total_projects = project_queryset.count()
-            self.queryset = project_queryset.annotate(popularity=Coalesce(Sum(
-                total_projects - F('student_preferences__rank')), 0)).order_by('identifier', 'name')
+            self.queryset = super().get_queryset().filter(
+                unit_id=self.kwargs['pk_unit']).order_by('identifier', 'name')
         return self.queryset
 
+    def get_table_data(self):
+        # Popularity is calculated from the unit's preference distribution rather than a join over the preferences of each project
+        unit = self.get_unit_object()
+        distribution = unit.get_preference_distribution()
+        projects = list(super().get_table_data())
+        for project in projects:
+            project.popularity = sum((unit.projects_count - rank) * count
+                                     for rank, count in distribution.get(project.id, {}).items())
+        return projects
+
+
+class PreferencesHeatMapView(PreferencesMixin, SingleTableMixin, TemplateView):
+    page_subtitle = 'Preference Heat Map'
+    table_class = tables.PreferencesHeatMapTable
+
+    def get_table_data(self):
+        distribution = self.get_unit_object().get_preference_distribution()
+        projects = models.Project.objects.filter(
+            unit_id=self.kwargs['pk_unit']).order_by('identifier', 'name')
+        return [{'id': project.id, 'unit_id': project.unit_id, 'identifier': project.identifier, 'name': project.name,
+                 **{f'rank_{rank}': count for rank, count in distribution.get(project.id, {}).items()}} for project in projects]
+
+    def get_table_kwargs(self):
+        # A column for each rank that a project was preferred at, shaded relative to the most students at any rank
+        counts = self.get_unit_object().get_preference_distribution().values()
+        ranks = sorted({rank for project_counts in counts for rank in project_counts})
+        max_count = max((count for project_counts in counts for count in project_counts.values()), default=0)
+        return {'extra_columns': [(f'rank_{rank}', tables.PreferenceHeatMapColumn(
+            verbose_name=f'Rank {rank}', max_count=max_count)) for rank in ranks]}
+
 
 class PreferencesUploadListView(PreferencesMixin, FormMixin, TemplateView):
     model = models.ProjectPreference
@@ -1144,8 +1388,25 @@ class PreferencesUploadListView(PreferencesMixin, FormMixin, TemplateView):
         form = forms.PreferenceListForm(
             request.POST, request.FILES, unit=self.get_unit_object())
         if form.is_valid():
-            # Reset file position after checking headers in form.clean()
             file = request.FILES['file']
+            list_options = {
+                'preference_rank_column': form.cleaned_data.get('preference_rank_column'),
+                'student_id_column': form.cleaned_data.get('student_id_column'),
+                'project_identifier_column': form.cleaned_data.get('project_identifier_column'),
+            }
+            if form.cleaned_data.get('dry_run'):
+                upload_preview = upload.preview_preferences_list(
+                    self.kwargs['pk_unit'], file, **list_options)
+                return self.render_to_response(self.get_context_data(form=form, upload_preview=upload_preview))
+
+            # Skip the upload if the same list has already been uploaded and the unit has not changed since
+            fingerprint = upload.fingerprint_upload(
+                self.kwargs['pk_unit'], models.Unit.UPLOAD_PREFERENCES_TASK_NAME, file, list_options)
+            if upload.is_duplicate_upload(self.kwargs['pk_unit'], models.Unit.UPLOAD_PREFERENCES_TASK_NAME, fingerprint):
+                self.warnings = [UNCHANGED_UPLOAD_WARNING]
+                return self.render_to_response(self.get_context_data(form=form))
+
+            # Reset file position after checking headers in form.clean()
             file.seek(0)
 
             file_bytes_base64 = base64.b64encode(file.read())
@@ -1153,12 +1414,10 @@ class PreferencesUploadListView(PreferencesMixin, FormMixin, TemplateView):
 
             task = tasks.upload_preferences_list_task.delay(
                 unit_id=self.kwargs['pk_unit'],
-                manager_id=self.request.user.id, file_bytes_base64_str=file_bytes_base64_str,
-                preference_rank_column=form.cleaned_data.get(
-                    'preference_rank_column'),
-                student_id_column=form.cleaned_data.get('student_id_column'),
-                project_identifier_column=form.cleaned_data.get(
-                    'project_identifier_column')
+                manager_id=self.request.user.id,
+                file_bytes_base64_str=file_bytes_base64_str,
+                fingerprint=fingerprint,
+                **list_options
             )
             self.get_unit_object().save_task(task=task)
             return self.form_valid(form)
@@ -1224,28 +1483,27 @@ class AllocationView(UnitMixin, TemplateView):
         unit = self.get_unit_object()
         allocated_info = []
         if unit.is_allocated():
+            summary = unit.get_allocation_summary()
             allocated_info = [
                 {'label': 'Allocation Status',
                  'content': unit.get_allocation_descriptive(), 'classes': 'align-items-center', 'content_classes': f'rounded bg-{"success" if unit.successfully_allocated() else "danger"}-subtle border border-{"success" if unit.successfully_allocated() else "danger"}-subtle p-1 px-2'},
                 {'label': 'Average Allocated Preference',
-                    'content': unit.avg_allocated_pref_rounded if unit.avg_allocated_pref_rounded else '—'},
+                    'content': round(summary.avg_allocated_pref, 2) if summary.avg_allocated_pref else '—'},
                 {'label': 'Best Allocated Preference',
-                    'content': unit.min_allocated_pref if unit.min_allocated_pref else '—'},
+                    'content': summary.min_allocated_pref if summary.min_allocated_pref else '—'},
                 {'label': 'Worst Allocated Preference',
-                    'content': unit.max_allocated_pref if unit.max_allocated_pref else '—'},
+                    'content': summary.max_allocated_pref if summary.max_allocated_pref else '—'},
+                {'label': 'Students Allocated to each Preference',
+                    'content': ', '.join(f'{rank}: {count}' for rank, count in summary.rank_counts.items()) if summary.rank_counts else '—'},
             ]
 
-        students_list = models.Student.objects.filter(
-            unit=self.kwargs['pk_unit'])
-        students_count = students_list.count()
-        if students_count == 0:
+        if unit.students_count == 0:
             return [
                 {'label': 'No. Students', 'content': unit.students_count}]
 
-        submitted_prefs_count = students_list.annotate(project_preference_count=Count(
-            'project_preferences')).filter(project_preference_count__gt=0).count()
+        submitted_prefs_count = unit.get_submitted_preferences_count()
         submitted_prefs_perc = round(
-            (submitted_prefs_count/students_count)*100, 1)
+            (submitted_prefs_count/unit.students_count)*100, 1)
 
         return [
             {'label': 'No. Students', 'content': unit.students_count},
@@ -1253,18 +1511,13 @@ class AllocationView(UnitMixin, TemplateView):
                 'content': f'{ submitted_prefs_perc }% ({ submitted_prefs_count } Students)'},
         ] + allocated_info
 
-    def get_unit_queryset(self):
-        if not hasattr(self, 'unit_queryset'):
-            self.unit_queryset = super().get_unit_queryset().prefetch_related('projects').prefetch_related('students').annotate(
-                avg_allocated_pref_rounded=Round(Avg('students__allocated_preference_rank'), 2)).annotate(
-                max_allocated_pref=Max('students__allocated_preference_rank')).annotate(
-                min_allocated_pref=Min('students__allocated_preference_rank'))
-        return self.unit_queryset
-
+    # Downloads are gzipped as they are streamed if the client accepts it
+    @method_decorator(gzip_page)
     def post(self, request, *args, **kwargs):
         if 'start_allocation' in request.POST:
             task = tasks.start_allocation_task.delay(
-                unit_id=self.kwargs['pk_unit'], manager_id=self.request.user.id, results_url=request.build_absolute_uri(reverse('manager:unit_allocation', kwargs={'pk_unit': self.kwargs['pk_unit']})))
+                unit_id=self.kwargs['pk_unit'], manager_id=self.request.user.id, results_url=request.build_absolute_uri(reverse('manager:unit_allocation', kwargs={'pk_unit': self.kwargs['pk_unit']})),
+                students_url=request.build_absolute_uri(reverse('student:unit-detail', kwargs={'pk': self.kwargs['pk_unit']})) if 'notify_students' in request.POST else None)
             self.get_unit_object().save_task(task=task)
             return HttpResponseRedirect(self.request.path)
         from . import export
@@ -1273,6 +1526,18 @@ class AllocationView(UnitMixin, TemplateView):
                 unit_id=self.kwargs['pk_unit'], manager_id=self.request.user.id)
             self.get_unit_object().save_task(task=task)
             return HttpResponseRedirect(self.request.path)
+        if 'email_students' in request.POST:
+            task = tasks.email_students_allocation_task.delay(
+                unit_id=self.kwargs['pk_unit'], unit_url=request.build_absolute_uri(reverse('student:unit-detail', kwargs={'pk': self.kwargs['pk_unit']})))
+            self.get_unit_object().save_task(task=task)
+            return HttpResponseRedirect(self.request.path)
         if 'download_results' in request.POST:
             return export.download_allocation_results_csv(unit_id=self.kwargs['pk_unit'])
+        if 'email_rosters' in request.POST:
+            task = tasks.email_project_rosters_zip_task.delay(
+                unit_id=self.kwargs['pk_unit'], manager_id=self.request.user.id)
+            self.get_unit_object().save_task(task=task)
+            return HttpResponseRedirect(self.request.path)
+        if 'download_rosters' in request.POST:
+            return export.download_project_rosters_zip(unit_id=self.kwargs['pk_unit'])
         return HttpResponseRedirect(self.request.path)
@@ -0,0 +1,40 @@
+const typeahead_search = (select, search, after) => {
+	const url = new URL(select.data('typeahead-url'), window.location.href);
+	url.searchParams.set('q', search);
+	if (after) url.searchParams.set('after', after);
+	$.getJSON(url.toString(), (data) => {
+		if (!after) {
+			// Keep the selected choices and replace the previous results
+			select.find('option:not(:selected)').filter((index, option) => option.value !== '').remove();
+		}
+		data.results.forEach((result) => {
+			if (!select.find(`option[value="${result.id}"]`).length) {
+				select.append($('<option>').val(result.id).text(result.text));
+			}
+		});
+		select.data('typeahead-next', data.next);
+		select.data('typeahead-more').toggleClass('d-none', !data.next);
+	});
+};
+
+const init_typeahead = (index, select) => {
+	select = $(select);
+	const container = select.parent('.form-floating').length ? select.parent('.form-floating') : select;
+	const search = $('<input type="search" class="form-control mb-2" placeholder="Search..." />');
+	const more = $('<button type="button" class="btn btn-sm btn-link d-none">Load more results</button>');
+	container.before(search);
+	container.after(more);
+	select.data('typeahead-more', more);
+
+	let timeout = null;
+	search.on('input', () => {
+		clearTimeout(timeout);
+		timeout = setTimeout(() => typeahead_search(select, search.val()), 250);
+	});
+	more.on('click', () => typeahead_search(select, search.val(), select.data('typeahead-next')));
+	typeahead_search(select, '');
+};
+
+$(() => {
+	$('select[data-typeahead-url]').each(init_typeahead);
+});
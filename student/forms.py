@@ -51,17 +51,20 @@ class PreferenceFormSet(BaseFormSet):
         """ Checks that all projects are listed only once & that submitted ranks are valid. """
         if any(self.errors):
             return
+        forms_to_check = [form for form in self.forms if not (
+            self.can_delete and self._should_delete_form(form))]
+        # The submitted projects are found in a single query
+        unit_project_ids = set(self.unit.projects.filter(id__in=[form.cleaned_data.get(
+            'project_id') for form in forms_to_check]).values_list('id', flat=True))
         projects = []
         ranks = []
-        for form in self.forms:
-            if self.can_delete and self._should_delete_form(form):
-                continue
+        for form in forms_to_check:
             """ Validate project ids """
             project_id = form.cleaned_data.get('project_id')
             if project_id in projects:
                 raise forms.ValidationError(
                     'You can only choose each project once.')
-            if not self.unit.projects.filter(id=project_id).exists():
+            if project_id not in unit_project_ids:
                 raise forms.ValidationError(
                     f'A project with the ID of {project_id} does not exist in this unit. Please hit cancel and try again.')
             projects.append(project_id)
@@ -72,7 +75,7 @@ class PreferenceFormSet(BaseFormSet):
                     'Each preference rank must be unique.')
             ranks.append(rank)
         ranks_sorted = sorted(ranks)
-        if ranks_sorted[0] != 1:
+        if ranks_sorted and ranks_sorted[0] != 1:
             raise forms.ValidationError(
                 'Your first preference rank must be 1.')
         if not all(ranks_sorted[i] == ranks_sorted[i-1] +
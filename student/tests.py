@@ -1,3 +1,84 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
-# Create your tests here.
+from core import models
+
+
+class PreferenceSubmissionTests(TestCase):
+    def setUp(self):
+        self.manager = models.User.objects.create(
+            username='manager', email='manager@example.com', is_manager=True)
+        self.unit = models.Unit.objects.create(
+            code='SUBMIT', name='SUBMIT', year='2024', semester='1', manager=self.manager)
+        self.projects = models.Project.objects.bulk_create([models.Project(
+            unit=self.unit, identifier=f'p{i:02}', name=f'Project {i}', min_students=1, max_students=5) for i in range(30)])
+        self.user = models.User.objects.create(
+            username='submitter', email='submitter@example.com', is_student=True)
+        self.student = models.Student.objects.create(
+            unit=self.unit, student_id='submitter')
+        self.client.force_login(self.user)
+
+    def submit(self, projects):
+        data = {'form-TOTAL_FORMS': len(projects), 'form-INITIAL_FORMS': 0,
+                'form-MIN_NUM_FORMS': 0, 'form-MAX_NUM_FORMS': 1000}
+        for index, project_id in enumerate(projects):
+            data[f'form-{index}-rank'] = index + 1
+            data[f'form-{index}-project_id'] = project_id
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse('student:unit-detail', kwargs={'pk': self.unit.id}), data)
+        return response, queries.captured_queries
+
+    def get_preferences(self):
+        return list(self.student.project_preferences.order_by('rank').values_list('project_id', flat=True))
+
+    def get_data_version(self):
+        return models.Unit.objects.get(pk=self.unit.id).data_version
+
+    def test_submission(self):
+        ids = [project.id for project in self.projects]
+        response, queries = self.submit(ids[:5])
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.get_preferences(), ids[:5])
+
+        # Swap the first two preferences
+        submitted = [ids[1], ids[0]] + ids[2:5]
+        response, small_queries = self.submit(submitted)
+        self.assertEqual(self.get_preferences(), submitted)
+
+        # Reverse the preferences, replace one and add many more
+        submitted = submitted[::-1][:4] + ids[20:30] + ids[5:15]
+        response, large_queries = self.submit(submitted)
+        self.assertEqual(len(small_queries), len(large_queries))
+        self.assertEqual(self.get_preferences(), submitted)
+
+        response, queries = self.submit(submitted[:3])
+        self.assertEqual(self.get_preferences(), submitted[:3])
+
+    def test_unchanged_submission(self):
+        ids = [project.id for project in self.projects]
+        self.submit(ids[:5])
+        preference_ids = list(self.student.project_preferences.order_by(
+            'rank').values_list('id', flat=True))
+        data_version = self.get_data_version()
+
+        response, queries = self.submit(ids[:5])
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual([query['sql'].split()[0] for query in queries if query['sql'].startswith(('INSERT', 'DELETE', 'UPDATE'))], [])
+        self.assertEqual(list(self.student.project_preferences.order_by(
+            'rank').values_list('id', flat=True)), preference_ids)
+        self.assertEqual(self.get_data_version(), data_version)
+
+    def test_invalid_project(self):
+        ids = [project.id for project in self.projects]
+        self.submit(ids[:3])
+        other_unit = models.Unit.objects.create(
+            code='OTHER', name='OTHER', year='2024', semester='1', manager=self.manager)
+        other_project = models.Project.objects.create(
+            unit=other_unit, identifier='x', name='Other', min_students=1, max_students=1)
+        response, queries = self.submit(ids[:2] + [other_project.id])
+        self.assertEqual(response.context['form'].non_form_errors(), [
+                         f'A project with the ID of {other_project.id} does not exist in this unit. Please hit cancel and try again.'])
+        self.assertEqual(self.get_preferences(), ids[:3])
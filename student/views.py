@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.messages.views import SuccessMessageMixin
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.db.models import Q, Count
@@ -66,61 +66,33 @@ class UnitDetailView(SuccessMessageMixin, LoginRequiredMixin, UserPassesTestMixi
     def get_success_url(self):
         return self.request.path
 
+    def save_preferences(self, formset):
+        """
+            Apply the difference between the student's preferences and the submitted preferences, in a single transaction
+        """
+        student = self.get_student_object()
+        submitted = {(form.cleaned_data.get('rank'), form.cleaned_data.get('project_id'))
+                     for form in formset}
+        with transaction.atomic():
+            current = {(rank, project_id): preference_id for preference_id, rank, project_id in student.project_preferences.values_list(
+                'id', 'rank', 'project_id')}
+            # Unchanged preferences are kept, any preference with a different rank or project is replaced
+            removed = [preference_id for preference,
+                       preference_id in current.items() if preference not in submitted]
+            added = [models.ProjectPreference(student=student, rank=rank, project_id=project_id)
+                     for rank, project_id in submitted if (rank, project_id) not in current]
+            if removed:
+                models.ProjectPreference.objects.filter(pk__in=removed).delete()
+            if added:
+                models.ProjectPreference.objects.bulk_create(added)
+            if removed or added:
+                models.Unit.data_changed(student.unit_id)
+
     def post(self, request, *args, **kwargs):
         self.object_list = self.get_queryset()
         formset = self.get_form()
         if formset.is_valid():
-            students_preferences = self.get_students_preferences()
-            # Delete any preferences that are outside the number of submitted preferences
-            for preference in students_preferences.all()[formset.total_form_count():]:
-                preference.delete()
-
-            for form in formset:
-                # Set the project for this form instance
-                project = models.Project.objects.filter(
-                    id=form.cleaned_data.get('project_id'))
-                if project.exists():
-                    form.instance.project = project.first()
-
-                    # Don't re-save existing records
-                    preference_exists = students_preferences.filter(
-                        rank=form.instance.rank, project=form.instance.project)
-
-                    if not preference_exists.exists():
-                        preference_at_current_rank = students_preferences.filter(
-                            rank=form.instance.rank)
-                        preference_with_current_project = students_preferences.filter(
-                            project=form.instance.project)
-
-                        if preference_at_current_rank.exists() and preference_with_current_project.exists():
-                            preference_at_current_rank = preference_at_current_rank.first()
-                            preference_with_current_project = preference_with_current_project.first()
-                            if preference_at_current_rank.project != form.instance.project and preference_with_current_project.rank != form.instance.rank:
-                                # Swap these records
-                                preference_at_current_rank.rank = 0
-                                preference_at_current_rank.save()
-
-                                temp = preference_with_current_project.rank
-                                preference_with_current_project.rank = form.instance.rank
-                                preference_with_current_project.save()
-
-                                preference_at_current_rank.rank = temp
-                                preference_at_current_rank.save()
-                        elif preference_at_current_rank.exists():
-                            preference_at_current_rank = preference_at_current_rank.first()
-                            # Replace preference at current rank with this project
-                            preference_at_current_rank.project = form.instance.project
-                            preference_at_current_rank.save()
-                        elif preference_with_current_project.exists():
-                            preference_with_current_project = preference_with_current_project.first()
-                            # Replace preference with current project with new rank
-                            preference_with_current_project.rank = form.instance.rank
-                            preference_at_current_rank.save()
-                        else:
-                            # Create new record
-                            form.instance.student = self.get_student_object()
-                            form.instance.save()
-
+            self.save_preferences(formset)
             return self.form_valid(formset)
         else:
             return self.form_invalid(formset)
@@ -135,11 +107,12 @@ class UnitDetailView(SuccessMessageMixin, LoginRequiredMixin, UserPassesTestMixi
         if formset:
             preference_from_form = []
             # Reload with form values
+            projects = unit.projects.in_bulk(
+                [form.cleaned_data.get('project_id') for form in formset])
             for form in formset:
-                project = models.Project.objects.filter(
-                    id=form.cleaned_data.get('project_id'))
-                if project.exists():
-                    form.instance.project = project.first()
+                project = projects.get(form.cleaned_data.get('project_id'))
+                if project:
+                    form.instance.project = project
                     form.instance.student = self.get_student_object()
                     preference_from_form.append(form.instance)
 